@@ -14,7 +14,8 @@ setup(
         'zstandard'
     ],
     extras_require={
-        'dist_plots': ["matplotlib", 'cartopy', 'fiona', 'pillow']
+        'dist_plots': ["matplotlib", 'cartopy', 'fiona', 'pillow'],
+        'parquet': ['pyarrow']
     },
     url='https://github.com/alrichardbollans/wcvpy',
     license='GNU v.3',
@@ -1,42 +1,263 @@
+import contextlib
 import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
 
 import pandas as pd
-import requests
+
+from wcvpy.wcvp_download.get_taxa_from_wcvp import _offline_mode
 
 _openrefine_ipni_service_url = 'http://data1.kew.org/reconciliation/reconcile/IpniName'
 
 reco_submitted_name_col_id = 'reco_submitted_name_col_id'
+# Names which couldn't be reconciled, because their requests failed or (offline) they have no stored results, are
+# listed in this attr of the output of openrefine_match_full_names
+openrefine_failed_names_attr = 'openrefine_failed_names'
+
+# Names are sent to the reconciliation service in batches of at most this many names, with this many batches sent at
+# a time
+openrefine_batch_size = 20
+openrefine_max_workers = 4
+# Seconds to wait for the reconciliation service to respond to a batch
+_openrefine_timeout = 120
+_openrefine_retries = 4
+# Seconds to wait before the first retry, doubled for each later retry
+_openrefine_retry_wait = 1
+# Responses after which the batch is retried, along with connection errors and timeouts
+_openrefine_retry_statuses = [429, 500, 502, 503, 504]
 
+openrefine_outputs_dir = os.path.join('name matching temp outputs', 'openrefine matches')
+# Results of the names reconciled are stored in this file in openrefine_outputs_dir
+_openrefine_cache_file = 'openrefine_matches.sqlite'
+# If given, stored results older than this many seconds are reconciled again
+openrefine_cache_ttl = None
 
-def _reconcile(row, full_name_col):
-    query = {'query': row[full_name_col]}
-    query_json = json.dumps(query)
-    # pass to reconciliation service
-    url = _openrefine_ipni_service_url + '?query=' + query_json
-    r = requests.get(url=url)
+
+def _reconciliation_results(raw_results: list) -> list:
+    # [id, name, score] of each of the results given by the reconciliation service for a query
     reco_results = []
-    try:
-        res = r.json()['result']
-        if res is not None:
-            for result in res:
-                id = result['id']
-                name = result['name']
-                reco_results.append([id, name, result['score']])
-    except json.decoder.JSONDecodeError:
-        pass
+    if raw_results is not None:
+        for result in raw_results:
+            id = result['id']
+            name = result['name']
+            reco_results.append([id, name, result['score']])
     return reco_results
 
 
+def _normalised_query(name: str) -> str:
+    return ' '.join(str(name).split())
+
+
+def _openrefine_cache_path() -> str:
+    return os.path.join(openrefine_outputs_dir, _openrefine_cache_file)
+
+
+@contextlib.contextmanager
+def _openrefine_database():
+    os.makedirs(openrefine_outputs_dir, exist_ok=True)
+    connection = sqlite3.connect(_openrefine_cache_path(), timeout=60)
+    try:
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS openrefine_results (query TEXT PRIMARY KEY, '
+                               'results TEXT NOT NULL, fetched REAL NOT NULL)')
+        yield connection
+    finally:
+        connection.close()
+
+
+def _read_cached_results(queries: List[str], cache_ttl: float) -> Dict[str, list]:
+    """
+    Looks up the stored raw results of the queries, ignoring those older than cache_ttl seconds if given.
+    :param queries:
+    :param cache_ttl:
+    :return: Raw results of each query found
+    """
+    if not os.path.exists(_openrefine_cache_path()) or len(queries) == 0:
+        return {}
+    oldest = 0 if cache_ttl is None else time.time() - cache_ttl
+    try:
+        with _openrefine_database() as connection:
+            connection.execute('CREATE TEMP TABLE lookup (query TEXT PRIMARY KEY)')
+            connection.executemany('INSERT OR IGNORE INTO lookup VALUES (?)', [(q,) for q in queries])
+            found = connection.execute(
+                'SELECT openrefine_results.query, openrefine_results.results FROM lookup JOIN openrefine_results ON '
+                'openrefine_results.query = lookup.query WHERE openrefine_results.fetched >= ?', (oldest,)).fetchall()
+    except sqlite3.Error as e:
+        print(f'WARNING: Could not read stored OpenRefine results ({e}): {_openrefine_cache_path()}')
+        return {}
+    return {q: json.loads(results) for q, results in found}
+
+
+def _write_cached_results(raw_results: Dict[str, list]):
+    if len(raw_results) == 0:
+        return
+    now = time.time()
+    try:
+        with _openrefine_database() as connection:
+            with connection:
+                connection.executemany('INSERT OR REPLACE INTO openrefine_results VALUES (?, ?, ?)',
+                                       [(q, json.dumps(r), now) for q, r in raw_results.items()])
+    except sqlite3.Error as e:
+        print(f'WARNING: Could not store OpenRefine results ({e}): {_openrefine_cache_path()}')
+
+
+def clear_stored_openrefine_matches():
+    """
+    Removes all stored OpenRefine results.
+    :return:
+    """
+    if os.path.exists(_openrefine_cache_path()):
+        os.remove(_openrefine_cache_path())
+
+
+def _openrefine_session(max_workers: int):
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _reconcile_batch(session, names: List[str]) -> Dict[str, list]:
+    """
+    Reconciles a batch of names in one request, using the multiple query form of the reconciliation API. Requests are
+    retried with exponential backoff, and a ConnectionError is raised if the batch still fails or the service returns
+    none of its queries.
+    :param session:
+    :param names:
+    :return: The raw results (which may be None) of each name the service returned a result for
+    """
+    import requests
+    queries = json.dumps({f'q{i}': {'query': name} for i, name in enumerate(names)})
+    attempt = 0
+    while True:
+        wait = _openrefine_retry_wait * 2 ** attempt
+        try:
+            r = session.post(_openrefine_ipni_service_url, data={'queries': queries}, timeout=_openrefine_timeout)
+            if r.status_code not in _openrefine_retry_statuses:
+                try:
+                    content = r.json()
+                except ValueError:
+                    raise ConnectionError('results not retrieved due to server error')
+                if not isinstance(content, dict):
+                    raise ConnectionError('results not retrieved due to server error')
+                # Queries missing from the response are left out, so that they aren't stored as having no results
+                query_responses = {name: content.get(f'q{i}') for i, name in enumerate(names)}
+                raw_results = {name: q['result'] for name, q in query_responses.items()
+                               if isinstance(q, dict) and 'result' in q}
+                if len(raw_results) == 0 and len(names) > 0:
+                    raise ConnectionError('no results returned')
+                return raw_results
+            problem = f'HTTP {r.status_code}'
+            retry_after = r.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                wait = int(retry_after)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            problem = str(e)
+        attempt += 1
+        if attempt > _openrefine_retries:
+            raise ConnectionError(f'OpenRefine reconciliation failed ({problem})')
+        time.sleep(wait)
+
+
+def _fetch_raw_results(names: List[str], batch_size: int, max_workers: int) -> Dict[str, list]:
+    """
+    Reconciles the names, sending batches of names concurrently over a pool of connections. Names in batches which
+    fail, or missing from the response to their batch, are left out, and a ConnectionError is raised if every batch
+    fails.
+    :return: Raw results of each name reconciled
+    """
+    batches = [names[i:i + batch_size] for i in range(0, len(names), batch_size)]
+    problems = []
+
+    def reconcile(batch):
+        try:
+            results = _reconcile_batch(session, batch)
+            missing = [name for name in batch if name not in results]
+            if len(missing) > 0:
+                print(f'WARNING: No results returned for {len(missing)} names: {missing[:5]}')
+            return results
+        except ConnectionError as e:
+            print(f'WARNING: Could not reconcile {len(batch)} names ({e}): {batch[:5]}')
+            problems.append(str(e))
+            return {}
+
+    with _openrefine_session(max_workers) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        batch_results = list(executor.map(reconcile, batches))
+    if len(batches) > 0 and len(problems) == len(batches):
+        raise ConnectionError(problems[0])
+    return {name: raw for results in batch_results for name, raw in results.items()}
+
+
+def _reconcile_names(names: List[str], batch_size: int = None, max_workers: int = None, offline: bool = None,
+                     cache_ttl: float = None) -> Tuple[List[list], List[str]]:
+    """
+    As reconcile_names, also returning the names which couldn't be reconciled.
+    """
+    batch_size = openrefine_batch_size if batch_size is None else batch_size
+    max_workers = openrefine_max_workers if max_workers is None else max_workers
+    cache_ttl = openrefine_cache_ttl if cache_ttl is None else cache_ttl
+    queries = [_normalised_query(n) for n in names]
+    unique_queries = list(dict.fromkeys(queries))
+    raw_results = _read_cached_results(unique_queries, cache_ttl)
+    new_queries = [q for q in unique_queries if q not in raw_results]
+    if len(new_queries) > 0:
+        if _offline_mode(offline):
+            print(f'WARNING: Offline, so {len(new_queries)} names without stored OpenRefine results are left unmatched')
+        else:
+            fetched = _fetch_raw_results(new_queries, batch_size, max_workers)
+            _write_cached_results(fetched)
+            raw_results.update(fetched)
+    failed_names = [n for n, q in zip(names, queries) if q not in raw_results]
+    return [_reconciliation_results(raw_results.get(q)) for q in queries], failed_names
+
+
+def reconcile_names(names: List[str], batch_size: int = None, max_workers: int = None, offline: bool = None,
+                    cache_ttl: float = None) -> List[list]:
+    """
+    Reconciles the names with the IPNI reconciliation service. The results of each (whitespace normalised) name are
+    stored, and names with stored results aren't sent to the service again.
+    :param names:
+    :param batch_size: Defaults to openrefine_batch_size
+    :param max_workers: Defaults to openrefine_max_workers
+    :param offline: If True, only stored results are used and names without them are left unmatched. Defaults to the
+    WCVPY_OFFLINE environment variable.
+    :param cache_ttl: Seconds after which stored results are reconciled again. Defaults to openrefine_cache_ttl,
+    where None keeps them indefinitely.
+    :return: The [id, name, score] of each result for each name
+    """
+    return _reconcile_names(names, batch_size=batch_size, max_workers=max_workers, offline=offline,
+                            cache_ttl=cache_ttl)[0]
+
+
 def openrefine_match_full_names(df: pd.DataFrame, full_name_col: str,
-                                output_csv: str = None) -> pd.DataFrame:
+                                output_csv: str = None, batch_size: int = None,
+                                max_workers: int = None, offline: bool = None,
+                                cache_ttl: float = None) -> pd.DataFrame:
+    """
+    Reconciles the names in full_name_col with the IPNI reconciliation service, giving a row for each result.
+    :param df:
+    :param full_name_col:
+    :param output_csv:
+    :param batch_size: Names per request, defaults to openrefine_batch_size
+    :param max_workers: Requests sent at a time, defaults to openrefine_max_workers
+    :param offline: If True, only stored results are used (see reconcile_names)
+    :param cache_ttl: Seconds after which stored results are reconciled again
+    :return: A row for each result of each name, with the names which couldn't be reconciled in
+    attrs[openrefine_failed_names_attr]
+    """
     out_df = df.copy()
     out_df[reco_submitted_name_col_id] = df[full_name_col]
     out_df = out_df.drop_duplicates(subset=[reco_submitted_name_col_id])
     print(f'Trying to resolve {len(out_df)} names with OpenRefine')
     # Reconcile
-    out_df['reco_results'] = out_df.apply(
-        lambda row: _reconcile(row, full_name_col=full_name_col),
-        axis=1)
+    reco_results, failed_names = _reconcile_names(out_df[full_name_col].tolist(), batch_size=batch_size,
+                                                  max_workers=max_workers, offline=offline, cache_ttl=cache_ttl)
+    out_df['reco_results'] = pd.Series(reco_results, index=out_df.index, dtype=object)
     # Explode reconciliation results so that each in own row
     out_df = out_df.explode('reco_results')
     # Extract ID, name and score from exploded reconciliation results
@@ -50,4 +271,5 @@ def openrefine_match_full_names(df: pd.DataFrame, full_name_col: str,
     if output_csv is not None:
         out_df.to_csv(output_csv)
 
+    out_df.attrs[openrefine_failed_names_attr] = failed_names
     return out_df
@@ -1,10 +1,19 @@
+import json
 import os
 import sys
+import tempfile
+import threading
 import time
 import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+from unittest import mock
 
+import numpy as np
 
 from wcvpy.OpenRefineMatching import *
+from wcvpy.OpenRefineMatching import find_OpenRefine_matches
 
 
 if sys.version_info >= (3, 9):
@@ -15,8 +24,88 @@ unittest_inputs = str(files(__name__).joinpath('test_inputs'))
 unittest_outputs = str(files(__name__).joinpath('test_outputs'))
 
 
+class _StandInReconciliation:
+    """
+    Answers single (query=) and multiple (queries=) reconciliation queries. Names starting with 'Match' get two
+    results, names starting with 'Null' get a null result and other names no results. The first `unavailable`
+    requests get a 503 response, requests containing a name in `failing_names` get a 500 response and queries for
+    names in `omitted_names` are left out of responses.
+    """
+
+    def __init__(self, unavailable: int = 0, failing_names: List[str] = None, omitted_names: List[str] = None):
+        self.unavailable = unavailable
+        self.failing_names = [] if failing_names is None else failing_names
+        self.omitted_names = [] if omitted_names is None else omitted_names
+        self.requests = []
+        self.lock = threading.Lock()
+
+        server = self
+
+        def results(query):
+            name = query['query']
+            if name.startswith('Match'):
+                return {'result': [{'id': name + '-1', 'name': name, 'score': 100.0, 'match': True},
+                                   {'id': name + '-2', 'name': name + ' var. b', 'score': 50.5, 'match': False}]}
+            if name.startswith('Null'):
+                return {'result': None}
+            return {'result': []}
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _respond(self, status: int, content=None):
+                body = b'' if content is None else json.dumps(content).encode()
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _answer(self, params):
+                with server.lock:
+                    server.requests.append(params)
+                    unavailable = server.unavailable > 0
+                    server.unavailable -= 1
+                if unavailable:
+                    return self._respond(503)
+                if 'queries' in params:
+                    queries = json.loads(params['queries'][0])
+                    if any(q['query'] in server.failing_names for q in queries.values()):
+                        return self._respond(500)
+                    return self._respond(200, {k: results(q) for k, q in queries.items()
+                                               if q['query'] not in server.omitted_names})
+                self._respond(200, results(json.loads(params['query'][0])))
+
+            def do_GET(self):
+                self._answer(urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query))
+
+            def do_POST(self):
+                self._answer(urllib.parse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode()))
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/reconciliation/reconcile/IpniName'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
 class MyTestCase(unittest.TestCase):
 
+    def setUp(self):
+        # Results are stored in a temporary directory
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        patcher = mock.patch.object(find_OpenRefine_matches, 'openrefine_outputs_dir', self.temp_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def compare_series(self, s1: pd.Series, s2: pd.Series):
         try:
             if s1.isnull().all():
@@ -54,6 +143,96 @@ class MyTestCase(unittest.TestCase):
         end = time.time()
         print(f'Time elapsed for method test: {end - start}s')
 
+    def test_batched_queries(self):
+        names = [f'Match {i}' for i in range(30)] + [f'Null {i}' for i in range(5)] + [f'None {i}' for i in
+                                                                                         range(10)]
+        test_df = pd.DataFrame({'Name': names + names[:5], 'Other': range(len(names) + 5)})
+        with _StandInReconciliation(unavailable=2) as server, mock.patch.multiple(
+                find_OpenRefine_matches, _openrefine_ipni_service_url=server.url, _openrefine_retry_wait=0):
+            s = openrefine_match_full_names(test_df, 'Name', batch_size=8, max_workers=3)
+        self.assertEqual(len(server.requests), 6 + 2)
+
+        expected_rows = []
+        for i, name in enumerate(names):
+            if name.startswith('Match'):
+                expected_rows.append([name, i, name, name + '-1', name, 100.0])
+                expected_rows.append([name, i, name, name + '-2', name + ' var. b', 50.5])
+            else:
+                expected_rows.append([name, i, name, np.nan, np.nan, np.nan])
+        expected = pd.DataFrame(expected_rows, columns=['Name', 'Other', reco_submitted_name_col_id, 'reco_id',
+                                                        'reco_name', 'reco_score'])
+        pd.testing.assert_frame_equal(s.reset_index(drop=True), expected, check_dtype=False)
+        self.assertEqual(s.attrs[openrefine_failed_names_attr], [])
+
+    def test_failed_batches(self):
+        # Names in batches which fail are left unmatched, listed as failed and not stored
+        names = [f'Match {i}' for i in range(6)] + ['Match failing']
+        test_df = pd.DataFrame({'Name': names})
+        with _StandInReconciliation(failing_names=['Match failing']) as server, mock.patch.multiple(
+                find_OpenRefine_matches, _openrefine_ipni_service_url=server.url, _openrefine_retry_wait=0):
+            s = openrefine_match_full_names(test_df, 'Name', batch_size=4)
+            self.assertEqual(s.attrs[openrefine_failed_names_attr], names[4:])
+            self.assertEqual(s['reco_id'].notna().sum(), 8)
+            self.assertTrue(s[s['Name'].isin(names[4:])]['reco_id'].isna().all())
+            server.failing_names = []
+            retried = openrefine_match_full_names(test_df, 'Name', batch_size=4)
+            self.assertEqual(json.loads(server.requests[-1]['queries'][0]),
+                             {f'q{i}': {'query': n} for i, n in enumerate(names[4:])})
+        self.assertEqual(retried.attrs[openrefine_failed_names_attr], [])
+        self.assertEqual(retried['reco_id'].notna().sum(), 14)
+
+    def test_omitted_queries(self):
+        # Names missing from a response are treated as failed rather than stored as having no results
+        names = ['Match 1', 'Match omitted', 'Null 1', 'None omitted']
+        test_df = pd.DataFrame({'Name': names})
+        with _StandInReconciliation(omitted_names=['Match omitted', 'None omitted']) as server, \
+                mock.patch.object(find_OpenRefine_matches, '_openrefine_ipni_service_url', server.url):
+            s = openrefine_match_full_names(test_df, 'Name')
+            self.assertEqual(s.attrs[openrefine_failed_names_attr], ['Match omitted', 'None omitted'])
+            self.assertEqual(s[s['Name'] == 'Match 1']['reco_id'].tolist(), ['Match 1-1', 'Match 1-2'])
+            server.omitted_names = []
+            retried = openrefine_match_full_names(test_df, 'Name')
+            self.assertEqual(json.loads(server.requests[-1]['queries'][0]),
+                             {'q0': {'query': 'Match omitted'}, 'q1': {'query': 'None omitted'}})
+        self.assertEqual(retried.attrs[openrefine_failed_names_attr], [])
+        self.assertEqual(retried[retried['Name'] == 'Match omitted']['reco_id'].tolist(),
+                         ['Match omitted-1', 'Match omitted-2'])
+
+        # A response without any of its queries fails the batch
+        with _StandInReconciliation(omitted_names=['Match new']) as server, mock.patch.multiple(
+                find_OpenRefine_matches, _openrefine_ipni_service_url=server.url, _openrefine_retry_wait=0):
+            self.assertRaises(ConnectionError, openrefine_match_full_names, pd.DataFrame({'Name': ['Match new']}),
+                              'Name')
+
+    def test_stored_results(self):
+        names = [f'Match {i}' for i in range(6)] + ['Null 1', 'None 1']
+        test_df = pd.DataFrame({'Name': names})
+        with _StandInReconciliation() as server, mock.patch.object(find_OpenRefine_matches,
+                                                                   '_openrefine_ipni_service_url', server.url):
+            s = openrefine_match_full_names(test_df, 'Name', batch_size=4)
+            self.assertEqual(len(server.requests), 2)
+            # Stored names aren't sent again, including differently spaced versions of them
+            stored = openrefine_match_full_names(test_df, 'Name')
+            self.assertEqual(len(server.requests), 2)
+            pd.testing.assert_frame_equal(stored, s)
+            spaced = openrefine_match_full_names(pd.DataFrame({'Name': [' Match  0 ']}), 'Name')
+            self.assertEqual(len(server.requests), 2)
+            self.assertEqual(spaced['reco_id'].tolist(), ['Match 0-1', 'Match 0-2'])
+            # Expired results are reconciled again
+            openrefine_match_full_names(test_df.head(3), 'Name', cache_ttl=-1)
+            self.assertEqual(len(server.requests), 3)
+            self.assertEqual(len(json.loads(server.requests[-1]['queries'][0])), 3)
+
+        # Offline, only stored results are used
+        new_df = pd.DataFrame({'Name': ['Match 1', 'Match new']})
+        offline = openrefine_match_full_names(new_df, 'Name', offline=True)
+        self.assertEqual(offline['reco_id'].tolist()[:2], ['Match 1-1', 'Match 1-2'])
+        self.assertTrue(pd.isna(offline['reco_id'].iloc[2]))
+        self.assertEqual(offline.attrs[openrefine_failed_names_attr], ['Match new'])
+
+        clear_stored_openrefine_matches()
+        self.assertEqual(os.listdir(find_OpenRefine_matches.openrefine_outputs_dir), [])
+
     def test_examples(self):
         self._test_get_names_on_csv('simple_examples', 'Name')
 
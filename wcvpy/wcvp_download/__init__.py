@@ -1,3 +1,34 @@
+import importlib as _importlib
+
 from .get_taxa_from_wcvp import *
-from .get_distributions_from_wcvp import *
-from .plot_distributions import *
\ No newline at end of file
+
+# Modules that aren't needed to load the checklist are only imported when one of their names is first used, to keep
+# importing the package fast
+_lazy_names = {name: '.get_distributions_from_wcvp' for name in
+               ['native_code_column', 'introduced_code_column', 'get_distributions_for_accepted_taxa',
+                'add_distribution_list_to_wcvp']}
+_lazy_names.update({name: '.plot_distributions' for name in
+                    ['get_region_distribution_dataframe_for_accepted_taxa',
+                     'get_native_region_distribution_dataframe_for_accepted_taxa',
+                     'plot_number_accepted_taxa_in_regions', 'plot_native_number_accepted_taxa_in_regions']})
+_lazy_names['download_zip'] = '.zip_download'
+
+
+def __getattr__(name):
+    if name in _lazy_names:
+        value = getattr(_importlib.import_module(_lazy_names[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_names))
+
+
+# The names imported by `from ... import *`. The lazily imported names are left out, so that star imports don't
+# import their modules
+__all__ = ['add_accepted_info_to_rows', 'add_authors_to_col', 'checklist_registry', 'clean_whitespaces_in_names',
+           'clear_parsed_checklist_cache', 'filter_families_from_df', 'get_all_taxa',
+           'get_parent_names_and_ipni_ids', 'get_species_names_and_ipni_ids', 'get_wcvp_zip', 'hybrid_characters',
+           'infraspecific_chars', 'wcvp_accepted_columns', 'wcvp_columns', 'wcvp_columns_used_in_direct_matching']
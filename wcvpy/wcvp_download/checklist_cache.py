@@ -0,0 +1,146 @@
+import hashlib
+import os
+from typing import List
+
+import pandas as pd
+
+_parsed_checklist_tag = '_parsed_'
+_parsed_checklist_extension = '.pkl.zst'
+_match_index_tag = '_match_index'
+_phonetic_index_tag = '_phonetic_index'
+# Key in DataFrame.attrs of checklists loaded from the cache, and frames derived from them, giving the cache path and
+# the number of taxa in the cached checklist
+checklist_cache_attr = 'wcvp_checklist_cache'
+
+
+def _parsed_checklist_prefix(zip_path: str, clean_strings: bool, statuses_to_drop: List[str]) -> str:
+    """
+    Path prefix shared by all cached parses of the given zip with the given parsing options.
+    :param zip_path:
+    :param clean_strings:
+    :param statuses_to_drop:
+    :return:
+    """
+    settings = str((bool(clean_strings), sorted(statuses_to_drop))).encode()
+    settings_hash = hashlib.md5(settings).hexdigest()[:10]
+    zip_stem = os.path.splitext(os.path.basename(zip_path))[0]
+    return os.path.join(os.path.dirname(zip_path), zip_stem + _parsed_checklist_tag + settings_hash + '_')
+
+
+def parsed_checklist_cache_path(zip_path: str, clean_strings: bool, statuses_to_drop: List[str]) -> str:
+    """
+    Location of the cached parsed checklist for the given zip and parsing options.
+    The modification time of the zip is part of the file name, so replacing the zip invalidates the cache.
+    :param zip_path:
+    :param clean_strings:
+    :param statuses_to_drop:
+    :return:
+    """
+    zip_mtime = os.stat(zip_path).st_mtime_ns
+    return _parsed_checklist_prefix(zip_path, clean_strings, statuses_to_drop) + str(
+        zip_mtime) + _parsed_checklist_extension
+
+
+def match_index_cache_path(cache_path: str) -> str:
+    """
+    Location of the cached name matching index built from the parsed checklist cached at cache_path.
+    :param cache_path:
+    :return:
+    """
+    return cache_path[:-len(_parsed_checklist_extension)] + _match_index_tag + _parsed_checklist_extension
+
+
+def phonetic_index_cache_path(cache_path: str) -> str:
+    """
+    Location of the cached phonetic index built from the parsed checklist cached at cache_path.
+    :param cache_path:
+    :return:
+    """
+    return cache_path[:-len(_parsed_checklist_extension)] + _phonetic_index_tag + _parsed_checklist_extension
+
+
+def _remove_stale_parsed_checklists(cache_path: str):
+    prefix = cache_path[:cache_path.rindex('_') + 1]
+    current = cache_path[:-len(_parsed_checklist_extension)]
+    cache_dir = os.path.dirname(cache_path)
+    for f in os.listdir(cache_dir):
+        stale_path = os.path.join(cache_dir, f)
+        # Stale caches and their lock files, but not the files of the current cache which may be in use
+        if stale_path.startswith(prefix) and not stale_path.startswith(current):
+            try:
+                os.remove(stale_path)
+            except FileNotFoundError:
+                pass
+
+
+def read_parsed_checklist(cache_path: str) -> pd.DataFrame:
+    """
+    Loads a cached parsed checklist, returns None if it doesn't exist or can't be read.
+    :param cache_path:
+    :return:
+    """
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        return pd.read_pickle(cache_path, compression='zstd')
+    except Exception as e:
+        print(f'WARNING: Could not read cached checklist ({e}), reparsing: {cache_path}')
+        return None
+
+
+def _write_cache_file(obj, cache_path: str) -> bool:
+    # Written to a temporary path first so that readers never see a partially written file
+    temp_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        pd.to_pickle(obj, temp_path, compression='zstd')
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        print(f'WARNING: Could not write cache file ({e}): {cache_path}')
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    return True
+
+
+def write_parsed_checklist(df: pd.DataFrame, cache_path: str):
+    """
+    Writes the parsed checklist to the cache and removes caches made from older versions of the same zip.
+    The file is written to a temporary path first so that readers never see a partially written cache.
+    :param df:
+    :param cache_path:
+    :return:
+    """
+    if _write_cache_file(df, cache_path):
+        _remove_stale_parsed_checklists(cache_path)
+
+
+def read_match_index(index_path: str):
+    """
+    Loads a cached name matching index, returns None if it doesn't exist or can't be read.
+    :param index_path:
+    :return:
+    """
+    if not os.path.exists(index_path):
+        return None
+    try:
+        return pd.read_pickle(index_path, compression='zstd')
+    except Exception as e:
+        print(f'WARNING: Could not read cached match index ({e}), rebuilding: {index_path}')
+        return None
+
+
+def write_match_index(match_index, index_path: str):
+    _write_cache_file(match_index, index_path)
+
+
+def clear_cached_checklists(cache_dir: str):
+    """
+    Removes all cached parsed checklists in the given directory.
+    :param cache_dir:
+    :return:
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    for f in os.listdir(cache_dir):
+        if _parsed_checklist_tag in f and f.endswith(_parsed_checklist_extension):
+            os.remove(os.path.join(cache_dir, f))
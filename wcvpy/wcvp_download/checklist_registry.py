@@ -0,0 +1,88 @@
+from typing import List, Tuple
+
+import pandas as pd
+
+from wcvpy.wcvp_download.checklist_cache import checklist_cache_attr
+
+
+class ChecklistRegistry:
+    """
+    Keeps parsed checklists resident in memory so that repeated calls to get_all_taxa within one process
+    don't reload them. Checklists are keyed by version, clean_strings, statuses_to_drop and whether they are compact.
+
+    Frames handed out by the registry share memory with the resident checklist and shouldn't be modified in place.
+
+    Indexes built for name matching are also kept here, by the cache path of the checklist they were built from, so
+    that they are freed along with the checklist.
+    """
+
+    def __init__(self):
+        self._checklists = {}
+        self._indexes = {}
+
+    @staticmethod
+    def _cache_path(parsed_checklist: pd.DataFrame) -> str:
+        return parsed_checklist.attrs.get(checklist_cache_attr, (None, None))[0]
+
+    def _remove_unused_indexes(self):
+        # Indexes of checklists which are no longer resident
+        resident_paths = {self._cache_path(c) for c in self._checklists.values()}
+        for cache_path in [p for p in self._indexes if p not in resident_paths]:
+            del self._indexes[cache_path]
+
+    @staticmethod
+    def key(version: str, clean_strings: bool, statuses_to_drop: List[str], compact: bool = False) -> Tuple:
+        return version, bool(clean_strings), tuple(sorted(statuses_to_drop)), bool(compact)
+
+    def lookup(self, key: Tuple) -> pd.DataFrame:
+        """
+        Returns the resident checklist for the key, or None if it hasn't been loaded.
+        :param key:
+        :return:
+        """
+        return self._checklists.get(key)
+
+    def register(self, key: Tuple, parsed_checklist: pd.DataFrame):
+        replaced = key in self._checklists
+        self._checklists[key] = parsed_checklist
+        if replaced:
+            self._remove_unused_indexes()
+
+    def lookup_index(self, cache_path: str, index_key) -> object:
+        """
+        Returns the index stored for the cached checklist at cache_path under index_key, or None.
+        :param cache_path:
+        :param index_key:
+        :return:
+        """
+        return self._indexes.get(cache_path, {}).get(index_key)
+
+    def register_index(self, cache_path: str, index_key, index: object):
+        self._indexes.setdefault(cache_path, {})[index_key] = index
+
+    def evict(self, version: str = None):
+        """
+        Removes all resident checklists of the given version. None refers to the latest downloaded version.
+        :param version:
+        :return:
+        """
+        for key in [k for k in self._checklists if k[0] == version]:
+            del self._checklists[key]
+        self._remove_unused_indexes()
+
+    def clear(self):
+        """
+        Removes all resident checklists and indexes.
+        :return:
+        """
+        self._checklists.clear()
+        self._indexes.clear()
+
+    def versions(self) -> List[str]:
+        return list(dict.fromkeys(k[0] for k in self._checklists))
+
+    def __len__(self):
+        return len(self._checklists)
+
+
+checklist_registry = ChecklistRegistry()
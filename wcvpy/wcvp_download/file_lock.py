@@ -0,0 +1,69 @@
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+def _try_lock(f) -> bool:
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except (BlockingIOError, PermissionError):
+        return False
+
+
+def _lock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        while True:
+            # LK_LOCK gives up after 10 seconds
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+
+
+def _unlock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """
+    Advisory lock, held by one process (or thread) at a time, for work on the given file such as downloading or
+    building it. Waits until the lock is available. Work done under the lock should check whether another process has
+    already done it while waiting.
+
+    If the file system doesn't support locking, continues without the lock.
+    :param path: The file the lock is for. The lock itself is held on path + '.lock'
+    :return:
+    """
+    lock_path = path + '.lock'
+    with open(lock_path, 'a+') as f:
+        try:
+            if not _try_lock(f):
+                print(f'Waiting for another process using: {path}')
+                _lock(f)
+        except OSError as e:
+            print(f'WARNING: Could not lock ({e}), continuing without lock: {lock_path}')
+            yield
+            return
+        try:
+            yield
+        finally:
+            _unlock(f)
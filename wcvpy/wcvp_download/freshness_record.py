@@ -0,0 +1,56 @@
+import datetime
+import json
+import os
+import time
+
+_freshness_record_file = 'freshness.json'
+
+
+def _freshness_record_path(zip_path: str) -> str:
+    return os.path.join(os.path.dirname(zip_path), _freshness_record_file)
+
+
+def _read_freshness_records(record_path: str) -> dict:
+    try:
+        with open(record_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def read_recent_last_modified(zip_path: str, ttl: float) -> datetime.datetime:
+    """
+    Returns the Last-Modified date of the online version of the zip if it was checked within the last ttl seconds,
+    otherwise None. Checks made before the zip was last replaced are ignored.
+    :param zip_path:
+    :param ttl: seconds
+    :return:
+    """
+    record = _read_freshness_records(_freshness_record_path(zip_path)).get(os.path.basename(zip_path))
+    if record is None or not os.path.exists(zip_path):
+        return None
+    if time.time() - record['checked'] >= ttl or record['zip_mtime_ns'] != os.stat(zip_path).st_mtime_ns:
+        return None
+    return datetime.datetime.fromisoformat(record['last_modified'])
+
+
+def write_last_modified(zip_path: str, last_modified: datetime.datetime):
+    """
+    Records the Last-Modified date of the online version of the zip, as checked now.
+    :param zip_path:
+    :param last_modified:
+    :return:
+    """
+    record_path = _freshness_record_path(zip_path)
+    records = _read_freshness_records(record_path)
+    records[os.path.basename(zip_path)] = {'checked': time.time(), 'last_modified': last_modified.isoformat(),
+                                           'zip_mtime_ns': os.stat(zip_path).st_mtime_ns}
+    temp_path = record_path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(records, f)
+        os.replace(temp_path, record_path)
+    except OSError as e:
+        print(f'WARNING: Could not write freshness record ({e}): {record_path}')
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
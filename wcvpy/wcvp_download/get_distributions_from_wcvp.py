@@ -2,7 +2,7 @@ import time
 
 import pandas as pd
 
-from wcvpy.wcvp_download import get_wcvp_zip, get_all_taxa, wcvp_columns, wcvp_accepted_columns
+from wcvpy.wcvp_download import get_wcvp_zip, get_all_taxa, wcvp_columns, wcvp_accepted_columns, is_compact_checklist
 
 native_code_column = 'native_tdwg3_codes'
 introduced_code_column = 'intro_tdwg3_codes'
@@ -11,7 +11,8 @@ _statuses_that_have_dists = ['Accepted', 'Artificial Hybrid']
 
 
 def get_distributions_for_accepted_taxa(df: pd.DataFrame, acc_name_col: str, include_doubtful: bool = False,
-                                        include_extinct: bool = False, wcvp_version: str = None):
+                                        include_extinct: bool = False, wcvp_version: str = None,
+                                        compact: bool = False):
     """
     Get distributions for accepted taxa.
 
@@ -20,10 +21,12 @@ def get_distributions_for_accepted_taxa(df: pd.DataFrame, acc_name_col: str, inc
     :param include_doubtful: A boolean value indicating whether to include doubtful taxa. Default is False.
     :param include_extinct: A boolean value indicating whether to include extinct taxa. Default is False.
     :param wcvp_version: The version of WCVP to use for getting distribution data. Default is None.
+    :param compact: Whether to use the compact representation of the checklist (see compact_checklist). Default is False.
     :return: A pandas DataFrame containing the merged data with distributions for accepted taxa.
     """
     start = time.time()
-    wcvp_with_dists = add_distribution_list_to_wcvp(include_doubtful, include_extinct, wcvp_version=wcvp_version)
+    wcvp_with_dists = add_distribution_list_to_wcvp(include_doubtful, include_extinct, wcvp_version=wcvp_version,
+                                                    compact=compact)
     wcvp_with_dists = wcvp_with_dists[wcvp_with_dists[wcvp_columns['status']].isin(_statuses_that_have_dists)]
     wcvp_with_dists = wcvp_with_dists.dropna(subset=wcvp_accepted_columns['name'])
     wcvp_with_dists = wcvp_with_dists[
@@ -51,15 +54,16 @@ def _sorted_tuple(iterable):
 
 
 def add_distribution_list_to_wcvp(include_doubtful: bool = False,
-                                  include_extinct: bool = False, wcvp_version: str = None):
+                                  include_extinct: bool = False, wcvp_version: str = None, compact: bool = False):
     """
     Gets a copy of WCVP with distribution data for all taxa
     :param include_doubtful:
     :param include_extinct:
+    :param compact:
     :return:
     """
     # Only use accepted taxa for distributions as everything else is unreliable
-    all_wcvp = get_all_taxa(version=wcvp_version)
+    all_wcvp = get_all_taxa(version=wcvp_version, compact=compact)
     accepted_wcvp_data = all_wcvp[all_wcvp[wcvp_columns['status']].isin(_statuses_that_have_dists)]
     zip_filetime, wcvp_zip = get_wcvp_zip(version=wcvp_version)
 
@@ -69,6 +73,12 @@ def add_distribution_list_to_wcvp(include_doubtful: bool = False,
                                        'plant_locality_id': object})
     all_dist_data = all_dist_data.dropna(subset=['area_code_l3'])
     csv_file.close()
+    if is_compact_checklist(all_wcvp):
+        # Match the integer ids of the compact checklist
+        id_dtype = all_wcvp[wcvp_columns['wcvp_id']].dtype
+        if not isinstance(id_dtype, pd.CategoricalDtype):
+            all_dist_data[wcvp_columns['wcvp_id']] = pd.to_numeric(all_dist_data[wcvp_columns['wcvp_id']]).astype(
+                id_dtype)
 
     merged = pd.merge(accepted_wcvp_data, all_dist_data, on='plant_name_id', how='left')
     if include_doubtful and include_extinct:
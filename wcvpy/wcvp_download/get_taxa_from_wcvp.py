@@ -2,15 +2,20 @@ import datetime
 import os
 import time
 import zipfile
-from typing import List
+from typing import List, Tuple
 
 import numpy as np
 import pandas as pd
-import requests
-from dateutil.parser import parse as parsedate
 
 from pathlib import Path
 
+from wcvpy.wcvp_download.checklist_cache import parsed_checklist_cache_path, read_parsed_checklist, \
+    write_parsed_checklist, clear_cached_checklists, checklist_cache_attr
+from wcvpy.wcvp_download.checklist_registry import checklist_registry
+from wcvpy.wcvp_download.file_lock import file_lock
+from wcvpy.wcvp_download.freshness_record import read_recent_last_modified, write_last_modified
+from wcvpy.wcvp_download.joined_strings import apply_to_unique_strings, join_words_in_joined_strings
+
 _wcvp_downloads_path = os.path.join(Path.home(), '.wcvp_downloads')
 
 wcvp_columns = {'family': 'family',
@@ -74,32 +79,61 @@ def clean_whitespaces_in_names(given_str: str):
         return given_str
 
 
+def _clean_whitespaces_in_joined_strings(joined: str) -> str:
+    return join_words_in_joined_strings(joined).replace('. )', '.)').replace(' )', ')')
+
+
+def clean_whitespaces_in_column(column: pd.Series) -> pd.Series:
+    """
+    Column version of clean_whitespaces_in_names, giving the same output as column.apply(clean_whitespaces_in_names).
+    :param column:
+    :return:
+    """
+    return apply_to_unique_strings(column, _clean_whitespaces_in_joined_strings, clean_whitespaces_in_names)
+
+
 def add_authors_to_col(wcvp_df: pd.DataFrame, col: str):
     return wcvp_df[col].str.cat(
         wcvp_df[wcvp_columns['authors']].fillna(''),
         sep=' ').str.strip()
 
 
-def add_accepted_info_to_rows(taxa_df: pd.DataFrame, all_accepted: pd.DataFrame) -> pd.DataFrame:
-    all_accepted = all_accepted.assign(accepted_ipni_id=all_accepted[wcvp_columns['ipni_id']])
-    all_accepted = all_accepted.assign(accepted_name=all_accepted[wcvp_columns['name']])
-    all_accepted = all_accepted.assign(accepted_family=all_accepted[wcvp_columns['family']])
-    all_accepted = all_accepted.assign(accepted_rank=all_accepted[wcvp_columns['rank']])
-    all_accepted = all_accepted.assign(accepted_parent=all_accepted[wcvp_columns['parent_name']])
-    all_accepted = all_accepted.assign(accepted_parent_w_author=all_accepted['parent_name_w_author'])
-    all_accepted = all_accepted.assign(accepted_parent_ipni_id=all_accepted[wcvp_columns['parent_ipni_id']])
-    all_accepted = all_accepted.assign(accepted_parent_id=all_accepted[wcvp_columns['parent_plant_name_id']])
-    all_accepted = all_accepted.assign(accepted_parent_rank=all_accepted['parent_rank'])
-
-    all_accepted['accepted_name_w_author'] = add_authors_to_col(all_accepted, wcvp_columns['name'])
-
-    all_accepted = all_accepted.rename(columns={wcvp_columns['wcvp_id']: 'plant_name_id_acc'})
-    all_accepted = all_accepted[
-        ['plant_name_id_acc', 'accepted_ipni_id', 'accepted_name', 'accepted_name_w_author',
-         'accepted_family', 'accepted_rank',
-         'accepted_parent', 'accepted_parent_w_author', 'accepted_parent_id', 'accepted_parent_ipni_id',
-         'accepted_parent_rank']]
-    taxa_df_with_accepted_id = pd.merge(all_accepted, taxa_df, left_on='plant_name_id_acc',
+# Source of each of the accepted_* columns added by add_accepted_info_to_rows, in the order they're added.
+# The accepted_parent_* columns come from get_parent_names_and_ipni_ids
+_accepted_info_sources = {'accepted_ipni_id': wcvp_columns['ipni_id'],
+                          'accepted_name': wcvp_columns['name'],
+                          'accepted_name_w_author': None,
+                          'accepted_family': wcvp_columns['family'],
+                          'accepted_rank': wcvp_columns['rank'],
+                          'accepted_parent': wcvp_columns['parent_name'],
+                          'accepted_parent_w_author': 'parent_name_w_author',
+                          'accepted_parent_id': wcvp_columns['parent_plant_name_id'],
+                          'accepted_parent_ipni_id': wcvp_columns['parent_ipni_id'],
+                          'accepted_parent_rank': 'parent_rank'}
+_accepted_parent_info_columns = ['accepted_parent', 'accepted_parent_w_author', 'accepted_parent_id',
+                                 'accepted_parent_ipni_id', 'accepted_parent_rank']
+
+
+def add_accepted_info_to_rows(taxa_df: pd.DataFrame, all_accepted: pd.DataFrame,
+                              accepted_info_columns: List[str] = None) -> pd.DataFrame:
+    """
+    :param taxa_df:
+    :param all_accepted:
+    :param accepted_info_columns: Only add these accepted_* columns. By default all are added, in which case
+    all_accepted must include the parent information from get_parent_names_and_ipni_ids.
+    :return:
+    """
+    if accepted_info_columns is None:
+        accepted_info_columns = list(_accepted_info_sources)
+    accepted_info = all_accepted[[wcvp_columns['wcvp_id']]].rename(
+        columns={wcvp_columns['wcvp_id']: 'plant_name_id_acc'})
+    for col in [c for c in _accepted_info_sources if c in accepted_info_columns]:
+        if col == 'accepted_name_w_author':
+            accepted_info[col] = add_authors_to_col(all_accepted, wcvp_columns['name'])
+        else:
+            accepted_info[col] = all_accepted[_accepted_info_sources[col]]
+
+    taxa_df_with_accepted_id = pd.merge(accepted_info, taxa_df, left_on='plant_name_id_acc',
                                         right_on=wcvp_columns['acc_plant_name_id'], how='right')
     taxa_df_with_accepted_id = taxa_df_with_accepted_id.drop(columns=['plant_name_id_acc'])
 
@@ -124,44 +158,110 @@ def get_parent_names_and_ipni_ids(taxa_df: pd.DataFrame, all_data: pd.DataFrame)
     return taxa_df_with_parent_info
 
 
-def get_species_names_and_ipni_ids(taxa_df: pd.DataFrame):
-    taxa_df['accepted_species'] = np.where(taxa_df['accepted_rank'] == 'Species', taxa_df['accepted_name'],
-                                           np.nan)
+# Accepted and parent columns used for each of the accepted_species* columns, in the order they're added
+_species_info_sources = {'accepted_species': ('accepted_name', 'accepted_parent'),
+                         'accepted_species_w_author': ('accepted_name_w_author', 'accepted_parent_w_author'),
+                         'accepted_species_ipni_id': (wcvp_accepted_columns['ipni_id'], 'accepted_parent_ipni_id'),
+                         'accepted_species_id': (wcvp_accepted_columns['wcvp_id'], 'accepted_parent_id')}
+
 
-    taxa_df['accepted_species_w_author'] = np.where(taxa_df['accepted_rank'] == 'Species',
-                                                    taxa_df['accepted_name_w_author'],
-                                                    np.nan)
+def get_species_names_and_ipni_ids(taxa_df: pd.DataFrame, species_info_columns: List[str] = None):
+    """
+    Adds the accepted species of each taxon, i.e. the accepted taxon if it is a species, or its parent if that is
+    a species.
+    :param taxa_df:
+    :param species_info_columns: Only add these accepted_species* columns. By default all are added.
+    :return:
+    """
+    if species_info_columns is None:
+        species_info_columns = list(_species_info_sources)
+    for col in [c for c in _species_info_sources if c in species_info_columns]:
+        accepted_col, parent_col = _species_info_sources[col]
+        taxa_df[col] = np.where(taxa_df['accepted_rank'] == 'Species', taxa_df[accepted_col], np.nan)
+        taxa_df[col] = np.where(taxa_df['accepted_parent_rank'] == 'Species', taxa_df[parent_col], taxa_df[col])
 
-    taxa_df['accepted_species'] = np.where(taxa_df['accepted_parent_rank'] == 'Species',
-                                           taxa_df['accepted_parent'],
-                                           taxa_df['accepted_species'])
+    return taxa_df
 
-    taxa_df['accepted_species_w_author'] = np.where(taxa_df['accepted_parent_rank'] == 'Species',
-                                                    taxa_df['accepted_parent_w_author'],
-                                                    taxa_df['accepted_species_w_author'])
 
-    # IPNI ids
-    taxa_df['accepted_species_ipni_id'] = np.where(taxa_df['accepted_rank'] == 'Species',
-                                                   taxa_df[wcvp_accepted_columns['ipni_id']],
-                                                   np.nan)
-    taxa_df['accepted_species_ipni_id'] = np.where(taxa_df['accepted_parent_rank'] == 'Species',
-                                                   taxa_df['accepted_parent_ipni_id'],
-                                                   taxa_df['accepted_species_ipni_id'])
+# Plant name id columns, stored as nullable integers in compact checklists
+wcvp_id_columns = [wcvp_columns['wcvp_id'], wcvp_columns['acc_plant_name_id'], wcvp_columns['parent_plant_name_id'],
+                   'basionym_plant_name_id', 'accepted_parent_id', wcvp_accepted_columns['species_wcvp_id']]
+# Low cardinality columns, stored as categoricals in compact checklists along with the accepted_* columns
+wcvp_categorical_columns = [wcvp_columns['family'], wcvp_columns['genus'], wcvp_columns['rank'],
+                            wcvp_columns['status'], wcvp_columns['lifeform'], 'climate_description']
 
-    # WCVP ids
-    taxa_df['accepted_species_id'] = np.where(taxa_df['accepted_rank'] == 'Species',
-                                              taxa_df[wcvp_accepted_columns['wcvp_id']],
-                                              np.nan)
-    taxa_df['accepted_species_id'] = np.where(taxa_df['accepted_parent_rank'] == 'Species',
-                                              taxa_df['accepted_parent_id'],
-                                              taxa_df['accepted_species_id'])
 
-    return taxa_df
+def _compact_id_column(column: pd.Series) -> pd.Series:
+    try:
+        numeric_ids = pd.to_numeric(column)
+    except (ValueError, TypeError):
+        # Not all ids are integers
+        return column.astype('category')
+    if numeric_ids.abs().max() >= 2 ** 31:
+        return numeric_ids.astype('Int64')
+    return numeric_ids.astype('Int32')
+
+
+def compact_checklist(wcvp_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns the parsed checklist with a smaller memory footprint. Low cardinality columns and the accepted_* columns
+    are stored as categoricals and plant name ids as nullable integers.
+    :param wcvp_data: output of get_all_taxa
+    :return:
+    """
+    compact_data = wcvp_data.copy(deep=False)
+    for col in compact_data.columns:
+        if col in wcvp_id_columns:
+            compact_data[col] = _compact_id_column(compact_data[col])
+        elif col in wcvp_categorical_columns or col.startswith('accepted_'):
+            compact_data[col] = compact_data[col].astype('category')
+    return compact_data
+
+
+def is_compact_checklist(wcvp_data: pd.DataFrame) -> bool:
+    return isinstance(wcvp_data[wcvp_columns['status']].dtype, pd.CategoricalDtype)
+
+
+# Set to e.g. 1 or true to never access the network, in which case a downloaded zip must already be available
+_offline_environment_variable = 'WCVPY_OFFLINE'
+# Seconds between checks for a newer online version of the checklist
+_freshness_ttl_environment_variable = 'WCVPY_FRESHNESS_TTL'
+_default_freshness_ttl = 24 * 60 * 60
+
 
+def _offline_mode(offline: bool = None) -> bool:
+    if offline is not None:
+        return offline
+    return os.environ.get(_offline_environment_variable, '').strip().lower() in ['1', 'true', 'yes', 'on']
 
-def get_wcvp_zip(get_new_version: bool = False, version: str = None):
+
+def _freshness_ttl(freshness_ttl: float = None) -> float:
+    if freshness_ttl is not None:
+        return freshness_ttl
+    env_ttl = os.environ.get(_freshness_ttl_environment_variable)
+    if env_ttl:
+        try:
+            return float(env_ttl)
+        except ValueError:
+            print(f'WARNING: Ignoring invalid {_freshness_ttl_environment_variable}: {env_ttl}')
+    return _default_freshness_ttl
+
+
+def get_wcvp_zip(get_new_version: bool = False, version: str = None, offline: bool = None,
+                 freshness_ttl: float = None):
+    """
+    :param get_new_version:
+    :param version:
+    :param offline: If TRUE, never access the network and use the already downloaded zip. Defaults to the
+    WCVPY_OFFLINE environment variable.
+    :param freshness_ttl: Seconds for which a check for a newer online version is reused. Defaults to the
+    WCVPY_FRESHNESS_TTL environment variable, or one day. Use 0 to check on every call.
+    :return:
+    """
     if get_new_version and version:
         raise ValueError('Cannot specify both get_new_version and version')
+    offline = _offline_mode(offline)
+    freshness_ttl = _freshness_ttl(freshness_ttl)
     base_wcvp_path = 'https://sftp.kew.org/pub/data-repositories/WCVP'
     if version:
         wcvp_file_name = 'wcvp_v' + version + '.zip'
@@ -174,26 +274,31 @@ def get_wcvp_zip(get_new_version: bool = False, version: str = None):
 
     input_zip_file = os.path.join(_wcvp_downloads_path, wcvp_file_name)
 
-    if not os.path.exists(_wcvp_downloads_path):
-        os.mkdir(_wcvp_downloads_path)
+    os.makedirs(_wcvp_downloads_path, exist_ok=True)
 
+    # Network clients are only imported when needed, to keep importing the package fast
     def download_newest():
+        from wcvpy.wcvp_download.zip_download import download_zip
         if version is None:
             print('Downloading latest WCVP version...')
         else:
             print('Downloading WCVP version:' + version)
         print(f'to: {input_zip_file}')
-        r = requests.get(wcvp_link, stream=True)
-        with open(input_zip_file, 'wb') as fd:
-            for chunk in r.iter_content(chunk_size=128):
-                fd.write(chunk)
+        download_zip(wcvp_link, input_zip_file)
 
-    def check_file_is_newer_than_online_version():
+    def check_file_is_newer_than_online_version(use_freshness_record: bool = True):
+        import requests
+        from dateutil.parser import parse as parsedate
         try:
-            r = requests.head(wcvp_link, timeout=10)
-            url_time = r.headers['last-modified']
-            url_date = parsedate(url_time).astimezone()
             file_time = datetime.datetime.fromtimestamp(os.path.getmtime(input_zip_file)).astimezone()
+            url_date = None
+            if use_freshness_record:
+                url_date = read_recent_last_modified(input_zip_file, freshness_ttl)
+            if url_date is None:
+                r = requests.head(wcvp_link, timeout=10)
+                url_time = r.headers['last-modified']
+                url_date = parsedate(url_time).astimezone()
+                write_last_modified(input_zip_file, url_date)
             if url_date < file_time:
                 print('Using up to date WCVP.')
             return url_date, file_time
@@ -203,31 +308,40 @@ def get_wcvp_zip(get_new_version: bool = False, version: str = None):
 
     print(f'Loading WCVP locally if exists...')
     print(f'from: {input_zip_file}')
-    if get_new_version:
-
-        print(f'The latest file will be downloaded if not already available at {input_zip_file}')
-        # Download if doesn't exist
-        if not os.path.exists(input_zip_file):
-            download_newest()
-
-        else:
-            # Download if online version is newer
-            url_date, file_time = check_file_is_newer_than_online_version()
-            if url_date > file_time:
+    # Only one process downloads or updates the zip at a time. Others wait and then find it already available
+    with file_lock(input_zip_file):
+        if offline:
+            if not os.path.exists(input_zip_file):
+                raise FileNotFoundError(
+                    f'WCVP not downloaded and running offline ({_offline_environment_variable}), '
+                    f'rerun with a connection to download it: {input_zip_file}')
+            if get_new_version:
+                print('WARNING: Running offline, will not check for an updated version')
+        elif get_new_version:
+
+            print(f'The latest file will be downloaded if not already available at {input_zip_file}')
+            # Download if doesn't exist
+            if not os.path.exists(input_zip_file):
                 download_newest()
 
-    elif not os.path.exists(input_zip_file):
-        download_newest()
-    else:
-        if version:
-            print('Using WCVP version:' + version)
+            else:
+                # Download if online version is newer
+                url_date, file_time = check_file_is_newer_than_online_version(use_freshness_record=False)
+                if url_date > file_time:
+                    download_newest()
+
+        elif not os.path.exists(input_zip_file):
+            download_newest()
         else:
-            url_date, file_time = check_file_is_newer_than_online_version()
-            if url_date > file_time:
-                print(
-                    f'WARNING: Loading your existing version of WCVP which is out of date. Downloaded at: {file_time}')
-                print(f'A new checklist version was released at: {url_date}')
-                print('To up date the WCVP version, run get_all_taxa(get_new_version=True)')
+            if version:
+                print('Using WCVP version:' + version)
+            else:
+                url_date, file_time = check_file_is_newer_than_online_version()
+                if url_date > file_time:
+                    print(
+                        f'WARNING: Loading your existing version of WCVP which is out of date. Downloaded at: {file_time}')
+                    print(f'A new checklist version was released at: {url_date}')
+                    print('To up date the WCVP version, run get_all_taxa(get_new_version=True)')
 
     file_time = datetime.datetime.fromtimestamp(os.path.getmtime(input_zip_file)).astimezone()
     try:
@@ -246,101 +360,439 @@ def filter_families_from_df(df: pd.DataFrame, families_of_interest: List[str] =
                 df[wcvp_accepted_columns['family']].isin(families_of_interest))]
     return df
 
-def get_all_taxa(families_of_interest: List[str] = None, ranks: List[str] = None, genera: List[str] = None,
-                 species: List[str] = None,
-                 specific_taxa: List[str] = None,
-                 accepted: bool = False, statuses_to_drop=None, output_csv: str = None,
-                 get_new_version: bool = False, version: str = None,
-                 clean_strings: bool = True) -> pd.DataFrame:
-    '''
+_accepted_statuses = ['Accepted', 'Artificial Hybrid']
 
-    :param families_of_interest: Restrict taxa to those in given families. Will also include synonyms whose accepted taxon is in given families
-    :param ranks: Restrict taxa to those in given ranks. Will also include synonyms whose accepted taxon is in given rank
-    :param genera: Return taxa with a particular species epithet.
-    :param species: Return taxa with a particular species epithet.
-    :param specific_taxa: Return taxa with a particular taxon name.
-    :param accepted: If TRUE, only return accepted taxa.
-    :param statuses_to_drop:
-    :param output_csv:
-    :param get_new_version:
-    :param version:
-    :param clean_strings:
-    :return:
-    '''
-    start = time.time()
+# Source columns used by each of the filters in get_all_taxa
+_filter_source_columns = {'families_of_interest': wcvp_columns['family'], 'ranks': wcvp_columns['rank'],
+                          'genera': wcvp_columns['genus'], 'species': 'species',
+                          'specific_taxa': wcvp_columns['name'], 'accepted': wcvp_columns['status']}
+_pushdown_chunksize = 200000
 
-    if output_csv is not None:
-        new_output_dir = os.path.dirname(output_csv)
-        if not os.path.isdir(new_output_dir) and new_output_dir != '':
-            os.mkdir(new_output_dir)
 
-    filetime, zf = get_wcvp_zip(get_new_version=get_new_version, version=version)
-    csv_file = zf.open('wcvp_names.csv')
+def _wcvp_names_csv_columns(wcvp_zip: zipfile.ZipFile) -> List[str]:
+    csv_file = wcvp_zip.open('wcvp_names.csv')
+    header = pd.read_csv(csv_file, encoding='utf-8', sep='|', quotechar='"', quoting=3, nrows=0)
+    csv_file.close()
+    return list(header.columns)
+
+
+def _validate_requested_columns(columns: List[str], available_columns: List[str]):
+    for c in columns:
+        if c not in available_columns:
+            raise ValueError(f'Given column: {c} not in WCVP. Available columns: {list(available_columns)}')
+
+
+def _columns_to_derive(columns: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    The accepted_* and accepted_species* columns that need to be derived to give the requested columns.
+    :param columns:
+    :return: accepted_info_columns, species_info_columns
+    """
+    species_info_columns = [c for c in _species_info_sources if c in columns]
+    needed = set(columns)
+    if len(species_info_columns) > 0:
+        needed.update(['accepted_rank', 'accepted_parent_rank'])
+        for c in species_info_columns:
+            needed.update(_species_info_sources[c])
+    accepted_info_columns = [c for c in _accepted_info_sources if c in needed]
+    return accepted_info_columns, species_info_columns
+
+
+def _columns_needed_for_filters(columns: List[str], **filters) -> List[str]:
+    """
+    Adds the columns used by the given filters to the requested columns.
+    :param columns:
+    :return:
+    """
+    needed = list(columns)
+    for f, value in filters.items():
+        if value is not None and value is not False:
+            needed.append(_filter_source_columns[f])
+    if filters.get('families_of_interest') is not None:
+        needed.append(wcvp_accepted_columns['family'])
+    if filters.get('ranks') is not None:
+        needed.append(wcvp_accepted_columns['rank'])
+    return list(dict.fromkeys(needed))
+
+
+def _source_columns_for(columns: List[str]) -> List[str]:
+    """
+    The columns of wcvp_names.csv which need to be read to give the requested columns.
+    :param columns:
+    :return:
+    """
+    derived_columns = list(_accepted_info_sources) + list(_species_info_sources)
+    source_columns = [wcvp_columns['wcvp_id'], wcvp_columns['status'], wcvp_columns['acc_plant_name_id']]
+    source_columns += [c for c in columns if c not in derived_columns]
+
+    accepted_info_columns, species_info_columns = _columns_to_derive(columns)
+    for c in accepted_info_columns:
+        if c in _accepted_parent_info_columns:
+            # Needed by get_parent_names_and_ipni_ids
+            source_columns += [wcvp_columns['parent_plant_name_id'], wcvp_columns['name'], wcvp_columns['authors'],
+                               wcvp_columns['ipni_id'], wcvp_columns['rank']]
+        elif c == 'accepted_name_w_author':
+            source_columns += [wcvp_columns['name'], wcvp_columns['authors']]
+        else:
+            source_columns.append(_accepted_info_sources[c])
+    return list(dict.fromkeys(source_columns))
+
+
+def _read_wcvp_names_csv(wcvp_zip: zipfile.ZipFile, usecols: List[str] = None,
+                         plant_name_ids: pd.Index = None) -> pd.DataFrame:
+    """
+    Reads wcvp_names.csv from the given zip.
+    :param wcvp_zip:
+    :param usecols: Only read these columns.
+    :param plant_name_ids: Only keep rows with these ids. The file is then read in chunks so that the full checklist
+    is never held in memory, and the kept rows are labelled by their position in the file (as when reading the
+    whole file).
+    :return:
+    """
+    csv_file = wcvp_zip.open('wcvp_names.csv')
 
     reading_dtypes = {'homotypic_synonym': object, wcvp_columns['wcvp_id']: object,
                       wcvp_columns['acc_plant_name_id']: object,
                       'parent_plant_name_id': object,
                       'basionym_plant_name_id': object}
-    all_wcvp_data = pd.read_csv(csv_file, encoding='utf-8', sep='|', quotechar='"', quoting=3,
-                                dtype=reading_dtypes)
+    if usecols is not None:
+        reading_dtypes = {k: v for k, v in reading_dtypes.items() if k in usecols}
+    if plant_name_ids is None:
+        all_wcvp_data = pd.read_csv(csv_file, encoding='utf-8', sep='|', quotechar='"', quoting=3,
+                                    dtype=reading_dtypes, usecols=usecols)
+    else:
+        chunks = []
+        read_dtypes = {}
+        for chunk in pd.read_csv(csv_file, encoding='utf-8', sep='|', quotechar='"', quoting=3,
+                                 dtype=reading_dtypes, usecols=usecols, chunksize=_pushdown_chunksize):
+            for col in chunk.columns:
+                if col not in read_dtypes and chunk[col].notna().any():
+                    read_dtypes[col] = chunk[col].dtype
+            chunks.append(chunk[chunk[wcvp_columns['wcvp_id']].isin(plant_name_ids)])
+        all_wcvp_data = pd.concat(chunks)
+        # Columns which are missing in some of the selected rows may be read as floats,
+        # so keep the types as they are read in the full checklist
+        for col, dtype in read_dtypes.items():
+            if all_wcvp_data[col].dtype != dtype:
+                all_wcvp_data[col] = all_wcvp_data[col].astype(dtype)
 
     csv_file.close()
+    return all_wcvp_data
+
 
+def _parse_wcvp_names_data(all_wcvp_data: pd.DataFrame, clean_strings: bool,
+                           statuses_to_drop: List[str], columns: List[str] = None) -> pd.DataFrame:
+    """
+    Adds accepted, parent and species information to each taxon in the given rows of wcvp_names.csv.
+    Accepted taxa of the given rows and their parents must also be included in the given rows.
+    :param all_wcvp_data:
+    :param clean_strings:
+    :param statuses_to_drop:
+    :param columns: Only derive the accepted and species information needed for these columns.
+    The given rows must include the source columns from _source_columns_for.
+    :return:
+    """
     print(f'Parsing the checklist')
 
     if clean_strings:
         # Clean strings
-        for col in wcvp_columns_used_in_direct_matching:
-            all_wcvp_data[col] = all_wcvp_data[col].apply(clean_whitespaces_in_names)
+        for col in [c for c in wcvp_columns_used_in_direct_matching if c in all_wcvp_data.columns]:
+            all_wcvp_data[col] = clean_whitespaces_in_column(all_wcvp_data[col])
 
-    all_accepted = all_wcvp_data[
-        all_wcvp_data[wcvp_columns['status']].isin(['Accepted', 'Artificial Hybrid'])]
+    if columns is None:
+        accepted_info_columns, species_info_columns = list(_accepted_info_sources), list(_species_info_sources)
+    else:
+        accepted_info_columns, species_info_columns = _columns_to_derive(columns)
 
-    parsed_wcvp_data = add_accepted_info_to_rows(all_wcvp_data,
-                                                 get_parent_names_and_ipni_ids(all_accepted,
-                                                                               all_wcvp_data))
-    parsed_wcvp_data = get_species_names_and_ipni_ids(parsed_wcvp_data)
+    all_accepted = all_wcvp_data[
+        all_wcvp_data[wcvp_columns['status']].isin(_accepted_statuses)]
+    if any(c in _accepted_parent_info_columns for c in accepted_info_columns):
+        all_accepted = get_parent_names_and_ipni_ids(all_accepted, all_wcvp_data)
 
-    if statuses_to_drop is None:
-        statuses_to_drop = ['Local Biotype']
+    if len(accepted_info_columns) > 0:
+        parsed_wcvp_data = add_accepted_info_to_rows(all_wcvp_data, all_accepted, accepted_info_columns)
+    else:
+        parsed_wcvp_data = all_wcvp_data
+    parsed_wcvp_data = get_species_names_and_ipni_ids(parsed_wcvp_data, species_info_columns)
 
     parsed_wcvp_data = parsed_wcvp_data[~all_wcvp_data[wcvp_columns['status']].isin(statuses_to_drop)]
+    return parsed_wcvp_data
+
+
+def _parse_wcvp_names(wcvp_zip: zipfile.ZipFile, clean_strings: bool, statuses_to_drop: List[str]) -> pd.DataFrame:
+    """
+    Reads wcvp_names.csv from the given zip and adds accepted, parent and species information to each taxon.
+    :param wcvp_zip:
+    :param clean_strings:
+    :param statuses_to_drop:
+    :return:
+    """
+    return _parse_wcvp_names_data(_read_wcvp_names_csv(wcvp_zip), clean_strings, statuses_to_drop)
+
+
+def _parse_partial_wcvp_names(wcvp_zip: zipfile.ZipFile, clean_strings: bool, statuses_to_drop: List[str],
+                              columns: List[str] = None, **filters) -> pd.DataFrame:
+    """
+    Parses only the part of the checklist needed to answer the given filters (see _checklist_filter_mask) and
+    give the requested columns.
+
+    The columns used by the filters are read first to find the selected taxa. Then only the selected taxa, their accepted
+    taxa and the parents of those accepted taxa are read and parsed, so that the accepted and parent information
+    is the same as when parsing the whole checklist.
+
+    When columns are given, only the source columns they need are read and only the derived columns they need are
+    added. The returned frame may contain other columns used along the way.
+    :return:
+    """
+    source_columns = None
+    if columns is not None:
+        _validate_requested_columns(columns, _wcvp_names_csv_columns(wcvp_zip) + list(_accepted_info_sources) + list(
+            _species_info_sources))
+        columns = _columns_needed_for_filters(columns, **filters)
+        source_columns = _source_columns_for(columns)
+
+    if not any(v is not None and v is not False for v in filters.values()):
+        all_wcvp_data = _read_wcvp_names_csv(wcvp_zip, usecols=source_columns)
+        return _parse_wcvp_names_data(all_wcvp_data, clean_strings, statuses_to_drop, columns)
+
+    used_filter_columns = [_filter_source_columns[f] for f in filters if
+                           filters[f] is not None and filters[f] is not False]
+    key_columns = list(dict.fromkeys([wcvp_columns['wcvp_id'], wcvp_columns['status'],
+                                      wcvp_columns['acc_plant_name_id'],
+                                      wcvp_columns['parent_plant_name_id']] + used_filter_columns))
+    key_data = _read_wcvp_names_csv(wcvp_zip, usecols=key_columns)
+    if clean_strings:
+        for col in [c for c in wcvp_columns_used_in_direct_matching if c in key_columns]:
+            key_data[col] = clean_whitespaces_in_column(key_data[col])
+
+    all_accepted = key_data[key_data[wcvp_columns['status']].isin(_accepted_statuses)].drop_duplicates(
+        subset=[wcvp_columns['wcvp_id']]).set_index(wcvp_columns['wcvp_id'])
+    accepted_ids = key_data[wcvp_columns['acc_plant_name_id']]
+    for c in ['family', 'rank']:
+        if wcvp_columns[c] in key_columns:
+            key_data[wcvp_accepted_columns[c]] = accepted_ids.map(all_accepted[wcvp_columns[c]])
+
+    kept_key_data = key_data[~key_data[wcvp_columns['status']].isin(statuses_to_drop)]
+    _validate_checklist_filters(kept_key_data, **filters)
+    selected = kept_key_data[_checklist_filter_mask(kept_key_data, **filters)]
+
+    selected_accepted_ids = selected[wcvp_columns['acc_plant_name_id']].dropna().unique()
+    parent_ids = all_accepted.loc[all_accepted.index.isin(selected_accepted_ids),
+    wcvp_columns['parent_plant_name_id']].dropna().unique()
+    ids_to_parse = pd.Index(selected[wcvp_columns['wcvp_id']]).union(pd.Index(selected_accepted_ids)).union(
+        pd.Index(parent_ids))
+
+    print(f'Parsing {len(selected.index)} of {len(key_data.index)} taxa in the checklist')
+    del key_data, kept_key_data, all_accepted
+    subset = _read_wcvp_names_csv(wcvp_zip, usecols=source_columns, plant_name_ids=ids_to_parse)
+    # Parsing relies on a range index, so the rows are relabelled by their position in the file afterwards to give
+    # the same labels as filtering the whole parsed checklist
+    file_positions = subset.index.to_numpy()
+    parsed_subset = _parse_wcvp_names_data(subset.reset_index(drop=True), clean_strings, statuses_to_drop, columns)
+    parsed_subset.index = pd.Index(file_positions[parsed_subset.index.to_numpy()])
+    return parsed_subset[_checklist_filter_mask(parsed_subset, **filters)]
+
+
+def _tag_cached_checklist(parsed_wcvp_data: pd.DataFrame, cache_path: str) -> pd.DataFrame:
+    # Lets name matching find the indexes cached with the checklist. Kept by frames derived from it e.g. by filtering
+    parsed_wcvp_data.attrs[checklist_cache_attr] = (cache_path, len(parsed_wcvp_data.index))
+    return parsed_wcvp_data
 
+
+def _load_parsed_wcvp_names(wcvp_zip: zipfile.ZipFile, clean_strings: bool, statuses_to_drop: List[str],
+                            use_cache: bool) -> pd.DataFrame:
+    """
+    Returns the parsed checklist, using the on-disk cache next to the zip where possible.
+    :param wcvp_zip:
+    :param clean_strings:
+    :param statuses_to_drop:
+    :param use_cache:
+    :return:
+    """
+    if not use_cache:
+        return _parse_wcvp_names(wcvp_zip, clean_strings, statuses_to_drop)
+
+    cache_path = parsed_checklist_cache_path(wcvp_zip.filename, clean_strings, statuses_to_drop)
+    parsed_wcvp_data = read_parsed_checklist(cache_path)
+    if parsed_wcvp_data is None:
+        # Only one process builds the cache, others wait and then read it
+        with file_lock(cache_path):
+            parsed_wcvp_data = read_parsed_checklist(cache_path)
+            if parsed_wcvp_data is None:
+                parsed_wcvp_data = _parse_wcvp_names(wcvp_zip, clean_strings, statuses_to_drop)
+                write_parsed_checklist(parsed_wcvp_data, cache_path)
+                return _tag_cached_checklist(parsed_wcvp_data, cache_path)
+    print(f'Loaded parsed checklist from cache: {cache_path}')
+    return _tag_cached_checklist(parsed_wcvp_data, cache_path)
+
+
+def clear_parsed_checklist_cache():
+    """
+    Removes all parsed checklists cached by get_all_taxa. The downloaded zips are kept.
+    :return:
+    """
+    clear_cached_checklists(_wcvp_downloads_path)
+
+
+known_ranks_in_wcvp = ['Species', 'nothosubsp.', 'Subspecies', 'Form', 'Variety', 'microgene', 'Genus',
+                       'proles', 'nothof.', 'Subvariety', 'nothovar.', 'Subform', 'lusus', 'monstr.',
+                       '[**]', '[*]', 'sublusus', 'Convariety', 'psp.', 'subspecioid', 'group', 'grex',
+                       'stirps', 'mut.', 'subproles', 'nid', 'provar.', 'positio', 'micromorphe',
+                       'modif.',
+                       'ecas.', 'microf.', 'agamosp.']
+
+
+def _validate_checklist_filters(parsed_wcvp_data: pd.DataFrame, families_of_interest: List[str] = None,
+                                ranks: List[str] = None, genera: List[str] = None, species: List[str] = None,
+                                specific_taxa: List[str] = None, accepted: bool = False):
     if genera is not None:
         for g in genera:
-            if g not in all_wcvp_data[wcvp_columns['genus']].values:
+            if g not in parsed_wcvp_data[wcvp_columns['genus']].values:
                 raise ValueError(f'Given genus: {g} not in WCVP. CASE SENSITIVE')
-        parsed_wcvp_data = parsed_wcvp_data.loc[parsed_wcvp_data['genus'].isin(genera)]
 
     if species is not None:
         for s in species:
-            if s not in all_wcvp_data['species'].values:
+            if s not in parsed_wcvp_data['species'].values:
                 raise ValueError(f'Given species: {s} not in WCVP. CASE SENSITIVE')
-        parsed_wcvp_data = parsed_wcvp_data.loc[parsed_wcvp_data['species'].isin(species)]
 
-    if accepted:
-        parsed_wcvp_data = parsed_wcvp_data[parsed_wcvp_data[wcvp_columns['status']] == 'Accepted']
-
-    known_ranks_in_wcvp = ['Species', 'nothosubsp.', 'Subspecies', 'Form', 'Variety', 'microgene', 'Genus',
-                           'proles', 'nothof.', 'Subvariety', 'nothovar.', 'Subform', 'lusus', 'monstr.',
-                           '[**]', '[*]', 'sublusus', 'Convariety', 'psp.', 'subspecioid', 'group', 'grex',
-                           'stirps', 'mut.', 'subproles', 'nid', 'provar.', 'positio', 'micromorphe',
-                           'modif.',
-                           'ecas.', 'microf.', 'agamosp.']
     if ranks is not None:
         for r in ranks:
             if r not in known_ranks_in_wcvp:
                 raise ValueError(f'Given rank: {r} not in wcvp ranks: {known_ranks_in_wcvp}. CASE SENSITIVE')
-        parsed_wcvp_data = parsed_wcvp_data[(parsed_wcvp_data[wcvp_columns['rank']].isin(ranks)) | (
-            parsed_wcvp_data[wcvp_accepted_columns['rank']].isin(ranks))]
 
     if specific_taxa is not None:
         for f in specific_taxa:
-            if f not in all_wcvp_data[wcvp_columns['name']].values:
+            if f not in parsed_wcvp_data[wcvp_columns['name']].values:
                 raise ValueError(f'Given specific taxa: {f} not in WCVP. CASE SENSITIVE')
-        parsed_wcvp_data = parsed_wcvp_data[parsed_wcvp_data[wcvp_columns['name']].isin(specific_taxa)]
 
-    parsed_wcvp_data = filter_families_from_df(parsed_wcvp_data, families_of_interest)
+    if families_of_interest is not None:
+        for f in families_of_interest:
+            if f not in parsed_wcvp_data[wcvp_columns['family']].values:
+                raise ValueError(f'Given family: {f} not in WCVP. CASE SENSITIVE')
+
+
+def _checklist_filter_mask(parsed_wcvp_data: pd.DataFrame, families_of_interest: List[str] = None,
+                           ranks: List[str] = None, genera: List[str] = None, species: List[str] = None,
+                           specific_taxa: List[str] = None, accepted: bool = False) -> pd.Series:
+    """
+    Boolean mask of the taxa matching all the given filters. Families and ranks also match taxa whose
+    accepted taxon is in the given families or ranks.
+    :return:
+    """
+    mask = pd.Series(True, index=parsed_wcvp_data.index)
+    if genera is not None:
+        mask &= parsed_wcvp_data['genus'].isin(genera)
+
+    if species is not None:
+        mask &= parsed_wcvp_data['species'].isin(species)
+
+    if accepted:
+        mask &= parsed_wcvp_data[wcvp_columns['status']] == 'Accepted'
+
+    if ranks is not None:
+        mask &= (parsed_wcvp_data[wcvp_columns['rank']].isin(ranks)) | (
+            parsed_wcvp_data[wcvp_accepted_columns['rank']].isin(ranks))
+
+    if specific_taxa is not None:
+        mask &= parsed_wcvp_data[wcvp_columns['name']].isin(specific_taxa)
+
+    if families_of_interest is not None:
+        mask &= (parsed_wcvp_data[wcvp_columns['family']].isin(families_of_interest)) | (
+            parsed_wcvp_data[wcvp_accepted_columns['family']].isin(families_of_interest))
+    return mask
+
+
+def _filter_parsed_checklist(parsed_wcvp_data: pd.DataFrame, **filters) -> pd.DataFrame:
+    """
+    Restricts the parsed checklist to the given filters. The filters are combined into a single boolean mask
+    so that only one slice of the checklist is taken.
+    :return:
+    """
+    _validate_checklist_filters(parsed_wcvp_data, **filters)
+    mask = _checklist_filter_mask(parsed_wcvp_data, **filters)
+
+    if mask.all():
+        # A shallow copy, so the resident checklist isn't affected by callers adding columns
+        return parsed_wcvp_data.copy(deep=False)
+    return parsed_wcvp_data[mask]
+
+
+def get_all_taxa(families_of_interest: List[str] = None, ranks: List[str] = None, genera: List[str] = None,
+                 species: List[str] = None,
+                 specific_taxa: List[str] = None,
+                 accepted: bool = False, statuses_to_drop=None, output_csv: str = None,
+                 get_new_version: bool = False, version: str = None,
+                 clean_strings: bool = True, use_cache: bool = True, keep_in_memory: bool = True,
+                 compact: bool = False, columns: List[str] = None, offline: bool = None) -> pd.DataFrame:
+    '''
+    When filters or columns are given and no parsed checklist is in memory or cached on disk, only the taxa and columns
+    needed to answer them are parsed (and nothing is cached).
+
+    :param families_of_interest: Restrict taxa to those in given families. Will also include synonyms whose accepted taxon is in given families
+    :param ranks: Restrict taxa to those in given ranks. Will also include synonyms whose accepted taxon is in given rank
+    :param genera: Return taxa with a particular species epithet.
+    :param species: Return taxa with a particular species epithet.
+    :param specific_taxa: Return taxa with a particular taxon name.
+    :param accepted: If TRUE, only return accepted taxa.
+    :param statuses_to_drop:
+    :param output_csv:
+    :param get_new_version:
+    :param version:
+    :param clean_strings:
+    :param use_cache: If TRUE, the parsed checklist is stored next to the downloaded zip and reused by later calls
+    with the same version, clean_strings and statuses_to_drop. The cache is rebuilt when the zip is updated.
+    :param keep_in_memory: If TRUE, the parsed checklist is kept in checklist_registry and later calls in the same
+    process are answered from memory. Use checklist_registry.evict(version) or checklist_registry.clear() to free it.
+    :param compact: If TRUE, return the checklist in the smaller representation given by compact_checklist.
+    :param columns: Only return these columns, in the given order. Any column of wcvp_names.csv or derived accepted_*
+    column can be given.
+    :param offline: If TRUE, never access the network and use the already downloaded checklist. Defaults to the
+    WCVPY_OFFLINE environment variable.
+    :return:
+    '''
+    start = time.time()
+
+    if output_csv is not None:
+        new_output_dir = os.path.dirname(output_csv)
+        if not os.path.isdir(new_output_dir) and new_output_dir != '':
+            os.mkdir(new_output_dir)
+
+    if statuses_to_drop is None:
+        statuses_to_drop = ['Local Biotype']
+
+    registry_key = checklist_registry.key(version, clean_strings, statuses_to_drop, compact)
+    all_wcvp_data = None
+    if keep_in_memory and not get_new_version:
+        all_wcvp_data = checklist_registry.lookup(registry_key)
+
+    filters = dict(families_of_interest=families_of_interest, ranks=ranks, genera=genera, species=species,
+                   specific_taxa=specific_taxa, accepted=accepted)
+    if all_wcvp_data is not None:
+        parsed_wcvp_data = _filter_parsed_checklist(all_wcvp_data, **filters)
+    else:
+        filetime, zf = get_wcvp_zip(get_new_version=get_new_version, version=version, offline=offline)
+        cache_exists = use_cache and os.path.exists(
+            parsed_checklist_cache_path(zf.filename, clean_strings, statuses_to_drop))
+        filters_given = any(v is not None and v is not False for v in filters.values())
+        if (filters_given or columns is not None) and not cache_exists:
+            # Without a parsed checklist to filter, only parse the taxa and columns needed
+            parsed_wcvp_data = _parse_partial_wcvp_names(zf, clean_strings, statuses_to_drop, columns=columns,
+                                                         **filters)
+            if compact:
+                parsed_wcvp_data = compact_checklist(parsed_wcvp_data)
+        else:
+            all_wcvp_data = _load_parsed_wcvp_names(zf, clean_strings, statuses_to_drop, use_cache)
+            if compact:
+                all_wcvp_data = compact_checklist(all_wcvp_data)
+            if keep_in_memory:
+                checklist_registry.register(registry_key, all_wcvp_data)
+            parsed_wcvp_data = _filter_parsed_checklist(all_wcvp_data, **filters)
+        zf.close()
+
+    if columns is not None:
+        _validate_requested_columns(columns, parsed_wcvp_data.columns)
+        parsed_wcvp_data = parsed_wcvp_data[columns]
+
     if output_csv is not None:
         parsed_wcvp_data.to_csv(output_csv)
 
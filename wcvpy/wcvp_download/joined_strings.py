@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+# The distinct values of a column are joined with this separator so that each cleaning step is a single
+# regular expression or string method call over all of them. The marker may be used within the joined values.
+joined_strings_separator = '\x00'
+joined_strings_marker = '\x01'
+
+
+def apply_to_unique_strings(column: pd.Series, joined_function, scalar_function) -> pd.Series:
+    """
+    Applies a string function once to each distinct string value of the column and broadcasts the results back.
+    Other values are left as they are, and the output has the same type as column.apply(scalar_function).
+
+    joined_function is given the distinct values joined by joined_strings_separator and must return the results
+    joined in the same way. scalar_function is used instead when the values contain the separator or marker.
+    :param column:
+    :param joined_function:
+    :param scalar_function:
+    :return:
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        categories = pd.Series(column.cat.categories)
+        return column.map(
+            dict(zip(categories, apply_to_unique_strings(categories, joined_function, scalar_function))))
+
+    codes, uniques = pd.factorize(column)
+    uniques = np.asarray(uniques, dtype=object)
+    if pd.api.types.is_string_dtype(uniques):
+        is_str = np.ones(len(uniques), dtype=bool)
+    else:
+        is_str = np.fromiter((isinstance(v, str) for v in uniques), dtype=bool, count=len(uniques))
+    if is_str.any():
+        strings = uniques[is_str].tolist()
+        joined = joined_strings_separator.join(strings)
+        if joined.count(joined_strings_separator) == len(strings) - 1 and joined_strings_marker not in joined:
+            results = joined_function(joined).split(joined_strings_separator)
+        else:
+            results = [scalar_function(v) for v in strings]
+        uniques[is_str] = results
+
+    missing = codes == -1
+    if missing.any():
+        values = column.to_numpy(dtype=object, copy=True)
+        values[~missing] = uniques.take(codes[~missing])
+    else:
+        values = uniques.take(codes)
+    return pd.Series(values, index=column.index, name=column.name).infer_objects()
+
+
+def join_words_in_joined_strings(joined: str) -> str:
+    """
+    Equivalent of ' '.join(value.split()) for each of the joined values.
+    :param joined:
+    :return:
+    """
+    # The separator isn't whitespace, so it is kept in the words next to it
+    joined = ' '.join(joined.split())
+    return joined.replace(' ' + joined_strings_separator, joined_strings_separator).replace(
+        joined_strings_separator + ' ', joined_strings_separator)
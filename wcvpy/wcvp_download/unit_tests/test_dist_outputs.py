@@ -32,6 +32,12 @@ def get_acc_name_from_ipni_id(all_taxa, ipni_id):
 
 class MyTestCase(unittest.TestCase):
 
+    def test_compact_checklist_distributions(self):
+        native_test_df = pd.DataFrame({'names': list(native_test_dict.keys())})
+        out = get_distributions_for_accepted_taxa(native_test_df, 'names')
+        compact_out = get_distributions_for_accepted_taxa(native_test_df, 'names', compact=True)
+        pd.testing.assert_frame_equal(out, compact_out, check_dtype=False)
+
     def test_getting_data_from_names(self):
 
         native_test_df = pd.DataFrame({'names': list(native_test_dict.keys())})
@@ -5,7 +5,7 @@ import pandas as pd
 import pandas.testing
 
 from wcvpy.wcvp_download import get_all_taxa, wcvp_columns, wcvp_accepted_columns, \
-    wcvp_columns_used_in_direct_matching
+    wcvp_columns_used_in_direct_matching, checklist_registry, wcvp_id_columns
 
 wcvp_data = get_all_taxa(get_new_version=True)
 _output_path = 'test_outputs'
@@ -306,6 +306,55 @@ class MyTestCase(unittest.TestCase):
 
         pandas.testing.assert_frame_equal(sp,all_sp)
 
+    def test_parsed_checklist_cache(self):
+        cached = get_all_taxa()
+        uncached = get_all_taxa(use_cache=False)
+        pandas.testing.assert_frame_equal(cached, uncached)
+
+    def test_checklist_registry(self):
+        checklist_registry.clear()
+        resident = get_all_taxa(families_of_interest=['Loganiaceae'])
+        self.assertEqual(len(checklist_registry), 1)
+        reloaded = get_all_taxa(families_of_interest=['Loganiaceae'], keep_in_memory=False)
+        pandas.testing.assert_frame_equal(resident, reloaded)
+
+        checklist_registry.evict()
+        self.assertEqual(len(checklist_registry), 0)
+
+    def test_compact_checklist(self):
+        compact = get_all_taxa(compact=True)
+        self.assertLess(compact.memory_usage(deep=True).sum(), wcvp_data.memory_usage(deep=True).sum())
+        for c in wcvp_data.columns:
+            if c in wcvp_id_columns:
+                pd.testing.assert_series_equal(compact[c].astype(float), pd.to_numeric(wcvp_data[c]).astype(float))
+            else:
+                pd.testing.assert_series_equal(compact[c].astype(object), wcvp_data[c].astype(object))
+
+    def test_filtered_parse_matches_full_parse(self):
+        # Filters are applied during parsing when nothing is cached
+        for filters in [{'families_of_interest': ['Loganiaceae']}, {'ranks': ['Variety']},
+                        {'genera': ['Anthocleista'], 'accepted': True}]:
+            filtered_parse = get_all_taxa(use_cache=False, keep_in_memory=False, **filters)
+            filtered_full_parse = get_all_taxa(**filters)
+            # Including the row labels, so that indexes of the checklist give the same taxa either way
+            pandas.testing.assert_frame_equal(filtered_parse, filtered_full_parse)
+
+    def test_column_projection(self):
+        all_taxa = get_all_taxa()
+        for columns in [['taxon_name', 'taxon_authors', 'taxon_status', 'accepted_name'],
+                        ['plant_name_id', 'accepted_species', 'accepted_species_id'],
+                        ['accepted_parent_w_author', 'family']]:
+            projected_parse = get_all_taxa(use_cache=False, keep_in_memory=False, columns=columns)
+            self.assertEqual(list(projected_parse.columns), columns)
+            pandas.testing.assert_frame_equal(projected_parse, all_taxa[columns])
+
+            filtered_projected_parse = get_all_taxa(use_cache=False, keep_in_memory=False, columns=columns,
+                                                    families_of_interest=['Loganiaceae'])
+            pandas.testing.assert_frame_equal(filtered_projected_parse,
+                                              get_all_taxa(families_of_interest=['Loganiaceae'])[columns])
+
+        self.assertRaises(ValueError, get_all_taxa, columns=['not_a_column'])
+
 
 if __name__ == '__main__':
     unittest.main()
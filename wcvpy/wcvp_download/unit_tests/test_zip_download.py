@@ -0,0 +1,226 @@
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from wcvpy.wcvp_download import zip_download, get_taxa_from_wcvp, get_wcvp_zip
+from wcvpy.wcvp_download.zip_download import download_zip, partial_download_path
+
+
+def _make_zip_bytes() -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as z:
+        # Stored uncompressed, so that the download is large enough to interrupt
+        z.writestr('wcvp_names.csv', ''.join(f'{i}|{i * 7919 % 10007}|name {i}\n' for i in range(20000)))
+    return buffer.getvalue()
+
+
+class _StandInServer:
+    """
+    Serves a single file with support for range requests. The first `drop_after` responses are cut off
+    after `drop_bytes` bytes.
+    """
+
+    def __init__(self, content: bytes, support_ranges: bool = True, drop_after: int = 0, drop_bytes: int = 0):
+        self.content = content
+        self.support_ranges = support_ranges
+        self.drop_after = drop_after
+        self.drop_bytes = drop_bytes
+        self.range_headers = []
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                range_header = self.headers.get('Range')
+                server.range_headers.append(range_header)
+                start = 0
+                if range_header is not None and server.support_ranges:
+                    start = int(range_header.split('=')[1].split('-')[0])
+                    if start >= len(server.content):
+                        self.send_response(416)
+                        self.send_header('Content-Range', f'bytes */{len(server.content)}')
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range',
+                                     f'bytes {start}-{len(server.content) - 1}/{len(server.content)}')
+                else:
+                    self.send_response(200)
+                body = server.content[start:]
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if server.drop_after > 0:
+                    server.drop_after -= 1
+                    self.wfile.write(body[:server.drop_bytes])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/wcvp.zip'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.content = _make_zip_bytes()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.destination = os.path.join(self.tmp_dir.name, 'wcvp.zip')
+        self._retry_wait = zip_download._download_retry_wait
+        zip_download._download_retry_wait = 0
+
+    def tearDown(self):
+        zip_download._download_retry_wait = self._retry_wait
+        self.tmp_dir.cleanup()
+
+    def assert_downloaded(self):
+        with open(self.destination, 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertFalse(os.path.exists(partial_download_path(self.destination)))
+
+    def test_download(self):
+        with _StandInServer(self.content) as server:
+            download_zip(server.url, self.destination)
+        self.assert_downloaded()
+        self.assertEqual(server.range_headers, [None])
+
+    def test_resume_after_interruption(self):
+        with _StandInServer(self.content, drop_after=2, drop_bytes=len(self.content) // 4) as server:
+            download_zip(server.url, self.destination, chunk_size=1024)
+        self.assert_downloaded()
+        # Each retry resumes from the end of what has been written so far
+        self.assertEqual(len(server.range_headers), 3)
+        self.assertIsNone(server.range_headers[0])
+        resumed_from = [int(h[len('bytes='):-1]) for h in server.range_headers[1:]]
+        self.assertTrue(0 < resumed_from[0] < resumed_from[1] <= len(self.content) // 2)
+
+    def test_resume_from_previous_partial_download(self):
+        with open(partial_download_path(self.destination), 'wb') as f:
+            f.write(self.content[:1000])
+        with _StandInServer(self.content) as server:
+            download_zip(server.url, self.destination)
+        self.assert_downloaded()
+        self.assertEqual(server.range_headers, ['bytes=1000-'])
+
+        # A complete partial download only needs installing
+        with open(partial_download_path(self.destination), 'wb') as f:
+            f.write(self.content)
+        with _StandInServer(self.content) as server:
+            download_zip(server.url, self.destination)
+        self.assert_downloaded()
+
+    def test_server_without_range_support(self):
+        with open(partial_download_path(self.destination), 'wb') as f:
+            f.write(b'stale')
+        with _StandInServer(self.content, support_ranges=False, drop_after=1, drop_bytes=5000) as server:
+            download_zip(server.url, self.destination)
+        self.assert_downloaded()
+
+    def test_failed_downloads(self):
+        # Out of retries, the partial download is kept for the next call
+        with _StandInServer(self.content, drop_after=3, drop_bytes=100) as server:
+            self.assertRaises(ConnectionError, download_zip, server.url, self.destination, chunk_size=10,
+                              retries=1)
+        self.assertFalse(os.path.exists(self.destination))
+        self.assertGreater(os.path.getsize(partial_download_path(self.destination)), 100)
+
+        # Invalid zips are removed
+        os.remove(partial_download_path(self.destination))
+        with _StandInServer(b'not a zip') as server:
+            self.assertRaises(zipfile.BadZipfile, download_zip, server.url, self.destination)
+        self.assertFalse(os.path.exists(self.destination))
+        self.assertFalse(os.path.exists(partial_download_path(self.destination)))
+
+
+class GetWCVPZipTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.zip_path = os.path.join(self.tmp_dir.name, 'wcvp.zip')
+        with open(self.zip_path, 'wb') as f:
+            f.write(_make_zip_bytes())
+        self.downloads_path_patch = mock.patch.object(get_taxa_from_wcvp, '_wcvp_downloads_path', self.tmp_dir.name)
+        self.downloads_path_patch.start()
+        self.head_patch = mock.patch('requests.head')
+        self.head = self.head_patch.start()
+        self.head.return_value.headers = {'last-modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+
+    def tearDown(self):
+        self.head_patch.stop()
+        self.downloads_path_patch.stop()
+        self.tmp_dir.cleanup()
+
+    def test_offline(self):
+        with mock.patch.dict(os.environ, {'WCVPY_OFFLINE': '1'}):
+            get_wcvp_zip()[1].close()
+            get_wcvp_zip(get_new_version=True)[1].close()
+            # The argument takes precedence over the environment variable
+            get_wcvp_zip(offline=False)[1].close()
+        self.assertEqual(self.head.call_count, 1)
+
+        os.remove(self.zip_path)
+        self.assertRaises(FileNotFoundError, get_wcvp_zip, offline=True)
+
+    def test_freshness_record(self):
+        get_wcvp_zip()[1].close()
+        get_wcvp_zip()[1].close()
+        self.assertEqual(self.head.call_count, 1)
+
+        get_wcvp_zip(freshness_ttl=0)[1].close()
+        self.assertEqual(self.head.call_count, 2)
+        with mock.patch.dict(os.environ, {'WCVPY_FRESHNESS_TTL': '0'}):
+            get_wcvp_zip()[1].close()
+        self.assertEqual(self.head.call_count, 3)
+
+        # Checks made before the zip is replaced aren't used
+        os.utime(self.zip_path, ns=(0, os.stat(self.zip_path).st_mtime_ns + 10 ** 9))
+        get_wcvp_zip()[1].close()
+        self.assertEqual(self.head.call_count, 4)
+
+        # Checking for a new version always uses the network
+        get_wcvp_zip(get_new_version=True)[1].close()
+        self.assertEqual(self.head.call_count, 5)
+
+    def test_concurrent_downloads(self):
+        os.remove(self.zip_path)
+        zip_bytes = _make_zip_bytes()
+
+        def slow_download(url, destination):
+            time.sleep(0.5)
+            with open(destination, 'wb') as f:
+                f.write(zip_bytes)
+
+        def load_zip():
+            get_wcvp_zip(version='99')[1].close()
+
+        with mock.patch.object(zip_download, 'download_zip', side_effect=slow_download) as download:
+            workers = [threading.Thread(target=load_zip) for _ in range(8)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+        # Only the first worker downloads, the others wait for it
+        self.assertEqual(download.call_count, 1)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir.name, 'wcvp_v99.zip')))
+
+
+if __name__ == '__main__':
+    unittest.main()
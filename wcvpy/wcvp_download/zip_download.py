@@ -0,0 +1,127 @@
+import os
+import time
+import zipfile
+
+import requests
+from tqdm import tqdm
+
+_download_chunk_size = 1024 * 1024
+_download_retries = 5
+# Seconds to wait before the first retry, doubled for each later retry
+_download_retry_wait = 1
+_download_timeout = 60
+
+_retryable_download_errors = (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                              requests.exceptions.Timeout)
+
+
+def partial_download_path(destination: str) -> str:
+    return destination + '.part'
+
+
+def _total_size_from_content_range(content_range: str) -> int:
+    # e.g. 'bytes 100-199/200' or 'bytes */200'
+    total = content_range.rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+def _download_to_partial_file(url: str, part_path: str, chunk_size: int, timeout: float) -> int:
+    """
+    Downloads url into part_path, resuming from the end of part_path if it exists and the server supports range
+    requests.
+    :param url:
+    :param part_path:
+    :param chunk_size:
+    :param timeout:
+    :return: The total size of the file being downloaded, or None if the server doesn't give it.
+    """
+    resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={resume_from}-'} if resume_from > 0 else {}
+
+    with requests.get(url, stream=True, headers=headers, timeout=timeout) as r:
+        if r.status_code == 416:
+            # Nothing left to download if the partial file is already complete, otherwise start again
+            total_size = _total_size_from_content_range(r.headers.get('content-range', ''))
+            if total_size == resume_from:
+                return total_size
+            os.remove(part_path)
+            return _download_to_partial_file(url, part_path, chunk_size, timeout)
+        r.raise_for_status()
+
+        if r.status_code == 206 and r.headers.get('content-range', '').startswith(f'bytes {resume_from}-'):
+            mode = 'ab'
+            total_size = _total_size_from_content_range(r.headers['content-range'])
+        else:
+            # The server ignored the range request so the whole file is being sent
+            mode = 'wb'
+            resume_from = 0
+            content_length = r.headers.get('content-length', '')
+            total_size = int(content_length) if content_length.isdigit() else None
+
+        with open(part_path, mode) as fd, tqdm(total=total_size, initial=resume_from, unit='B', unit_scale=True,
+                                               unit_divisor=1024, desc=os.path.basename(url)) as progress:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                fd.write(chunk)
+                progress.update(len(chunk))
+    return total_size
+
+
+def _verify_downloaded_zip(part_path: str, total_size: int):
+    """
+    Checks the download has the expected size and is a readable zip. Invalid downloads are removed.
+    :param part_path:
+    :param total_size:
+    :return:
+    """
+    problem = None
+    if total_size is not None and os.path.getsize(part_path) != total_size:
+        problem = f'expected {total_size} bytes but downloaded {os.path.getsize(part_path)}'
+    else:
+        try:
+            with zipfile.ZipFile(part_path) as z:
+                bad_file = z.testzip()
+            if bad_file is not None:
+                problem = f'corrupt file in zip: {bad_file}'
+        except zipfile.BadZipfile as e:
+            problem = str(e)
+    if problem is not None:
+        os.remove(part_path)
+        raise zipfile.BadZipfile(f'Downloaded file is invalid ({problem}), rerun to download again.')
+
+
+def download_zip(url: str, destination: str, chunk_size: int = _download_chunk_size, retries: int = _download_retries,
+                 timeout: float = _download_timeout):
+    """
+    Downloads the zip at url to destination, reporting progress.
+
+    The download is written to a partial file next to destination, which is only moved to destination once its size
+    and contents have been checked, so destination is never left partially written. Interrupted downloads are resumed
+    from the partial file with HTTP range requests, up to the given number of retries. If the download still
+    fails, the partial file is kept and resumed by the next call.
+    :param url:
+    :param destination:
+    :param chunk_size: Size in bytes of the chunks written to disk
+    :param retries:
+    :param timeout: Seconds to wait for the server to respond
+    :return:
+    """
+    part_path = partial_download_path(destination)
+    attempt = 0
+    while True:
+        try:
+            total_size = _download_to_partial_file(url, part_path, chunk_size, timeout)
+            if total_size is None or os.path.getsize(part_path) >= total_size:
+                break
+            problem = f'connection closed after {os.path.getsize(part_path)} of {total_size} bytes'
+        except _retryable_download_errors as e:
+            problem = str(e)
+        attempt += 1
+        if attempt > retries:
+            raise ConnectionError(f'Download failed after {retries} retries ({problem}). '
+                                  f'Rerun to resume the download: {url}')
+        wait = _download_retry_wait * 2 ** (attempt - 1)
+        print(f'WARNING: Download interrupted ({problem}), resuming in {wait}s. Retry {attempt} of {retries}')
+        time.sleep(wait)
+
+    _verify_downloaded_zip(part_path, total_size)
+    os.replace(part_path, destination)
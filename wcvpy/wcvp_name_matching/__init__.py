@@ -1,6 +1,49 @@
+import importlib as _importlib
+
 from .string_utils import *
 from .general_matching_utils import *
 from .resolve_openrefine_matches import *
 from .knms_name_matching import *
 from .wcvp_matching import *
+from .local_fuzzy_matching import *
+from .phonetic_matching import *
+from .resolution_cache import *
 from .get_accepted_info import *
+from .chunked_matching import *
+
+# The OpenRefine client is only imported when first used, to keep importing the package fast
+_lazy_names = {'openrefine_match_full_names': 'wcvpy.OpenRefineMatching',
+               'reco_submitted_name_col_id': 'wcvpy.OpenRefineMatching'}
+
+
+def __getattr__(name):
+    if name in _lazy_names:
+        value = getattr(_importlib.import_module(_lazy_names[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_names))
+
+
+# The names imported by `from ... import *`. The lazily imported names are left out, so that star imports don't
+# import their modules
+__all__ = ['acc_info_col_names', 'add_space_around_hybrid_chars_and_infraspecific_epithets', 'clean_urn_ids',
+           'clean_whitespaces_in_names', 'clear_resolution_cache', 'clear_stored_knms_matches',
+           'filter_families_from_df', 'get_accepted_info_from_names_in_chunks',
+           'get_accepted_info_from_names_in_column', 'get_accepted_wcvp_info_from_ipni_ids_in_column',
+           'get_all_taxa', 'get_family_specific_resolutions', 'get_genus_from_full_name', 'get_knms_name_matches',
+           'get_local_fuzzy_matches', 'get_phonetic_matches', 'get_species_binomial_from_full_name',
+           'get_species_epithet_from_full_name', 'get_wcvp_info_for_names_in_column', 'get_word_combinations',
+           'hybrid_characters', 'infraspecific_chars', 'is_latin', 'knms_batch_size', 'knms_cache_ttl',
+           'knms_max_workers', 'knms_outputs_dir', 'latin_letters', 'lookup_ipni_id_in_wcvp', 'lowercase_name_col',
+           'match_name_to_concatenated_columns', 'max_cached_knms_names', 'near_match_keys_in_column',
+           'only_roman_chars', 'output_record_col_names', 'rank_priority', 'recapitalised_name_col',
+           'remove_double_spaces', 'remove_fullstop', 'remove_spacelike_chars',
+           'remove_whitespace_at_beginning_and_end', 'resolve_matches_by_priorities',
+           'resolve_openrefine_to_best_matches', 'status_priority', 'submitted_family_name_col_id',
+           'submitted_name_col_id', 'temp_outputs_dir', 'tidied_taxon_authors_col', 'tidy_authors',
+           'tidy_families_in_column', 'tidy_names_in_column', 'tidy_value_for_matching',
+           'unique_submission_index_col', 'wcvp_accepted_columns', 'wcvp_columns']
@@ -0,0 +1,163 @@
+import os
+from typing import Iterable, Iterator, List, Union
+
+import numpy as np
+import pandas as pd
+
+from wcvpy.wcvp_download import get_all_taxa
+from wcvpy.wcvp_name_matching import output_record_col_names, unique_submission_index_col
+from wcvpy.wcvp_name_matching.get_accepted_info import get_accepted_info_from_names_in_column, \
+    _check_reserved_columns, _broadcast_resolutions
+
+# Columns added to each chunk by matching
+resolution_columns = output_record_col_names + ['matched_by', 'matched_name']
+
+
+def _read_chunks(chunks: Union[str, os.PathLike, pd.DataFrame, Iterable[pd.DataFrame]],
+                 chunksize: int) -> Iterator[pd.DataFrame]:
+    if isinstance(chunks, (str, os.PathLike)):
+        path = os.fspath(chunks)
+        if path.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+                yield batch.to_pandas()
+        else:
+            with pd.read_csv(path, chunksize=chunksize) as reader:
+                yield from reader
+    elif isinstance(chunks, pd.DataFrame):
+        for start in range(0, len(chunks.index), chunksize):
+            yield chunks.iloc[start:start + chunksize]
+    else:
+        yield from chunks
+
+
+def _write_chunks(matched_chunks: Iterator[pd.DataFrame], output_file: Union[str, os.PathLike]):
+    output_file = os.fspath(output_file)
+    if output_file.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        try:
+            for chunk in matched_chunks:
+                if writer is None:
+                    schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                    # Resolutions are all strings, but may all be missing in the first chunk
+                    for c in resolution_columns:
+                        schema = schema.set(schema.get_field_index(c), pa.field(c, pa.string()))
+                    writer = pq.ParquetWriter(output_file, schema)
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        header = True
+        for chunk in matched_chunks:
+            chunk.to_csv(output_file, mode='w' if header else 'a', header=header, index=False)
+            header = False
+
+
+def _submission_keys(df: pd.DataFrame, name_col: str, family_column: str = None) -> pd.Index:
+    if family_column is None:
+        return pd.Index(df[name_col].astype(object))
+    return pd.MultiIndex.from_arrays([df[family_column].astype(object), df[name_col].astype(object)])
+
+
+def _match_chunks(chunks: Iterable[pd.DataFrame], name_col: str, cache_size: int, family_column: str,
+                  all_taxa: pd.DataFrame, **kwargs) -> Iterator[pd.DataFrame]:
+    submission_columns = [name_col] if family_column is None else [family_column, name_col]
+    # Codes of the submissions seen so far, in the order they were seen, and their resolutions. Submissions may have
+    # more than one resolution (e.g. from a manual resolution csv)
+    seen_codes = pd.Series(index=_submission_keys(pd.DataFrame(columns=submission_columns), name_col, family_column),
+                           dtype=np.int64)
+    cache = pd.DataFrame({unique_submission_index_col: pd.Series(dtype=np.int64),
+                          **{c: pd.Series(dtype=object) for c in resolution_columns}})
+    next_code = 0
+    # Types of the resolution columns given by matching, which the cache doesn't keep
+    resolution_dtypes = {}
+    for chunk in chunks:
+        _check_reserved_columns(chunk)
+        keys = _submission_keys(chunk, name_col, family_column)
+        has_name = chunk[name_col].notna().to_numpy()
+        seen_rows = seen_codes.index.get_indexer(keys)
+        new_submissions = chunk.iloc[np.flatnonzero(has_name & (seen_rows < 0))][submission_columns]
+        new_submissions = new_submissions.drop_duplicates()
+        if len(new_submissions.index) > 0:
+            # Only submissions which haven't been seen in previous chunks are matched
+            new_codes = pd.Series(np.arange(next_code, next_code + len(new_submissions.index)),
+                                  index=_submission_keys(new_submissions, name_col, family_column))
+            next_code += len(new_submissions.index)
+            resolutions = get_accepted_info_from_names_in_column(new_submissions, name_col,
+                                                                 family_column=family_column, all_taxa=all_taxa,
+                                                                 **kwargs)
+            resolution_dtypes.update({c: resolutions[c].dtype for c in resolution_columns if
+                                      resolutions[c].notna().any()})
+            resolution_codes = new_codes.to_numpy()[
+                new_codes.index.get_indexer(_submission_keys(resolutions, name_col, family_column))]
+            resolutions = resolutions[resolution_columns].astype(object)
+            resolutions.insert(0, unique_submission_index_col, resolution_codes)
+            seen_codes = pd.concat([seen_codes, new_codes])
+            cache = pd.concat([cache, resolutions], ignore_index=True)
+            seen_rows = seen_codes.index.get_indexer(keys)
+        row_codes = np.where(has_name & (seen_rows >= 0), seen_codes.to_numpy()[seen_rows], -1)
+        # Rows without a resolution look up the missing code -1, so are left unresolved
+        matched_chunk = _broadcast_resolutions(chunk, row_codes, cache, keep_index=True).astype(resolution_dtypes)
+        if len(seen_codes.index) > cache_size:
+            # Forget the submissions seen first
+            seen_codes = seen_codes.iloc[len(seen_codes.index) - cache_size:]
+            cache = cache[cache[unique_submission_index_col].isin(seen_codes.to_numpy())]
+        yield matched_chunk
+
+
+def get_accepted_info_from_names_in_chunks(chunks: Union[str, os.PathLike, pd.DataFrame, Iterable[pd.DataFrame]],
+                                           name_col: str, output_file: Union[str, os.PathLike] = None,
+                                           chunksize: int = 100000, cache_size: int = 1000000,
+                                           families_of_interest: List[str] = None,
+                                           family_column: str = None,
+                                           manual_resolution_csv: str = None,
+                                           match_level: str = 'full', use_open_refine: bool = True,
+                                           wcvp_version: str = None, all_taxa: pd.DataFrame = None,
+                                           n_jobs: int = 1, use_resolution_cache: bool = False,
+                                           use_local_fuzzy: bool = False, use_knms: bool = True,
+                                           use_phonetic: bool = False, concurrent_network_stages: bool = False):
+    """
+    Version of get_accepted_info_from_names_in_column for data too large to match at once. Data is read and matched
+    a chunk at a time, using one copy of the checklist. Resolutions are kept for later chunks, so that names repeated
+    across chunks are only matched once.
+    :param chunks: Path to a csv or parquet file, a dataframe, or an iterable of dataframes
+    :param name_col:
+    :param output_file: If given, matched chunks are written to this csv (or parquet, if it ends with .parquet) file
+    rather than returned
+    :param chunksize: Number of rows to read at a time from files and dataframes
+    :param cache_size: Maximum number of resolved submissions to keep for later chunks
+    :param families_of_interest:
+    :param family_column:
+    :param manual_resolution_csv:
+    :param match_level:
+    :param use_open_refine:
+    :param wcvp_version:
+    :param all_taxa: output of get_all_taxa, if None will be calculated
+    :param n_jobs: Number of processes to match each chunk with, -1 to use all cores
+    :param use_resolution_cache: bool whether to reuse resolutions from previous runs, and store new ones
+    :param use_local_fuzzy: bool whether to fuzzy match names to the checklist locally, before using knms and open
+    refine
+    :param use_knms: bool whether to use knms in fuzzy matching
+    :param use_phonetic: bool whether to match misspelt names to the checklist by their near-match keys, before any
+    other fuzzy matching
+    :param concurrent_network_stages: bool whether to query knms and openrefine at the same time
+    :return: Iterator of matched chunks, or None if output_file is given
+    """
+    if all_taxa is not None and wcvp_version is not None:
+        raise ValueError('Cannot specify both wcvp_version and all_taxa')
+    if all_taxa is None:
+        all_taxa = get_all_taxa(version=wcvp_version)
+
+    matched_chunks = _match_chunks(_read_chunks(chunks, chunksize), name_col, cache_size, family_column, all_taxa,
+                                   families_of_interest=families_of_interest,
+                                   manual_resolution_csv=manual_resolution_csv, match_level=match_level,
+                                   use_open_refine=use_open_refine, n_jobs=n_jobs,
+                                   use_resolution_cache=use_resolution_cache, use_local_fuzzy=use_local_fuzzy,
+                                   use_knms=use_knms, use_phonetic=use_phonetic,
+                                   concurrent_network_stages=concurrent_network_stages)
+    if output_file is None:
+        return matched_chunks
+    _write_chunks(matched_chunks, output_file)
@@ -1,17 +1,12 @@
 import hashlib
+import multiprocessing
 import os
-from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
-# Add progress bar to apply method
-from tqdm import tqdm
 
-from wcvpy.OpenRefineMatching import openrefine_match_full_names
-
-tqdm.pandas()
-
-from typing import List
+from typing import List, Tuple
 
 from wcvpy.wcvp_name_matching import get_wcvp_info_for_names_in_column, \
     get_knms_name_matches, clean_urn_ids, output_record_col_names, temp_outputs_dir, \
@@ -19,8 +14,19 @@ from wcvpy.wcvp_name_matching import get_wcvp_info_for_names_in_column, \
     tidy_families_in_column, submitted_family_name_col_id, unique_submission_index_col, \
     lowercase_name_col, tidied_taxon_authors_col, get_word_combinations, \
     remove_whitespace_at_beginning_and_end, get_accepted_wcvp_info_from_ipni_ids_in_column, \
-    resolve_matches_by_priorities, rank_priority, resolve_openrefine_to_best_matches
+    resolve_matches_by_priorities, rank_priority, resolve_openrefine_to_best_matches, knms_failed_names_attr
 from wcvpy.wcvp_download import get_all_taxa, wcvp_columns, wcvp_accepted_columns, filter_families_from_df
+from wcvpy.wcvp_download.checklist_cache import checklist_cache_attr
+from wcvpy.wcvp_name_matching.match_index import get_match_index, hash_keys, tidy_values_for_matching_in_column
+from wcvpy.wcvp_name_matching.local_fuzzy_matching import get_local_fuzzy_matches, resolve_local_fuzzy_matches
+from wcvpy.wcvp_name_matching.phonetic_matching import get_phonetic_matches, resolve_phonetic_matches
+from wcvpy.wcvp_name_matching.resolution_cache import resolution_settings, read_cached_resolutions, \
+    write_cached_resolutions, cached_resolution_columns
+
+# Checklist used by worker processes resolving submissions in parallel
+_worker_taxa = None
+# Marks the resolutions of submissions whose knms or openrefine requests failed, which aren't cached
+_lookup_failed_col = 'lookup_failed'
 
 
 def _temp_output(df: pd.DataFrame, tag: str, warning: str = None):
@@ -41,12 +47,51 @@ def _temp_output(df: pd.DataFrame, tag: str, warning: str = None):
     df.to_csv(outfile)
 
 
+def _autoresolution_candidates(names: pd.Series, all_taxa: pd.DataFrame,
+                               families: pd.Series = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the taxa whose name is one of the word combinations (from get_word_combinations) of the given names, by
+    looking up the combinations in the match index of the taxa. If families are given, only taxa with the family as
+    their family or accepted family are found.
+    :param names:
+    :param all_taxa:
+    :param families:
+    :return: Positions in names and the positions in all_taxa of the taxa found, ordered by position in names and
+    then by position in all_taxa.
+    """
+    combinations = [get_word_combinations(n) for n in names]
+    name_positions = np.repeat(np.arange(len(combinations)), np.array([len(c) for c in combinations], dtype=np.int64))
+    combinations = np.array([c for name_combinations in combinations for c in name_combinations], dtype=object)
+
+    match_index, taxa_positions = get_match_index(all_taxa, [()])
+    combination_positions, index_rows = match_index.candidates((), hash_keys(
+        tidy_values_for_matching_in_column(pd.Series(combinations, dtype=object))))
+    taxa_rows = taxa_positions[index_rows]
+    in_taxa = taxa_rows >= 0
+    combination_positions = combination_positions[in_taxa]
+    taxa_rows = taxa_rows[in_taxa]
+    # Taxon names must be the same as the combination, not just have the same match key
+    found = all_taxa[wcvp_columns['name']].to_numpy(dtype=object)[taxa_rows] == combinations[combination_positions]
+    name_positions = name_positions[combination_positions[found]]
+    taxa_rows = taxa_rows[found]
+    if families is not None:
+        submitted_families = families.to_numpy(dtype=object)[name_positions]
+        in_family = pd.notna(submitted_families) & (
+                (all_taxa[wcvp_columns['family']].to_numpy(dtype=object)[taxa_rows] == submitted_families) |
+                (all_taxa[wcvp_accepted_columns['family']].to_numpy(dtype=object)[taxa_rows] == submitted_families))
+        name_positions = name_positions[in_family]
+        taxa_rows = taxa_rows[in_family]
+    order = np.lexsort((taxa_rows, name_positions))
+    return name_positions[order], taxa_rows[order]
+
+
 def _autoresolve_missing_matches(unmatched_submissions_df: pd.DataFrame, matching_name_col: str,
                                  submission_id_col: str,
                                  all_taxa: pd.DataFrame,
                                  family_column: str = None) -> pd.DataFrame:
     """
-
+    Matches submissions to taxa whose name is the first word(s) of the submitted name, and resolves them to the
+    most specific of these.
     :param unmatched_submissions_df:
     :return:
     """
@@ -54,70 +99,23 @@ def _autoresolve_missing_matches(unmatched_submissions_df: pd.DataFrame, matchin
     if len(unmatched_submissions_df.index) > 0:
         _temp_output(unmatched_submissions_df, 'unmatched_to_autoresolve',
                      "Resolving submitted names which weren't initially matched using KNMS.")
-        print(
-            "This may take some time... This can be sped up by specifying families of interest (if you "
-            "haven't already done so) or checking the temp file for misspelled submissions.")
 
-        # For each submission, check if any name is contained in the name, then take the lowest rank of
+        # For each submission, find the names its first words are a match for, then take the lowest rank of
         # matches
-        # Create a df of submissions with possible matches
-        match_df = pd.DataFrame()
-
-        if family_column is not None:
-            match_df[family_column] = []
-
-        # Get more precise list of taxa which possibly matches submissions
-        substrings_of_unmatched_names = []
-        for sub_name in unmatched_submissions_df[matching_name_col].values:
-            substrings_of_unmatched_names += [sub_name[x:y] for x, y in
-                                              combinations(range(len(sub_name) + 1), r=2)]
-
-        substrings_of_unmatched_names = list(set(substrings_of_unmatched_names))
-
-        wcvp_name_containment_df = all_taxa[
-            all_taxa[wcvp_columns['name']].isin(substrings_of_unmatched_names)]
-
-        wcvp_names = wcvp_name_containment_df[wcvp_columns['name']].tolist()
-        mask = unmatched_submissions_df[matching_name_col].str.contains(
-            '|'.join(wcvp_names))
-        unmatched_submissions_worth_checking = unmatched_submissions_df[mask]
+        submitted_families = None if family_column is None else unmatched_submissions_df[family_column]
+        submission_rows, taxa_rows = _autoresolution_candidates(unmatched_submissions_df[matching_name_col],
+                                                                all_taxa, submitted_families)
 
         match_df_cols = output_record_col_names + [wcvp_columns['family'], wcvp_columns['name'],
                                                    wcvp_columns['rank']]
-
-        for i in tqdm(range(len(unmatched_submissions_worth_checking[matching_name_col].values)),
-                      desc="Searching automated matches",
-                      ascii=False, ncols=72):
-            submitted_name = unmatched_submissions_worth_checking[matching_name_col].values[i]
-            submitted_id = unmatched_submissions_worth_checking[submission_id_col].values[i]
-            word_combinations_to_check = get_word_combinations(submitted_name)
-            if family_column is not None:
-                submitted_family = unmatched_submissions_worth_checking[family_column].values[i]
-
-                for index, row in wcvp_name_containment_df.iterrows():
-                    record = row.to_frame().transpose()[match_df_cols]
-
-                    if submitted_family == row[wcvp_columns['family']] or submitted_family == row[
-                        wcvp_accepted_columns['family']]:
-                        taxa = row[wcvp_columns['name']]
-
-                        if taxa in word_combinations_to_check:
-                            record[matching_name_col] = [submitted_name]
-                            record[family_column] = [submitted_family]
-                            record['matched_name'] = taxa
-                            record[submission_id_col] = submitted_id
-                            match_df = pd.concat([match_df, record])
-            else:
-                for index, row in wcvp_name_containment_df.iterrows():
-                    record = row.to_frame().transpose()[match_df_cols]
-
-                    taxa = row[wcvp_columns['name']]
-
-                    if taxa in word_combinations_to_check:
-                        record[matching_name_col] = [submitted_name]
-                        record[submission_id_col] = submitted_id
-                        record['matched_name'] = taxa
-                        match_df = pd.concat([match_df, record])
+        match_df = all_taxa.iloc[taxa_rows][match_df_cols]
+        submissions = unmatched_submissions_df.iloc[submission_rows]
+        match_df[matching_name_col] = submissions[matching_name_col].to_numpy(dtype=object)
+        match_df['matched_name'] = match_df[wcvp_columns['name']]
+        match_df[submission_id_col] = submissions[submission_id_col].to_numpy()
+        if family_column is not None:
+            match_df[family_column] = submissions[family_column].to_numpy()
+            match_df = match_df[[family_column] + [c for c in match_df.columns if c != family_column]]
 
         if len(match_df.index) > 0:
             match_df = match_df.dropna(subset=[wcvp_accepted_columns['name']])
@@ -147,7 +145,10 @@ def _autoresolve_missing_matches(unmatched_submissions_df: pd.DataFrame, matchin
 
             return matches
         else:
-            return match_df
+            no_matches = pd.DataFrame()
+            if family_column is not None:
+                no_matches[family_column] = []
+            return no_matches
     else:
         return unmatched_submissions_df
 
@@ -161,13 +162,15 @@ def _get_knms_matches_and_accepted_info_from_names_in_column(df: pd.DataFrame, m
     Matches names in df using knms and gets corresponding accepted info from wcvp.
     :param df:
     :param matching_name_col:
-    :return:
+    :return: The resolutions, with the names knms couldn't match because their requests failed in
+    attrs[knms_failed_names_attr]
     """
     if len(df.index) > 0:
         match_records = get_knms_name_matches(df[matching_name_col].unique())
         if match_records is None:
             none_data = pd.DataFrame(columns=[unique_submission_id_col])
             return none_data
+        failed_names = match_records.attrs.get(knms_failed_names_attr, [])
         match_records = pd.merge(match_records, df, left_on='submitted', right_on=matching_name_col)
         match_records['ipni_id'] = match_records['ipni_id'].apply(clean_urn_ids)
         match_records = get_accepted_wcvp_info_from_ipni_ids_in_column(match_records, 'ipni_id', all_taxa)
@@ -204,6 +207,7 @@ def _get_knms_matches_and_accepted_info_from_names_in_column(df: pd.DataFrame, m
             [unique_submission_id_col] + output_record_col_names + ['matched_by', 'matched_name']]
         resolved_df = resolved_df.dropna(subset=[wcvp_accepted_columns['name']])
         resolved_df = resolved_df.drop_duplicates(subset=[unique_submission_id_col], keep='first')
+        resolved_df.attrs[knms_failed_names_attr] = failed_names
 
         return resolved_df
     else:
@@ -284,12 +288,330 @@ def _find_best_matches_from_multiple_knms_matches(multiple_match_records: pd.Dat
     return matches_to_use
 
 
+def _check_reserved_columns(in_df: pd.DataFrame):
+    reserved_column_names = [submitted_name_col_id, submitted_family_name_col_id, recapitalised_name_col,
+                             lowercase_name_col,
+                             unique_submission_index_col, 'submitted', 'matched_by', 'matched_name',
+                             'resolution_id',
+                             'taxon_name_with_taxon_authors', tidied_taxon_authors_col
+                             ] + list(wcvp_columns.values()) + output_record_col_names
+    problem_columns = [x for x in in_df.columns if
+                       x in reserved_column_names]
+    if len(problem_columns) > 0:
+        raise ValueError(
+            f'Column names used in input data will be confused in matching process: {problem_columns}. '
+            f'Following column names are reserved: {reserved_column_names}')
+
+
+def _unique_submissions(in_df: pd.DataFrame, name_col: str, family_column: str = None) -> Tuple[
+    np.ndarray, pd.DataFrame]:
+    """
+    Codes the rows of in_df by submission i.e. by name, or by name and family if family_column is given.
+    :param in_df:
+    :param name_col:
+    :param family_column:
+    :return: The submission code of each row of in_df (-1 for rows without a name), and the first row of in_df for
+    each submission with its code in unique_submission_index_col.
+    """
+    name_codes, _ = pd.factorize(in_df[name_col])
+    has_name = name_codes >= 0
+    if family_column is not None:
+        family_codes, families = pd.factorize(in_df[family_column], use_na_sentinel=False)
+        name_codes = name_codes.astype(np.int64) * len(families) + family_codes
+    submission_codes = np.full(len(in_df.index), -1, dtype=np.int64)
+    submission_codes[has_name] = pd.factorize(name_codes[has_name])[0]
+    # Codes are in order of first appearance
+    first_rows = np.flatnonzero(has_name)[np.unique(submission_codes[has_name], return_index=True)[1]]
+    df = in_df.iloc[first_rows].copy()
+    df[unique_submission_index_col] = np.arange(len(first_rows))
+    return submission_codes, df
+
+
+def _broadcast_resolutions(in_df: pd.DataFrame, submission_codes: np.ndarray,
+                           resolved_df: pd.DataFrame, keep_index: bool = False) -> pd.DataFrame:
+    """
+    Gives each row of in_df the resolution of its submission, leaving rows without a name unresolved. Submissions
+    with more than one resolution (e.g. from a manual resolution csv) get a row for each, as with a left merge.
+    :param in_df:
+    :param submission_codes: From _unique_submissions
+    :param resolved_df: Resolutions, with the submission code of each in unique_submission_index_col
+    :param keep_index: If True, rows keep the index of in_df (repeated for submissions with more than one
+    resolution), otherwise the index is reset
+    :return:
+    """
+    resolved_codes = resolved_df[unique_submission_index_col]
+    if resolved_codes.is_unique:
+        row_positions = np.arange(len(in_df.index))
+        resolution_rows = resolved_df.set_index(unique_submission_index_col).reindex(submission_codes)
+    else:
+        pairs = pd.merge(pd.DataFrame({unique_submission_index_col: submission_codes,
+                                       'row_position': np.arange(len(in_df.index))}),
+                         pd.DataFrame({unique_submission_index_col: resolved_codes.to_numpy(),
+                                       'resolution_position': np.arange(len(resolved_codes))}),
+                         on=unique_submission_index_col, how='left')
+        row_positions = pairs['row_position'].to_numpy()
+        resolution_rows = resolved_df.drop(columns=[unique_submission_index_col]).reset_index(drop=True).reindex(
+            pairs['resolution_position'].fillna(-1).astype(np.int64))
+    out_df = pd.concat([in_df.iloc[row_positions].reset_index(drop=True), resolution_rows.reset_index(drop=True)],
+                       axis=1)
+    if keep_index:
+        out_df.index = in_df.index[row_positions]
+    return out_df
+
+
+def _expand_compact_columns(resolved_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Gives the output columns from a compact checklist (see compact_checklist) the types they have when matching with
+    the full checklist: categoricals as their values and plant name ids as strings.
+    :param resolved_df:
+    :return:
+    """
+    for c in output_record_col_names:
+        column = resolved_df[c]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            resolved_df[c] = column.astype(column.cat.categories.dtype)
+        elif pd.api.types.is_extension_array_dtype(column.dtype) and pd.api.types.is_integer_dtype(column.dtype):
+            resolved_df[c] = column.astype(str).astype(object).where(column.notna(), np.nan)
+    return resolved_df
+
+
+def _add_cached_resolutions(resolved_df: pd.DataFrame, cached_resolved_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds the resolutions read from the resolution cache to those just made. Cached resolutions are given the types of
+    the columns just resolved, so that using the cache doesn't change the types of the output.
+    :param resolved_df:
+    :param cached_resolved_df: From read_cached_resolutions
+    :return:
+    """
+    if len(cached_resolved_df.index) == 0:
+        return resolved_df
+    if len(resolved_df.index) == 0:
+        return cached_resolved_df
+    # Columns without any resolutions just made take the types of the cached resolutions
+    resolution_dtypes = {c: resolved_df[c].dtype if resolved_df[c].notna().any() else cached_resolved_df[c].dtype
+                         for c in cached_resolution_columns}
+    return pd.concat([resolved_df.astype(resolution_dtypes), cached_resolved_df.astype(resolution_dtypes)])
+
+
+def _resolve_submissions(df: pd.DataFrame, all_taxa: pd.DataFrame, family_column: str,
+                         families_of_interest: List[str], manual_resolution_csv: str, match_level: str,
+                         use_open_refine: bool, use_local_fuzzy: bool = False,
+                         use_knms: bool = True, use_phonetic: bool = False,
+                         concurrent_network_stages: bool = False) -> pd.DataFrame:
+    """
+    Runs each matching step in turn on the tidied unique submissions in df, returning the resolution of each
+    submission (or the submission itself where it couldn't be resolved).
+    :param df:
+    :param all_taxa:
+    :param family_column:
+    :param families_of_interest:
+    :param manual_resolution_csv:
+    :param match_level:
+    :param use_open_refine:
+    :param use_local_fuzzy:
+    :param use_knms:
+    :param use_phonetic:
+    :param concurrent_network_stages:
+    :return: The resolutions, with the submissions whose knms or openrefine requests failed marked in
+    _lookup_failed_col
+    """
+    # First get manual matches using given ipni ids
+    if manual_resolution_csv is not None:
+        manual_match_df = pd.read_csv(manual_resolution_csv)
+        manual_match_df = manual_match_df[
+            manual_match_df['submitted'].isin(df[submitted_name_col_id].values.tolist())]
+        man_matches_with_accepted_info = get_accepted_wcvp_info_from_ipni_ids_in_column(manual_match_df,
+                                                                                        'resolution_id',
+                                                                                        all_taxa)
+        man_matches_with_accepted_info = man_matches_with_accepted_info.dropna(
+            subset=[wcvp_accepted_columns['name']])
+        manual_matches = pd.merge(df, man_matches_with_accepted_info, left_on=submitted_name_col_id,
+                                  right_on='submitted',
+                                  sort=False)
+        manual_matches['matched_by'] = 'manual'
+        manual_matches['matched_name'] = np.nan
+        unmatched_manual_df = df[
+            ~df[unique_submission_index_col].isin(manual_matches[unique_submission_index_col].values)]
+    else:
+        manual_matches = pd.DataFrame()
+        unmatched_manual_df = df
+
+    # Then match with exact matches in wcvp
+    wcvp_exact_name_match_df = get_wcvp_info_for_names_in_column(unmatched_manual_df,
+                                                                 recapitalised_name_col,
+                                                                 unique_submission_index_col,
+                                                                 family_column=family_column,
+                                                                 all_taxa=all_taxa)
+
+    wcvp_resolved_df = pd.concat([wcvp_exact_name_match_df, manual_matches], axis=0)
+    unmatched_name_df = df[
+        ~df[unique_submission_index_col].isin(wcvp_resolved_df[unique_submission_index_col].values)]
+
+    failed_submission_ids = []
+    if match_level in ['full', 'fuzzy']:
+        # If exact matches aren't found in wcvp, use phonetic and local fuzzy matching, knms and openrefine
+        if use_phonetic:
+            phonetic_matches = resolve_phonetic_matches(
+                get_phonetic_matches(unmatched_name_df, recapitalised_name_col, unique_submission_index_col,
+                                     all_taxa=all_taxa, family_column=family_column),
+                unique_submission_index_col)
+            wcvp_resolved_df = pd.concat([wcvp_resolved_df, phonetic_matches], axis=0)
+            unmatched_name_df = unmatched_name_df[
+                ~unmatched_name_df[unique_submission_index_col].isin(
+                    phonetic_matches[unique_submission_index_col].values)]
+        if use_local_fuzzy:
+            local_fuzzy_matches = resolve_local_fuzzy_matches(
+                get_local_fuzzy_matches(unmatched_name_df, recapitalised_name_col, unique_submission_index_col,
+                                        all_taxa=all_taxa, family_column=family_column),
+                unique_submission_index_col)
+            wcvp_resolved_df = pd.concat([wcvp_resolved_df, local_fuzzy_matches], axis=0)
+            unmatched_name_df = unmatched_name_df[
+                ~unmatched_name_df[unique_submission_index_col].isin(
+                    local_fuzzy_matches[unique_submission_index_col].values)]
+        # then knms
+        def match_with_knms():
+            if use_knms:
+                return _get_knms_matches_and_accepted_info_from_names_in_column(unmatched_name_df,
+                                                                                recapitalised_name_col,
+                                                                                unique_submission_index_col,
+                                                                                all_taxa,
+                                                                                family_column=family_column)
+            return pd.DataFrame(columns=[unique_submission_index_col])
+
+        def failed_submissions(matches: pd.DataFrame, failed_names_attr: str, submissions_df: pd.DataFrame):
+            failed_names = matches.attrs.get(failed_names_attr, [])
+            return submissions_df.loc[submissions_df[recapitalised_name_col].isin(failed_names),
+                                      unique_submission_index_col].tolist()
+
+        if use_open_refine:
+            from wcvpy.OpenRefineMatching import openrefine_match_full_names, openrefine_failed_names_attr
+            if concurrent_network_stages and use_knms:
+                # Send all the remaining names to openrefine while knms runs, and keep the openrefine matches of those
+                # knms doesn't match, as if it had run afterwards
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    open_refine_future = executor.submit(openrefine_match_full_names, unmatched_name_df,
+                                                         recapitalised_name_col)
+                    matches_with_knms = match_with_knms()
+                    all_open_refine_matches = open_refine_future.result()
+                unmatched_knms_df = unmatched_name_df[
+                    ~unmatched_name_df[unique_submission_index_col].isin(
+                        matches_with_knms[unique_submission_index_col].values)]
+            else:
+                matches_with_knms = match_with_knms()
+                unmatched_knms_df = unmatched_name_df[
+                    ~unmatched_name_df[unique_submission_index_col].isin(
+                        matches_with_knms[unique_submission_index_col].values)]
+                # Use given submitted name and let openrefine do any cleaning
+                all_open_refine_matches = openrefine_match_full_names(unmatched_knms_df, recapitalised_name_col)
+            failed_submission_ids += failed_submissions(all_open_refine_matches, openrefine_failed_names_attr,
+                                                        unmatched_knms_df)
+            all_open_refine_matches = all_open_refine_matches[
+                all_open_refine_matches[unique_submission_index_col].isin(
+                    unmatched_knms_df[unique_submission_index_col].values)]
+
+            resolved_open_refine_matches = resolve_openrefine_to_best_matches(all_open_refine_matches,
+                                                                              all_taxa,
+                                                                              families_of_interest=families_of_interest)
+            resolved_open_refine_matches['matched_name'] = resolved_open_refine_matches['reco_name']
+
+            fuzzy_resolved_df = pd.concat([wcvp_resolved_df, matches_with_knms, resolved_open_refine_matches],
+                                          axis=0)
+        else:
+            matches_with_knms = match_with_knms()
+            fuzzy_resolved_df = pd.concat([wcvp_resolved_df, matches_with_knms],
+                                          axis=0)
+        failed_submission_ids += failed_submissions(matches_with_knms, knms_failed_names_attr, unmatched_name_df)
+        unmatched_df = df[
+            ~df[unique_submission_index_col].isin(fuzzy_resolved_df[unique_submission_index_col].values)]
+
+        if match_level == 'full':
+            # Get autoresolved matches
+            unmatched_resolutions = _autoresolve_missing_matches(unmatched_df, recapitalised_name_col,
+                                                                 unique_submission_index_col,
+                                                                 all_taxa,
+                                                                 family_column=family_column)
+            # This will raise a pandas warning
+            # https://github.com/pandas-dev/pandas/issues/55928
+            final_resolved_df = pd.concat(
+                [unmatched_resolutions, fuzzy_resolved_df], axis=0)
+
+        else:
+            final_resolved_df = pd.concat([fuzzy_resolved_df])
+    else:
+        final_resolved_df = wcvp_resolved_df
+
+    # Provide temp outputs
+    unmatched_final_df = df[
+        ~df[unique_submission_index_col].isin(final_resolved_df[unique_submission_index_col].values)]
+    if len(unmatched_final_df.index) > 0:
+        _temp_output(unmatched_final_df, 'unmatched_samples',
+                     'WARNING: some submissions have not been resolved and must be manually resolved. '
+                     'Consider fixing names in your original data.')
+        final_resolved_df = pd.concat([final_resolved_df, unmatched_final_df])
+
+    _temp_output(final_resolved_df, 'final_resolutions')
+    final_resolved_df[_lookup_failed_col] = final_resolved_df[unique_submission_index_col].isin(failed_submission_ids)
+
+    return final_resolved_df
+
+
+def _set_worker_taxa(all_taxa: pd.DataFrame):
+    # Forked workers already have the checklist, so aren't given it
+    global _worker_taxa
+    if all_taxa is not None:
+        _worker_taxa = all_taxa
+
+
+def _resolve_submissions_in_worker(args) -> pd.DataFrame:
+    df, kwargs = args
+    return _resolve_submissions(df, _worker_taxa, **kwargs)
+
+
+def _resolve_submissions_in_parallel(df: pd.DataFrame, all_taxa: pd.DataFrame, n_jobs: int,
+                                     **kwargs) -> pd.DataFrame:
+    """
+    Splits the submissions in df into n_jobs shards, which are resolved by a pool of processes. The results are
+    concatenated in the order of the shards.
+
+    Processes are started with the default start method. Where this forks processes (e.g. on Linux), the workers
+    share the checklist and its match index with this process rather than each being sent a copy. Otherwise (e.g. on
+    macOS and Windows, where forking is unsafe or unavailable), the checklist is sent to each worker once, and scripts
+    using this need the usual `if __name__ == '__main__':` guard.
+    :param df:
+    :param all_taxa:
+    :param n_jobs:
+    :param kwargs: Passed to _resolve_submissions
+    :return:
+    """
+    global _worker_taxa
+    shards = [df.iloc[positions] for positions in np.array_split(np.arange(len(df.index)), n_jobs)]
+    context = multiprocessing.get_context()
+    if context.get_start_method() == 'fork':
+        if checklist_cache_attr in all_taxa.attrs:
+            # Load the match index before forking, so that workers don't each load it
+            get_match_index(all_taxa)
+        _worker_taxa = all_taxa
+        worker_taxa = None
+    else:
+        worker_taxa = all_taxa
+    try:
+        with context.Pool(n_jobs, initializer=_set_worker_taxa, initargs=(worker_taxa,)) as pool:
+            resolutions = pool.map(_resolve_submissions_in_worker, [(shard, kwargs) for shard in shards])
+    finally:
+        _worker_taxa = None
+    return pd.concat(resolutions)
+
+
 def get_accepted_info_from_names_in_column(in_df: pd.DataFrame, name_col: str,
                                            families_of_interest: List[str] = None,
                                            family_column: str = None,
                                            manual_resolution_csv: str = None,
                                            match_level: str = 'full', use_open_refine: bool = True,
-                                           wcvp_version: str = None, all_taxa: pd.DataFrame = None) -> pd.DataFrame:
+                                           wcvp_version: str = None, all_taxa: pd.DataFrame = None,
+                                           n_jobs: int = 1, use_resolution_cache: bool = False,
+                                           use_local_fuzzy: bool = False, use_knms: bool = True,
+                                           use_phonetic: bool = False,
+                                           concurrent_network_stages: bool = False) -> pd.DataFrame:
     """
     First tries to match names in df to wcvp directly to obtain accepted info and then
     matches names in df using knms/openrefine. Finally uses full automated matching.
@@ -302,6 +624,17 @@ def get_accepted_info_from_names_in_column(in_df: pd.DataFrame, name_col: str,
     :param wcvp_version:
     :param use_open_refine: bool whether to use open refine in fuzzy matching
     :param all_taxa: output of get_all_taxa, if None will be calculated
+    :param n_jobs: Number of processes to match names with, -1 to use all cores
+    :param use_resolution_cache: bool whether to reuse resolutions from previous runs, and store new ones. Only
+    available when all_taxa is loaded by get_all_taxa
+    :param use_local_fuzzy: bool whether to fuzzy match names to the checklist locally, before using knms and open
+    refine
+    :param use_knms: bool whether to use knms in fuzzy matching
+    :param use_phonetic: bool whether to match misspelt names to the checklist by their near-match keys (see
+    near_match_keys_in_column), before any other fuzzy matching
+    :param concurrent_network_stages: bool whether to query knms and openrefine at the same time, rather than only
+    sending openrefine the names knms doesn't match. Gives the same resolutions in less time, at the cost of sending
+    openrefine more names
     :return:
     """
     # Check for bad inputs
@@ -312,23 +645,12 @@ def get_accepted_info_from_names_in_column(in_df: pd.DataFrame, name_col: str,
     if all_taxa is not None and wcvp_version is not None:
         raise ValueError('Cannot specify both wcvp_version and all_taxa')
 
-    reserved_column_names = [submitted_name_col_id, submitted_family_name_col_id, recapitalised_name_col,
-                             lowercase_name_col,
-                             unique_submission_index_col, 'submitted', 'matched_by', 'matched_name',
-                             'resolution_id',
-                             'taxon_name_with_taxon_authors', tidied_taxon_authors_col
-                             ] + list(wcvp_columns.values()) + output_record_col_names
-    problem_columns = [x for x in in_df.columns if
-                       x in reserved_column_names]
-    if len(problem_columns) > 0:
-        raise ValueError(
-            f'Column names used in input data will be confused in matching process: {problem_columns}. '
-            f'Following column names are reserved: {reserved_column_names}')
+    _check_reserved_columns(in_df)
 
     if len(in_df.index) > 0:
-        df = in_df.copy(deep=True)
+        # Each distinct submission is only tidied and matched once, and the results are broadcast back to in_df
+        submission_codes, df = _unique_submissions(in_df, name_col, family_column)
         # Standardise inputs
-        df = df.dropna(subset=[name_col])
         tidy_names_in_column(df, name_col)
         if family_column is not None:
             tidy_families_in_column(df, family_column)
@@ -349,14 +671,13 @@ def get_accepted_info_from_names_in_column(in_df: pd.DataFrame, name_col: str,
             elif families_of_interest is None:
                 families_of_interest = df[family_column].unique()
 
+        if all_taxa is None:
+            all_taxa = get_all_taxa(version=wcvp_version)
+
         # Check families of interest and in family column are in wcvp, and remove if not
         if families_of_interest is not None or family_column is not None:
-            if all_taxa is None:
-                wcvp_families_df = get_all_taxa(version=wcvp_version)
-            else:
-                wcvp_families_df = all_taxa.copy()
-            wcvp_families = list(wcvp_families_df[wcvp_columns['family']].unique())
-            wcvp_acc_families = list(wcvp_families_df[wcvp_accepted_columns['family']].unique())
+            wcvp_families = list(all_taxa[wcvp_columns['family']].unique())
+            wcvp_acc_families = list(all_taxa[wcvp_accepted_columns['family']].unique())
             wcvp_all_families = wcvp_families + wcvp_acc_families
             if families_of_interest is not None:
                 problem_fams = [f for f in families_of_interest if f not in wcvp_all_families]
@@ -375,123 +696,65 @@ def get_accepted_info_from_names_in_column(in_df: pd.DataFrame, name_col: str,
                     for f in problem_fams:
                         df[family_column].replace(f, np.nan, inplace=True)
 
-        # Create a unique identifier for submissions
-        if family_column is None:
-            df[unique_submission_index_col] = df[submitted_name_col_id].values.tolist()
-            in_df[unique_submission_index_col] = in_df[name_col].values.tolist()
-
-        else:
-            df[unique_submission_index_col] = df[
-                [submitted_family_name_col_id, submitted_name_col_id]].values.tolist()
-            in_df[unique_submission_index_col] = in_df[
-                [family_column, name_col]].values.tolist()
-
-        df[unique_submission_index_col] = df[unique_submission_index_col].astype(str)
-        in_df[unique_submission_index_col] = in_df[unique_submission_index_col].astype(str)
-        df = df.drop_duplicates(subset=[unique_submission_index_col])
-        if all_taxa is None:
-            all_taxa = get_all_taxa(families_of_interest=families_of_interest, version=wcvp_version)
-        else:
-            all_taxa = filter_families_from_df(all_taxa, families_of_interest)
-        # First get manual matches using given ipni ids
-        if manual_resolution_csv is not None:
-            manual_match_df = pd.read_csv(manual_resolution_csv)
-            manual_match_df = manual_match_df[
-                manual_match_df['submitted'].isin(df[submitted_name_col_id].values.tolist())]
-            man_matches_with_accepted_info = get_accepted_wcvp_info_from_ipni_ids_in_column(manual_match_df,
-                                                                                            'resolution_id',
-                                                                                            all_taxa)
-            man_matches_with_accepted_info = man_matches_with_accepted_info.dropna(
-                subset=[wcvp_accepted_columns['name']])
-            manual_matches = pd.merge(df, man_matches_with_accepted_info, left_on=submitted_name_col_id,
-                                      right_on='submitted',
-                                      sort=False)
-            manual_matches['matched_by'] = 'manual'
-            manual_matches['matched_name'] = np.nan
-            unmatched_manual_df = df[
-                ~df[unique_submission_index_col].isin(manual_matches[unique_submission_index_col].values)]
-        else:
-            manual_matches = pd.DataFrame()
-            unmatched_manual_df = df
-
-        # Then match with exact matches in wcvp
-        wcvp_exact_name_match_df = get_wcvp_info_for_names_in_column(unmatched_manual_df,
-                                                                     recapitalised_name_col,
-                                                                     unique_submission_index_col,
-                                                                     family_column=family_column,
-                                                                     all_taxa=all_taxa)
-
-        wcvp_resolved_df = pd.concat([wcvp_exact_name_match_df, manual_matches], axis=0)
-        unmatched_name_df = df[
-            ~df[unique_submission_index_col].isin(wcvp_resolved_df[unique_submission_index_col].values)]
-
-        if match_level in ['full', 'fuzzy']:
-            # If exact matches aren't found in wcvp, use knms and openrefine
-            # then knms
-            matches_with_knms = _get_knms_matches_and_accepted_info_from_names_in_column(
-                unmatched_name_df,
-                recapitalised_name_col,
-                unique_submission_index_col,
-                all_taxa,
-                family_column=family_column)
-
-            unmatched_knms_df = unmatched_name_df[
-                ~unmatched_name_df[unique_submission_index_col].isin(
-                    matches_with_knms[unique_submission_index_col].values)]
-            if use_open_refine:
-                # Use given submitted name and let openrefine do any cleaning
-                all_open_refine_matches = openrefine_match_full_names(unmatched_knms_df, recapitalised_name_col)
-
-                resolved_open_refine_matches = resolve_openrefine_to_best_matches(all_open_refine_matches,
-                                                                                  all_taxa,
-                                                                                  families_of_interest=families_of_interest)
-                resolved_open_refine_matches['matched_name'] = resolved_open_refine_matches['reco_name']
-
-                fuzzy_resolved_df = pd.concat([wcvp_resolved_df, matches_with_knms, resolved_open_refine_matches],
-                                              axis=0)
-            else:
-                fuzzy_resolved_df = pd.concat([wcvp_resolved_df, matches_with_knms],
-                                              axis=0)
-            unmatched_df = df[
-                ~df[unique_submission_index_col].isin(fuzzy_resolved_df[unique_submission_index_col].values)]
-
-            if match_level == 'full':
-                # Get autoresolved matches
-                unmatched_resolutions = _autoresolve_missing_matches(unmatched_df, recapitalised_name_col,
-                                                                     unique_submission_index_col,
-                                                                     all_taxa,
-                                                                     family_column=family_column)
-                # This will raise a pandas warning
-                # https://github.com/pandas-dev/pandas/issues/55928
-                final_resolved_df = pd.concat(
-                    [unmatched_resolutions, fuzzy_resolved_df], axis=0)
-
-            else:
-                final_resolved_df = pd.concat([fuzzy_resolved_df])
+        settings = None
+        if use_resolution_cache:
+            settings = resolution_settings(all_taxa, families_of_interest, match_level, use_open_refine,
+                                           manual_resolution_csv, use_local_fuzzy=use_local_fuzzy, use_knms=use_knms,
+                                           use_phonetic=use_phonetic)
+            if settings is None:
+                print('WARNING: Resolutions can only be cached for checklists loaded by get_all_taxa. '
+                      'Not using the resolution cache')
+        all_taxa = filter_families_from_df(all_taxa, families_of_interest)
+
+        cached_resolved_df = None
+        # Manual resolutions are found by the submitted names rather than the tidied names, so with a manual
+        # resolution csv resolutions are cached under the submitted names
+        cached_name_col = recapitalised_name_col if manual_resolution_csv is None else submitted_name_col_id
+        if settings is not None:
+            # Submissions resolved in previous runs are not matched again
+            family_values = df[family_column] if family_column is not None else None
+            cached_positions, cached_resolved_df = read_cached_resolutions(settings, df[cached_name_col],
+                                                                           family_values)
+            cached_resolved_df[unique_submission_index_col] = df[unique_submission_index_col].to_numpy()[
+                cached_positions]
+            is_cached = np.zeros(len(df.index), dtype=bool)
+            is_cached[cached_positions] = True
+            df = df[~is_cached]
+
+        resolve_args = dict(family_column=family_column, families_of_interest=families_of_interest,
+                            manual_resolution_csv=manual_resolution_csv, match_level=match_level,
+                            use_open_refine=use_open_refine, use_local_fuzzy=use_local_fuzzy, use_knms=use_knms,
+                            use_phonetic=use_phonetic, concurrent_network_stages=concurrent_network_stages)
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        n_jobs = min(n_jobs, len(df.index))
+        if len(df.index) == 0:
+            final_resolved_df = pd.DataFrame(columns=[unique_submission_index_col] + cached_resolution_columns +
+                                             [_lookup_failed_col])
+        elif n_jobs > 1:
+            final_resolved_df = _resolve_submissions_in_parallel(df, all_taxa, n_jobs, **resolve_args)
         else:
-            final_resolved_df = wcvp_resolved_df
-
-        # Provide temp outputs
-        unmatched_final_df = df[
-            ~df[unique_submission_index_col].isin(final_resolved_df[unique_submission_index_col].values)]
-        if len(unmatched_final_df.index) > 0:
-            _temp_output(unmatched_final_df, 'unmatched_samples',
-                         'WARNING: some submissions have not been resolved and must be manually resolved. '
-                         'Consider fixing names in your original data.')
-            final_resolved_df = pd.concat([final_resolved_df, unmatched_final_df])
-
-        _temp_output(final_resolved_df, 'final_resolutions')
-
-        final_resolved_df = final_resolved_df[
-            [unique_submission_index_col] + output_record_col_names + ['matched_by', 'matched_name']]
-        out_df = pd.merge(in_df, final_resolved_df, on=unique_submission_index_col,
-                          how='left')
-        in_df.drop(columns=[unique_submission_index_col], inplace=True)
-        out_df = out_df.drop(columns=[unique_submission_index_col])
-        # reorder
-        out_df = out_df[in_df.columns.tolist() + output_record_col_names + ['matched_by', 'matched_name']]
-        out_df['matched_name'] = out_df['matched_name'].apply(remove_whitespace_at_beginning_and_end)
-        return out_df
+            final_resolved_df = _resolve_submissions(df, all_taxa, **resolve_args)
+
+        failed_lookups = final_resolved_df.loc[final_resolved_df[_lookup_failed_col].astype(bool),
+                                               unique_submission_index_col]
+        final_resolved_df = _expand_compact_columns(final_resolved_df[
+            [unique_submission_index_col] + output_record_col_names + ['matched_by', 'matched_name']].copy())
+        final_resolved_df['matched_name'] = final_resolved_df['matched_name'].apply(
+            remove_whitespace_at_beginning_and_end)
+        if settings is not None:
+            # Only submissions with a single resolution are cached, and not those whose knms or openrefine requests
+            # failed, which may be resolved differently when the services respond
+            single_resolutions = final_resolved_df[
+                ~final_resolved_df[unique_submission_index_col].duplicated(keep=False) &
+                ~final_resolved_df[unique_submission_index_col].isin(failed_lookups)]
+            cached_df = df[df[unique_submission_index_col].isin(single_resolutions[unique_submission_index_col])]
+            new_resolutions = single_resolutions.set_index(unique_submission_index_col).reindex(
+                cached_df[unique_submission_index_col])
+            write_cached_resolutions(settings, cached_df[cached_name_col], new_resolutions,
+                                     cached_df[family_column] if family_column is not None else None)
+            final_resolved_df = _add_cached_resolutions(final_resolved_df, cached_resolved_df)
+        return _broadcast_resolutions(in_df, submission_codes, final_resolved_df)
     else:
         out_copy = in_df.copy()
         for a in output_record_col_names + ['matched_by', 'matched_name']:
@@ -1,16 +1,44 @@
-import hashlib
+import contextlib
 import json
 import os
+import sqlite3
+import threading
+import time
 import unicodedata as ud
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 
 import numpy as np
 import pandas as pd
-import requests
 
 temp_outputs_dir = 'name matching temp outputs'
 knms_outputs_dir = os.path.join(temp_outputs_dir, 'knms matches')
 
+knms_url = 'http://namematch.science.kew.org/api/v2/powo/match'
+# Names are sent to KNMS in batches of at most this many names, with this many batches sent at a time
+knms_batch_size = 100
+knms_max_workers = 4
+# Seconds to wait for KNMS to respond to a batch
+knms_timeout = 120
+knms_retries = 4
+# Seconds to wait before the first retry, doubled for each later retry
+knms_retry_wait = 1
+# Responses from KNMS after which the batch is retried, along with connection errors and timeouts
+_knms_retry_statuses = [429, 502, 503, 504]
+knms_record_columns = ['submitted', 'match_state', 'ipni_id', 'matched_name']
+# Names which couldn't be matched because their requests failed, or whose records weren't stored because they
+# suggested server issues, are listed in this attr of the records returned
+knms_failed_names_attr = 'knms_failed_names'
+
+# Records of the names searched for in KNMS are stored in this file in knms_outputs_dir
+_knms_cache_file = 'knms_matches.sqlite'
+# Prefix of the csv files records were stored in by older versions
+_legacy_knms_cache_tag = 'knms_matches_cache_'
+# Stored records older than this many seconds are searched for again
+knms_cache_ttl = 180 * 24 * 60 * 60
+# Least recently used names are removed beyond this number
+max_cached_knms_names = 2000000
+
 latin_letters = {}
 
 
@@ -29,85 +57,279 @@ def only_roman_chars(unistr):
                if uchr.isalpha())
 
 
-def get_knms_name_matches(names: List[str]) -> pd.DataFrame:
+class _RateLimit:
+    """
+    Shared by the threads sending requests to KNMS, so that all of them pause when KNMS responds that too many
+    requests are being made.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def wait(self):
+        with self._lock:
+            delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+
+class _KnmsBatchError(Exception):
+    def __init__(self, problem: str, splittable: bool):
+        super().__init__(problem)
+        # Whether the batch may succeed if sent as smaller batches, e.g. when the server errors on some of its names
+        # or times out
+        self.splittable = splittable
+
+
+def _knms_session(max_workers: int):
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _parse_knms_records(content: bytes) -> pd.DataFrame:
+    try:
+        content = json.loads(content.decode('utf-8'))
+        if all(len(content["records"][x]) == 2 for x in range(len(content["records"]))):
+            shortened_headings = ['submitted', 'match_state']
+            records = pd.DataFrame(content["records"], columns=shortened_headings)
+            records['ipni_id'] = np.nan
+            records['matched_name'] = np.nan
+        else:
+            records = pd.DataFrame(content["records"], columns=knms_record_columns)
+    except (ValueError, KeyError, TypeError):
+        raise _KnmsBatchError('records not retrieved due to server error', splittable=False)
+    records = records.replace('', np.nan)
+    records['submitted'] = records['submitted'].ffill()
+    records['match_state'] = records['match_state'].ffill()
+    return records
+
+
+def _post_knms_batch(session, names: List[str], url: str, timeout: float, retries: int,
+                     rate_limit: _RateLimit) -> pd.DataFrame:
+    """
+    Sends a batch of names to KNMS, retrying with exponential backoff when KNMS is rate limiting, unavailable or
+    can't be reached. Raises _KnmsBatchError if the batch can't be matched. Rate limiting pauses all batches, for as
+    long as KNMS asks if it gives a Retry-After header.
+    :return: The KNMS records of the names
+    """
+    import requests
+    attempt = 0
+    while True:
+        rate_limit.wait()
+        wait = knms_retry_wait * 2 ** attempt
+        try:
+            res = session.post(url, json=names, timeout=timeout)
+        except requests.exceptions.ReadTimeout as e:
+            problem, splittable, retryable = str(e), True, True
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            problem, splittable, retryable = str(e), False, True
+        else:
+            if res.ok:
+                return _parse_knms_records(res.content)
+            problem = f'HTTP {res.status_code}'
+            if res.status_code == 500:
+                problem += ', possibly from non-latin scripts in names'
+            elif res.status_code == 504:
+                problem += ', possibly due to lots of names'
+            splittable = res.status_code in [500, 504]
+            retryable = res.status_code in _knms_retry_statuses
+            if res.status_code == 429:
+                retry_after = res.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    wait = int(retry_after)
+                rate_limit.pause(wait)
+        attempt += 1
+        # Batches which can be split are split straight away rather than retried
+        if not retryable or attempt > retries or (splittable and len(names) > 1):
+            raise _KnmsBatchError(problem, splittable)
+        time.sleep(wait)
+
+
+def _match_knms_batch(session, names: List[str], url: str, timeout: float, retries: int,
+                      rate_limit: _RateLimit) -> Tuple[pd.DataFrame, List[Tuple[str, List[str]]]]:
+    """
+    Matches a batch of names with KNMS. Batches which fail from server errors or timeouts are split in half and
+    each half is tried again, so that the names causing the errors are isolated from the rest of the batch.
+    :return: The KNMS records of the names, and the problem with and names of each part of the batch which couldn't
+    be matched
+    """
+    try:
+        return _post_knms_batch(session, names, url, timeout, retries, rate_limit), []
+    except _KnmsBatchError as e:
+        if e.splittable and len(names) > 1:
+            middle = len(names) // 2
+            first_records, first_failures = _match_knms_batch(session, names[:middle], url, timeout, retries,
+                                                              rate_limit)
+            second_records, second_failures = _match_knms_batch(session, names[middle:], url, timeout, retries,
+                                                                rate_limit)
+            return pd.concat([first_records, second_records]), first_failures + second_failures
+        print(f'WARNING: Could not match {len(names)} names with KNMS ({e}): {names[:5]}')
+        return pd.DataFrame(columns=knms_record_columns), [(str(e), names)]
+
+
+def _get_knms_records(names: List[str], url: str = None, batch_size: int = None, max_workers: int = None,
+                      timeout: float = None, retries: int = None) -> Tuple[pd.DataFrame, List[str]]:
     """
-    Searches knms for matching names
+    Matches the names with KNMS in batches, sent concurrently over a pool of connections. Raises a ConnectionError
+    if none of the names could be matched.
+    :return: The KNMS records of the names, in the order of the names, and the names which couldn't be matched
+    """
+    url = knms_url if url is None else url
+    batch_size = knms_batch_size if batch_size is None else batch_size
+    max_workers = knms_max_workers if max_workers is None else max_workers
+    timeout = knms_timeout if timeout is None else timeout
+    retries = knms_retries if retries is None else retries
+
+    batches = [names[i:i + batch_size] for i in range(0, len(names), batch_size)]
+    rate_limit = _RateLimit()
+    with _knms_session(max_workers) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda batch: _match_knms_batch(session, batch, url, timeout, retries,
+                                                                    rate_limit), batches))
+    failures = [f for _, batch_failures in results for f in batch_failures]
+    records = pd.concat([batch_records for batch_records, _ in results])
+    if len(failures) > 0 and len(records.index) == 0:
+        raise ConnectionError(f'KNMS requests failed ({failures[0][0]})')
+    return records.reset_index(drop=True), [n for _, failed_names in failures for n in failed_names]
+
+
+def _knms_cache_path() -> str:
+    return os.path.join(knms_outputs_dir, _knms_cache_file)
+
+
+@contextlib.contextmanager
+def _knms_database():
+    os.makedirs(knms_outputs_dir, exist_ok=True)
+    connection = sqlite3.connect(_knms_cache_path(), timeout=60)
+    try:
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS knms_matches (submitted TEXT PRIMARY KEY, '
+                               'records TEXT NOT NULL, fetched REAL NOT NULL, last_used REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS knms_matches_last_used ON knms_matches (last_used)')
+        yield connection
+    finally:
+        connection.close()
+
+
+def _put_knms_records(connection: sqlite3.Connection, records: pd.DataFrame, fetched: float):
+    # The records of each submitted name are stored together, as a list of rows
+    name_rows = {}
+    for r in records[knms_record_columns].itertuples(index=False, name=None):
+        name_rows.setdefault(str(r[0]), []).append([None if pd.isna(v) else str(v) for v in r])
+    now = time.time()
+    connection.executemany('INSERT OR REPLACE INTO knms_matches VALUES (?, ?, ?, ?)',
+                           [(n, json.dumps(rows), fetched, now) for n, rows in name_rows.items()])
+
+
+def _remove_stale_knms_records(connection: sqlite3.Connection):
+    connection.execute('DELETE FROM knms_matches WHERE fetched < ?', (time.time() - knms_cache_ttl,))
+    number_cached = connection.execute('SELECT COUNT(*) FROM knms_matches').fetchone()[0]
+    if number_cached > max_cached_knms_names:
+        connection.execute('DELETE FROM knms_matches WHERE rowid IN (SELECT rowid FROM knms_matches '
+                           'ORDER BY last_used LIMIT ?)', (number_cached - max_cached_knms_names,))
+
+
+def _ingest_legacy_knms_csvs(connection: sqlite3.Connection):
+    # Records cached by older versions in a csv per call are moved into the database
+    for f in sorted(os.listdir(knms_outputs_dir)):
+        if f.startswith(_legacy_knms_cache_tag) and f.endswith('.csv'):
+            csv_path = os.path.join(knms_outputs_dir, f)
+            try:
+                # Pandas will read TRUE/true as bools and therefore as True rather than true
+                records = pd.read_csv(csv_path, dtype={'match_state': str}, index_col=0)
+                with connection:
+                    _put_knms_records(connection, records, os.path.getmtime(csv_path))
+                os.remove(csv_path)
+            except (OSError, ValueError, KeyError) as e:
+                print(f'WARNING: Could not read stored KNMS matches ({e}): {csv_path}')
+
+
+def _read_cached_knms_records(names: List[str]) -> Tuple[pd.DataFrame, List[str]]:
+    """
+    Looks up the stored KNMS records of the names, ignoring those older than knms_cache_ttl.
     :param names:
-    :return:
+    :return: The stored records, and the names which weren't found
     """
     try:
-        os.mkdir(temp_outputs_dir)
-    except FileExistsError as error:
-        pass
+        with _knms_database() as connection:
+            _ingest_legacy_knms_csvs(connection)
+            connection.execute('CREATE TEMP TABLE lookup (submitted TEXT PRIMARY KEY)')
+            connection.executemany('INSERT OR IGNORE INTO lookup VALUES (?)', [(n,) for n in names])
+            found = connection.execute(
+                'SELECT knms_matches.submitted, knms_matches.records FROM lookup JOIN knms_matches ON '
+                'knms_matches.submitted = lookup.submitted WHERE knms_matches.fetched >= ? ORDER BY lookup.rowid',
+                (time.time() - knms_cache_ttl,)).fetchall()
+            with connection:
+                connection.execute('UPDATE knms_matches SET last_used = ? WHERE submitted IN '
+                                   '(SELECT submitted FROM lookup)', (time.time(),))
+    except sqlite3.Error as e:
+        print(f'WARNING: Could not read stored KNMS matches ({e}): {_knms_cache_path()}')
+        found = []
+    records = pd.DataFrame([r for _, name_rows in found for r in json.loads(name_rows)],
+                           columns=knms_record_columns)
+    # Missing values are stored as null
+    records = records.where(records.notna(), np.nan)
+    known_names = set(n for n, _ in found)
+    return records, [n for n in names if n not in known_names]
 
+
+def _write_cached_knms_records(records: pd.DataFrame):
     try:
-        os.mkdir(knms_outputs_dir)
-    except FileExistsError as error:
-        pass
-
-    unique_name_list = list(np.unique(names))
-
-    temp_file_tag = 'knms_matches_cache_'
-    existing_df = None
-    existing_info = []
-    for temp_cl_file in os.listdir(knms_outputs_dir):
-        if temp_cl_file.startswith(temp_file_tag):
-            # Pandas will read TRUE/true as bools and therefore as True rather than true
-            existing_info.append(pd.read_csv(os.path.join(knms_outputs_dir, temp_cl_file), dtype={'match_state': str}, index_col=0))
-    if len(existing_info) > 0:
-        existing_df = pd.concat(existing_info)
-
-        already_known_names = existing_df['submitted'].tolist()
-        # remove the item for all its occurrences
-        for alread_known in already_known_names:
-            c = unique_name_list.count(alread_known)
-            for i in range(c):
-                unique_name_list.remove(alread_known)
-    if len(unique_name_list) > 0:
-        knms_url = "http://namematch.science.kew.org/api/v2/powo/match"
-        res = requests.post(knms_url, json=unique_name_list)
-        headings = ['submitted', 'match_state', 'ipni_id', 'matched_name']
-
-        if res.status_code == 500:
-            print('Possibly from non-latin scripts in names')
-            print(unique_name_list)
-            raise ValueError('Internal Server error from KNMS.')
-        elif res.status_code == 429:
-            raise ConnectionRefusedError('KNMS Rate limiting')
-
-        elif res.status_code == 504:
-            raise TimeoutError('Network Timedout (possibly due to lots of names)')
+        with _knms_database() as connection:
+            with connection:
+                _put_knms_records(connection, records, time.time())
+                _remove_stale_knms_records(connection)
+    except sqlite3.Error as e:
+        print(f'WARNING: Could not store KNMS matches ({e}): {_knms_cache_path()}')
+
+
+def get_knms_name_matches(names: List[str], batch_size: int = None, max_workers: int = None) -> pd.DataFrame:
+    """
+    Searches knms for matching names. Names are sent in batches of batch_size, max_workers batches at a time, and
+    batches which fail are retried or split up, so that names which can't be matched don't stop the others being
+    matched. Records are stored for each name, and names searched for in the last knms_cache_ttl seconds aren't
+    searched for again.
+    :param names:
+    :param batch_size: Defaults to knms_batch_size
+    :param max_workers: Defaults to knms_max_workers
+    :return: The records of the names, with the names which couldn't be matched because their requests failed (or
+    whose records weren't stored) in records.attrs[knms_failed_names_attr]
+    """
+    unique_name_list = [str(n) for n in np.unique(names)]
+    cached_records, new_names = _read_cached_knms_records(unique_name_list)
+    failed_names = []
+    if len(new_names) > 0:
+        records, failed_names = _get_knms_records(new_names, batch_size=batch_size, max_workers=max_workers)
 
+        if (records['match_state'] == 'false').all():
+            print('All KNMS records return false. Not saving these records as this sometimes indicates server issues.')
+            failed_names = new_names
         else:
-            content = json.loads(res.content.decode('utf-8'))
-            try:
-                if all(len(content["records"][x]) == 2 for x in range(len(content["records"]))):
-                    shortened_headings = ['submitted', 'match_state']
-                    records = pd.DataFrame(content["records"], columns=shortened_headings)
-                    records['ipni_id'] = np.nan
-                    records['matched_name'] = np.nan
-                else:
-                    records = pd.DataFrame(content["records"], columns=headings)
-            except ValueError:
-                raise requests.ConnectionError('records not retrieved due to server error')
-            records.replace('', np.nan, inplace=True)
-            records['submitted'].ffill(inplace=True)
-            records['match_state'].ffill(inplace=True)
-
-            if (records['match_state'] == 'false').all():
-                print('All KNMS records return false. Not saving these records as this sometimes indicates server issues.')
-            else:
-                str_to_hash = str(unique_name_list).encode()
-                temp_output_knms_csv = os.path.join(knms_outputs_dir, temp_file_tag + str(hashlib.md5(str_to_hash).hexdigest()) + ".csv")
-                records.to_csv(temp_output_knms_csv)
-            if existing_df is not None:
-                records = pd.concat([records, existing_df])
+            _write_cached_knms_records(records)
+        if len(cached_records.index) > 0:
+            records = pd.concat([records, cached_records])
     else:
-        print(f'Already searched for these name in KNMS. Returning records from cache directory: {knms_outputs_dir}')
-        records = existing_df
+        print(f'Already searched for these name in KNMS. Returning records from cache: {_knms_cache_path()}')
+        records = cached_records
+    records = records.reset_index(drop=True)
+    records.attrs[knms_failed_names_attr] = failed_names
     return records
 
 
 def clear_stored_knms_matches():
+    """
+    Removes all stored KNMS records.
+    :return:
+    """
+    if not os.path.isdir(knms_outputs_dir):
+        return
     for f in os.listdir(knms_outputs_dir):
         os.remove(os.path.join(knms_outputs_dir, f))
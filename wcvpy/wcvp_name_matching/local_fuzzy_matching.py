@@ -0,0 +1,248 @@
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from wcvpy.wcvp_download import get_all_taxa, wcvp_columns
+from wcvpy.wcvp_download.checklist_cache import checklist_cache_attr
+from wcvpy.wcvp_download.checklist_registry import checklist_registry
+from wcvpy.wcvp_name_matching import output_record_col_names, resolve_matches_by_priorities
+from wcvpy.wcvp_name_matching.match_index import get_match_index, match_keys, tidy_values_for_matching_in_column
+from wcvpy.wcvp_name_matching.wcvp_matching import _find_taxa_with_keys, _family_filter
+
+# Maximum number of edits (insertions, deletions and substitutions of characters) between a name and its local fuzzy
+# matches
+local_fuzzy_max_distance = 2
+
+# Key of the word index of a cached checklist in checklist_registry
+_word_index_key = 'local fuzzy word index'
+
+
+def _trigrams(word: str) -> set:
+    padded = '$' + word + '$'
+    return {padded[i:i + 3] for i in range(max(len(padded) - 2, 1))}
+
+
+def _bit_parallel_distances(column_matches, word_lengths: np.ndarray, candidate_lengths: np.ndarray,
+                            number_of_columns: int) -> np.ndarray:
+    """
+    Levenshtein distances between pairs of words and candidates, calculated for all pairs at once with Myers'
+    bit-parallel algorithm. Words must be between 1 and 63 characters long.
+    :param column_matches: function giving, for a column of the candidates, the positions in each word of the
+    character in that column of its candidate, as a bitmask
+    :param word_lengths:
+    :param candidate_lengths:
+    :param number_of_columns: Length of the longest candidate
+    :return:
+    """
+    one = np.uint64(1)
+    word_mask = (one << word_lengths.astype(np.uint64)) - one
+    last_bit = one << (word_lengths.astype(np.uint64) - one)
+
+    vertical_plus = word_mask.copy()
+    vertical_minus = np.zeros(len(candidate_lengths), dtype=np.uint64)
+    distances = word_lengths.astype(np.int64)
+    for j in range(number_of_columns):
+        matches = column_matches(j)
+        x_vertical = matches | vertical_minus
+        x_horizontal = ((((matches & vertical_plus) + vertical_plus) & word_mask) ^ vertical_plus) | matches
+        horizontal_plus = vertical_minus | (~(x_horizontal | vertical_plus) & word_mask)
+        horizontal_minus = vertical_plus & x_horizontal
+        # Distances stop changing after the end of each candidate
+        in_candidate = j < candidate_lengths
+        distances += in_candidate & ((horizontal_plus & last_bit) != 0)
+        distances -= in_candidate & ((horizontal_minus & last_bit) != 0)
+        horizontal_plus = ((horizontal_plus << one) | one) & word_mask
+        horizontal_minus = (horizontal_minus << one) & word_mask
+        vertical_plus = horizontal_minus | (~(x_vertical | horizontal_plus) & word_mask)
+        vertical_minus = horizontal_plus & x_vertical
+    return distances
+
+
+def _edit_distances(word: str, candidates: np.ndarray, candidate_lengths: np.ndarray) -> np.ndarray:
+    """
+    Levenshtein distances between the word and each of the candidates. The word must be shorter than 64 characters.
+    :param word:
+    :param candidates: Unicode code points of each candidate, padded with zeros
+    :param candidate_lengths:
+    :return:
+    """
+    # Positions of each character in the word, as a bitmask
+    char_masks = {}
+    for i, char in enumerate(word):
+        char_masks[ord(char)] = char_masks.get(ord(char), 0) | (1 << i)
+
+    def column_matches(j):
+        matches = np.zeros(len(candidates), dtype=np.uint64)
+        for code, char_mask in char_masks.items():
+            matches[candidates[:, j] == code] |= np.uint64(char_mask)
+        return matches
+
+    return _bit_parallel_distances(column_matches, np.full(len(candidates), len(word), dtype=np.int64),
+                                   candidate_lengths, candidates.shape[1])
+
+
+def _allowed_edits(word: str, max_distance: int) -> int:
+    # Short words, e.g. rank abbreviations, must match exactly
+    if len(word) >= 64:
+        return 0
+    return min(max_distance, len(word) // 4)
+
+
+class _WordIndex:
+    """
+    Trigram inverted index of the words in the (tidied) names of a checklist, used to find the words within a given
+    edit distance of a word.
+    """
+
+    def __init__(self, names: pd.Series):
+        self.words = pd.Index(names.str.split().explode().dropna().unique())
+        self.lengths = np.array([len(w) for w in self.words], dtype=np.int64)
+        # Unicode code points of the words, padded with zeros
+        self._chars = np.array(self.words, dtype=str).view(np.uint32).reshape(len(self.words), -1)
+        word_trigrams = [_trigrams(w) for w in self.words]
+        self.trigram_counts = np.array([len(t) for t in word_trigrams], dtype=np.int64)
+        trigram_codes, trigrams = pd.factorize(pd.Series([t for trigrams in word_trigrams for t in trigrams],
+                                                         dtype=object))
+        self.trigrams = pd.Index(trigrams)
+        word_ids = np.repeat(np.arange(len(self.words)), self.trigram_counts)
+        order = np.argsort(trigram_codes, kind='stable')
+        self._postings = word_ids[order]
+        self._offsets = np.searchsorted(trigram_codes[order], np.arange(len(self.trigrams) + 1))
+
+    def similar_words(self, word: str, max_edits: int) -> List[Tuple[str, int]]:
+        """
+        Finds the words in the index within max_edits of the given word.
+        :param word:
+        :param max_edits:
+        :return: The words and their edit distance from the given word, ordered by distance
+        """
+        if max_edits == 0:
+            return [(word, 0)] if word in self.words else []
+        word_trigrams = _trigrams(word)
+        trigram_ids = self.trigrams.get_indexer(list(word_trigrams))
+        trigram_ids = trigram_ids[trigram_ids >= 0]
+        if len(trigram_ids) == 0:
+            return []
+        postings = np.concatenate([self._postings[self._offsets[t]:self._offsets[t + 1]] for t in trigram_ids])
+        word_ids, shared = np.unique(postings, return_counts=True)
+        # Each edit changes at most three trigrams of each word
+        is_candidate = (shared >= np.maximum(self.trigram_counts[word_ids], len(word_trigrams)) - 3 * max_edits) & (
+                np.abs(self.lengths[word_ids] - len(word)) <= max_edits)
+        word_ids = word_ids[is_candidate]
+        lengths = self.lengths[word_ids]
+        distances = _edit_distances(word, self._chars[word_ids, :lengths.max(initial=0)], lengths)
+        similar = distances <= max_edits
+        order = np.argsort(distances[similar], kind='stable')
+        return list(zip(self.words[word_ids[similar][order]], distances[similar][order].tolist()))
+
+
+def _word_index(all_taxa: pd.DataFrame, taxa_positions: np.ndarray) -> _WordIndex:
+    cache_path, _ = all_taxa.attrs.get(checklist_cache_attr, (None, None))
+    # The index is only kept for whole checklists, rather than ones which have been filtered
+    is_whole_checklist = cache_path is not None and bool((taxa_positions >= 0).all())
+    if is_whole_checklist:
+        word_index = checklist_registry.lookup_index(cache_path, _word_index_key)
+        if word_index is not None:
+            return word_index
+    word_index = _WordIndex(match_keys(all_taxa, ()))
+    if is_whole_checklist:
+        checklist_registry.register_index(cache_path, _word_index_key, word_index)
+    return word_index
+
+
+def _names_within_distance(word_options: List[List[Tuple[str, int]]], max_distance: int) -> Iterator[
+    Tuple[str, int]]:
+    # Names made of one of the options for each word, with a total distance of at most max_distance
+    if len(word_options) == 0:
+        yield '', 0
+        return
+    for word, distance in word_options[0]:
+        if distance > max_distance:
+            break
+        for rest, rest_distance in _names_within_distance(word_options[1:], max_distance - distance):
+            yield (word + ' ' + rest).strip(), distance + rest_distance
+
+
+def get_local_fuzzy_matches(df: pd.DataFrame, matching_name_col: str, unique_submission_id_col: str,
+                            all_taxa: pd.DataFrame = None, family_column: str = None,
+                            max_distance: int = local_fuzzy_max_distance, wcvp_version: str = None) -> pd.DataFrame:
+    """
+    Finds the taxa with names within max_distance edits of the names in matching_name_col, without using any
+    online services. Each word of a name is matched to the words of the checklist names, using a trigram index of
+    these words, and the names made from the closest words are then looked up in the checklist. Names are compared
+    in lower case and without fullstops, and words of fewer than 4 characters must match exactly.
+    :param df:
+    :param matching_name_col:
+    :param unique_submission_id_col:
+    :param all_taxa:
+    :param family_column: if given, only taxa in the family of each name (as their family or accepted family) are
+    matched
+    :param max_distance:
+    :param wcvp_version:
+    :return: All matches of each submission, with their edit distance and a score from 0 to 1, where 1 is the same
+    name
+    """
+    if all_taxa is None:
+        all_taxa = get_all_taxa(version=wcvp_version)
+    match_index, taxa_positions = get_match_index(all_taxa, [()])
+    word_index = _word_index(all_taxa, taxa_positions)
+
+    names = tidy_values_for_matching_in_column(df[matching_name_col]).to_numpy(dtype=object)
+    similar_words = {}
+    name_positions = []
+    candidate_names = []
+    distances = []
+    for position, name in enumerate(names):
+        if pd.isna(name):
+            continue
+        word_options = []
+        for word in name.split():
+            if word not in similar_words:
+                similar_words[word] = word_index.similar_words(word, _allowed_edits(word, max_distance))
+            word_options.append(similar_words[word])
+        for candidate_name, distance in _names_within_distance(word_options, max_distance):
+            name_positions.append(position)
+            candidate_names.append(candidate_name)
+            distances.append(distance)
+    candidate_names = pd.Series(candidate_names, dtype=object)
+
+    candidate_positions, taxa_rows = _find_taxa_with_keys(candidate_names, all_taxa, match_index, taxa_positions, ())
+    name_positions = np.array(name_positions, dtype=np.int64)[candidate_positions]
+    distances = np.array(distances, dtype=np.int64)[candidate_positions]
+    if family_column is not None:
+        in_family = _family_filter(df, family_column, all_taxa, name_positions, taxa_rows)
+        name_positions, taxa_rows, distances = name_positions[in_family], taxa_rows[in_family], distances[in_family]
+        candidate_positions = candidate_positions[in_family]
+
+    match_df = pd.concat([df[[unique_submission_id_col]].iloc[name_positions].reset_index(drop=True),
+                          all_taxa[output_record_col_names + [wcvp_columns['family'], wcvp_columns['rank']]].iloc[
+                              taxa_rows].reset_index(drop=True)], axis=1)
+    match_df['matched_name'] = all_taxa[wcvp_columns['name']].to_numpy(dtype=object)[taxa_rows]
+    match_df['edit_distance'] = distances
+    # Distances relative to the length of the longer of the two names
+    name_lengths = np.maximum(np.array([len(n) for n in names[name_positions]], dtype=np.int64),
+                              candidate_names.iloc[candidate_positions].str.len().to_numpy(dtype=np.int64))
+    match_df['fuzzy_score'] = 1 - distances / np.maximum(name_lengths, 1)
+    return match_df
+
+
+def resolve_local_fuzzy_matches(match_df: pd.DataFrame, unique_submission_id_col: str) -> pd.DataFrame:
+    """
+    Resolves the matches from get_local_fuzzy_matches to the closest match of each submission, using status and
+    then rank priority where there are several.
+    :param match_df:
+    :param unique_submission_id_col:
+    :return:
+    """
+    closest = match_df[match_df['edit_distance'] == match_df.groupby(unique_submission_id_col)[
+        'edit_distance'].transform('min')]
+    # Appropriately label unique matches
+    matched_by = np.where(closest.duplicated(keep=False, subset=[unique_submission_id_col]), 'local_fuzzy',
+                          'local_fuzzy_unique')
+    closest = closest.assign(matched_by=matched_by)
+    resolved_df = resolve_matches_by_priorities(closest, unique_submission_id_col, ['status', 'rank'])
+    resolved_df = resolved_df.sort_index()
+    for c in [wcvp_columns['status'], wcvp_columns['rank']]:
+        resolved_df[c] = resolved_df[c].astype(object)
+    return resolved_df
@@ -0,0 +1,404 @@
+import os
+import weakref
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from wcvpy.wcvp_download import wcvp_columns, wcvp_accepted_columns, clean_whitespaces_in_column
+from wcvpy.wcvp_download.checklist_cache import checklist_cache_attr, match_index_cache_path, read_match_index, \
+    write_match_index, read_parsed_checklist
+from wcvpy.wcvp_download.checklist_registry import checklist_registry
+from wcvpy.wcvp_download.file_lock import file_lock
+from wcvpy.wcvp_name_matching.general_matching_utils import status_priority
+
+# Columns added to taxon names to make the keys used in direct matching, in the order the keys are tried
+match_key_columns = [(wcvp_columns['authors'],),
+                     (wcvp_columns['paranthet_author'], wcvp_columns['primary_author']),
+                     (wcvp_columns['primary_author'],),
+                     ()]
+
+def tidy_values_for_matching_in_column(column: pd.Series) -> pd.Series:
+    """
+    Column version of tidy_value_for_matching.
+    :param column:
+    :return:
+    """
+    lower = column.astype(object).str.lower()
+    without_fullstop = lower.str.replace('.', '', regex=False)
+    return clean_whitespaces_in_column(without_fullstop)
+
+
+def match_keys(taxa: pd.DataFrame, columns: Tuple[str, ...]) -> pd.Series:
+    """
+    Tidied taxon names followed by the given columns, as used to match names to the taxa. Taxa missing a value in
+    any of the columns don't have a key and are left out.
+    :param taxa:
+    :param columns:
+    :return:
+    """
+    taxa_with_columns = taxa.dropna(subset=list(columns))
+    keys = taxa_with_columns[wcvp_columns['name']].astype(object)
+    for c in columns:
+        keys = keys + ' ' + taxa_with_columns[c].astype(object)
+    return tidy_values_for_matching_in_column(keys)
+
+
+def hash_keys(keys) -> np.ndarray:
+    return pd.util.hash_array(np.asarray(keys, dtype=object))
+
+
+def _combine_hashes(key_hashes: np.ndarray, family_hashes: np.ndarray) -> np.ndarray:
+    # Hashes of (key, family) pairs
+    return (key_hashes * np.uint64(0x9E3779B97F4A7C15)) ^ family_hashes
+
+
+def _group_starts(sorted_hashes: np.ndarray) -> np.ndarray:
+    if len(sorted_hashes) == 0:
+        return np.array([], dtype=np.int64)
+    return np.flatnonzero(np.r_[True, sorted_hashes[1:] != sorted_hashes[:-1]])
+
+
+def _lookup(sorted_hashes: np.ndarray, hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Positions in hashes of those found in sorted_hashes, and where they were found
+    found_at = np.searchsorted(sorted_hashes, hashes)
+    found = found_at < len(sorted_hashes)
+    found[found] = sorted_hashes[found_at[found]] == hashes[found]
+    return np.flatnonzero(found), found_at[found]
+
+
+def _resolve_groups(hashes: np.ndarray, values: np.ndarray, rows: np.ndarray, priorities: np.ndarray,
+                    unknown_status: np.ndarray):
+    """
+    Groups rows by hash, and resolves each group to its best row by status priority and then checklist order.
+    :param hashes:
+    :param values: The values hashed, to find groups with hash collisions
+    :param rows:
+    :param priorities:
+    :param unknown_status: Whether the status of each row is missing from status_priority
+    :return: Sorted unique hashes, the best row and size of each group, and whether each group can't be resolved in
+    advance because it has an unknown status or a hash collision.
+    """
+    order = np.lexsort((rows, priorities, hashes))
+    hashes = hashes[order]
+    values = values[order]
+    starts = _group_starts(hashes)
+    sizes = np.diff(np.append(starts, len(hashes)))
+    group_ids = np.repeat(np.arange(len(starts)), sizes)
+    is_start = np.full(len(hashes), False)
+    is_start[starts] = True
+    collision = np.r_[False, values[1:] != values[:-1]] & ~is_start if len(hashes) > 0 else is_start
+    unresolvable = np.bincount(group_ids, weights=unknown_status[order] | collision, minlength=len(starts)) > 0
+    return hashes[starts], rows[order][starts].astype(np.int32), sizes.astype(np.int32), unresolvable
+
+
+def _row_hashes(taxa: pd.DataFrame, columns: List[str]) -> np.ndarray:
+    # Hashes of the values of the given columns in each row
+    row_hashes = hash_keys(taxa[columns[0]])
+    for c in columns[1:]:
+        row_hashes = _combine_hashes(row_hashes, hash_keys(taxa[c]))
+    return row_hashes
+
+
+def _column_arrays(taxa: pd.DataFrame, columns: List[str]) -> list:
+    # The arrays holding the values of the columns, and where the values start in them, which change when columns
+    # are replaced or copied on write
+    arrays = []
+    for c in columns:
+        values = taxa[c].values
+        start = None
+        if isinstance(values, np.ndarray):
+            start = values.__array_interface__['data'][0]
+            while isinstance(values.base, np.ndarray):
+                values = values.base
+        arrays.append((values, start))
+    return arrays
+
+
+class MatchIndex:
+    """
+    For each combination of columns in match_key_columns, maps the hash of each match key to the positions of the
+    taxa in the checklist with that key. The index labels and hashes of the values the index depends on (taxon names,
+    the key columns and, with resolve_best, statuses and families) are kept to find the given taxa in the index and
+    check they are unchanged from the checklist the index was built from.
+
+    Keys are stored as hashes to keep the index small, so lookups need checking against the taxa they return.
+
+    When built with resolve_best, the index also stores the best taxon (by status_priority and then checklist order)
+    for each key, and for each key and family of keys with more than one taxon, so that the best match for a name can
+    be found without looking at all its candidates.
+    """
+    # Increase when the contents change, so that indexes cached by older versions are rebuilt
+    format_version = 3
+
+    def __init__(self, taxa: pd.DataFrame, key_columns: List[Tuple[str, ...]], resolve_best: bool = False):
+        self.format_version = MatchIndex.format_version
+        self.labels = taxa.index
+        checked_columns = [wcvp_columns['name']] + [c for columns in key_columns for c in columns]
+        if resolve_best:
+            checked_columns += [wcvp_columns['status'], wcvp_columns['family'], wcvp_accepted_columns['family']]
+        self.checked_columns = list(dict.fromkeys(checked_columns))
+        self.row_hashes = _row_hashes(taxa, self.checked_columns)
+        self.status_priority = list(status_priority) if resolve_best else None
+        self._key_hashes = {}
+        self._key_offsets = {}
+        self._key_rows = {}
+        self._key_best = {}
+        self._key_unresolvable = {}
+        self._family_key_hashes = {}
+        self._family_best = {}
+        self._family_counts = {}
+        self._family_unresolvable = {}
+        if resolve_best:
+            priorities = taxa[wcvp_columns['status']].map({s: i for i, s in enumerate(status_priority)})
+            unknown_status = priorities.isna().to_numpy()
+            priorities = priorities.fillna(len(status_priority)).to_numpy(dtype=np.int64)
+            families = taxa[wcvp_columns['family']].to_numpy(dtype=object)
+            accepted_families = taxa[wcvp_accepted_columns['family']].to_numpy(dtype=object)
+        for columns in key_columns:
+            keys = match_keys(taxa, columns)
+            has_columns = taxa[list(columns)].notna().all(axis=1).to_numpy() if columns else np.full(len(self), True)
+            positions = np.flatnonzero(has_columns)
+            hashes = hash_keys(keys)
+            order = self._add_keys(columns, hashes, positions)
+            if resolve_best:
+                keys = keys.to_numpy(dtype=object)
+                _, self._key_best[columns], sizes, self._key_unresolvable[columns] = _resolve_groups(
+                    hashes, keys, positions, priorities[positions], unknown_status[positions])
+
+                # Keys of more than one taxon are also resolved within each family of their taxa
+                shared = np.repeat(sizes, sizes)[np.argsort(order)] > 1
+                shared_rows = positions[shared]
+                pair_families = np.concatenate([families[shared_rows], accepted_families[shared_rows]])
+                pair_rows = np.concatenate([shared_rows, shared_rows])
+                pair_keys = np.concatenate([keys[shared], keys[shared]])
+                pair_key_hashes = np.concatenate([hashes[shared], hashes[shared]])
+                # Taxa are only counted once in a family
+                is_pair = pd.notna(pair_families) & np.r_[np.full(len(shared_rows), True),
+                                                          accepted_families[shared_rows] != families[shared_rows]]
+                pair_families = pair_families[is_pair]
+                (self._family_key_hashes[columns], self._family_best[columns], self._family_counts[columns],
+                 self._family_unresolvable[columns]) = _resolve_groups(
+                    _combine_hashes(pair_key_hashes[is_pair], hash_keys(pair_families)),
+                    pair_keys[is_pair] + '|' + pair_families, pair_rows[is_pair], priorities[pair_rows[is_pair]],
+                    unknown_status[pair_rows[is_pair]])
+
+    def _add_keys(self, columns: Tuple[str, ...], hashes: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        # Stores the positions of the taxa with each key hash, returning the order the keys are stored in
+        order = np.lexsort((positions, hashes))
+        sorted_hashes = hashes[order]
+        key_starts = _group_starts(sorted_hashes)
+        self._key_hashes[columns] = sorted_hashes[key_starts]
+        self._key_offsets[columns] = np.append(key_starts, len(sorted_hashes)).astype(np.int64)
+        self._key_rows[columns] = positions[order].astype(np.int32)
+        return order
+
+    def __len__(self):
+        return len(self.row_hashes)
+
+    def has_key_columns(self, columns: Tuple[str, ...]) -> bool:
+        return columns in self._key_hashes
+
+    def candidates(self, columns: Tuple[str, ...], key_hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the taxa whose match key, made with the given columns, has one of the given hashes.
+        :param columns:
+        :param key_hashes:
+        :return: Positions in key_hashes and the positions of the matching taxa, ordered by position in key_hashes
+        and then by position in the checklist.
+        """
+        offsets = self._key_offsets[columns]
+        queries, found_at = _lookup(self._key_hashes[columns], key_hashes)
+        starts = offsets[found_at]
+        counts = offsets[found_at + 1] - starts
+        query_positions = np.repeat(queries, counts)
+        # Positions of each key's taxa in the key_rows
+        row_positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return query_positions, self._key_rows[columns][row_positions]
+
+    def resolves_best(self, taxa_positions: np.ndarray) -> bool:
+        """
+        Whether the best matches stored in the index can be used for the taxa at the given positions, i.e. the index
+        was built with them using the current status_priority and all of the taxa in the index are included.
+        :param taxa_positions: As returned by positions_in
+        :return:
+        """
+        return self.status_priority == status_priority and bool((taxa_positions >= 0).all())
+
+    def best_matches(self, columns: Tuple[str, ...], key_hashes: np.ndarray):
+        """
+        Finds the best taxon for each of the given key hashes, made with the given columns.
+        :param columns:
+        :param key_hashes:
+        :return: Positions in key_hashes which were found, the position of their best taxon and the number of taxa
+        with the key. None if any of them can't be resolved in advance, when all of the candidates are needed.
+        """
+        queries, found_at = _lookup(self._key_hashes[columns], key_hashes)
+        if self._key_unresolvable[columns][found_at].any():
+            return None
+        offsets = self._key_offsets[columns]
+        return queries, self._key_best[columns][found_at], offsets[found_at + 1] - offsets[found_at]
+
+    def best_matches_in_families(self, columns: Tuple[str, ...], key_hashes: np.ndarray,
+                                 family_hashes: np.ndarray):
+        """
+        As best_matches, but only for taxa with the given families as their family or accepted family. For keys of
+        a single taxon, the taxon is returned whatever its family, so results should be checked against the family.
+        :param columns:
+        :param key_hashes:
+        :param family_hashes:
+        :return:
+        """
+        matches = self.best_matches(columns, key_hashes)
+        if matches is None:
+            return None
+        queries, rows, counts = matches
+        single = counts == 1
+        shared = ~single
+        pair_queries, found_at = _lookup(self._family_key_hashes[columns],
+                                         _combine_hashes(key_hashes[queries[shared]],
+                                                         family_hashes[queries[shared]]))
+        if self._family_unresolvable[columns][found_at].any():
+            return None
+        queries = np.concatenate([queries[single], queries[shared][pair_queries]])
+        order = np.argsort(queries, kind='stable')
+        rows = np.concatenate([rows[single], self._family_best[columns][found_at]])
+        counts = np.concatenate([counts[single], self._family_counts[columns][found_at]])
+        return queries[order], rows[order], counts[order]
+
+    def __getstate__(self):
+        # The taxa last found in the index aren't stored with it
+        state = self.__dict__.copy()
+        state.pop('_found_taxa', None)
+        return state
+
+    def _found_positions(self, taxa: pd.DataFrame, arrays: list) -> np.ndarray:
+        # Positions from the last call of positions_in, if it was given the same frame with the same index, columns
+        # and cache attr
+        found_taxa = getattr(self, '_found_taxa', None)
+        if found_taxa is None:
+            return None
+        taxa_ref, index, cache_attr, array_refs, positions = found_taxa
+        if taxa_ref() is not taxa or index is not taxa.index or cache_attr != taxa.attrs.get(checklist_cache_attr):
+            return None
+        if not all(ref() is values and found_start == start for (ref, found_start), (values, start) in
+                   zip(array_refs, arrays)):
+            return None
+        return positions
+
+    def positions_in(self, taxa: pd.DataFrame) -> np.ndarray:
+        """
+        Returns the position in taxa of each taxon in the index, or -1 for taxa not included. Returns None if taxa
+        isn't (a subset of) the checklist the index was built from, or any of the values the index depends on have
+        been changed.
+
+        Checking the values means hashing the checked columns of all of taxa, so the positions are kept for the last
+        frame given and reused while none of its checked columns are replaced. Frames edited in place after being
+        matched should be copied before matching them again.
+        :param taxa:
+        :return:
+        """
+        if not taxa.index.is_unique or not all(c in taxa.columns for c in self.checked_columns):
+            return None
+        arrays = _column_arrays(taxa, self.checked_columns)
+        positions = self._found_positions(taxa, arrays)
+        if positions is not None:
+            return positions
+        index_positions = self.labels.get_indexer(taxa.index)
+        if (index_positions < 0).any():
+            return None
+        if not np.array_equal(self.row_hashes[index_positions], _row_hashes(taxa, self.checked_columns)):
+            return None
+        positions = np.full(len(self), -1, dtype=np.int64)
+        positions[index_positions] = np.arange(len(index_positions))
+        try:
+            array_refs = [(weakref.ref(values), start) for values, start in arrays]
+            self._found_taxa = (weakref.ref(taxa), taxa.index, taxa.attrs.get(checklist_cache_attr), array_refs,
+                                positions)
+        except TypeError:
+            # Arrays which can't be weakly referenced aren't kept track of
+            self._found_taxa = None
+        return positions
+
+
+def _is_full_cached_checklist(taxa: pd.DataFrame, number_of_taxa: int) -> bool:
+    key_columns = [wcvp_columns['name'], wcvp_columns['status'], wcvp_columns['family'],
+                   wcvp_accepted_columns['family']] + [c for columns in match_key_columns for c in columns]
+    return len(taxa.index) == number_of_taxa and all(c in taxa.columns for c in key_columns)
+
+
+def _read_match_index(index_path: str, index_type: type = MatchIndex) -> MatchIndex:
+    match_index = read_match_index(index_path)
+    if not isinstance(match_index, index_type) or getattr(match_index, 'format_version',
+                                                          None) != index_type.format_version:
+        return None
+    return match_index
+
+
+def _cached_index(taxa: pd.DataFrame, index_type: type, index_path_for, build_index) -> MatchIndex:
+    """
+    Returns the index of the given type of the cached checklist that taxa was loaded from, building it with
+    build_index and caching it at index_path_for(cache path of the checklist) if necessary. Returns None if taxa
+    isn't from a cached checklist.
+    :param taxa:
+    :param index_type:
+    :param index_path_for:
+    :param build_index:
+    :return:
+    """
+    cache_path, number_of_taxa = taxa.attrs.get(checklist_cache_attr, (None, None))
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    index_path = index_path_for(cache_path)
+    match_index = checklist_registry.lookup_index(cache_path, index_path)
+    if match_index is None:
+        match_index = _read_match_index(index_path, index_type)
+        if match_index is None:
+            # Only one process builds the index, others wait and then read it
+            with file_lock(index_path):
+                match_index = _read_match_index(index_path, index_type)
+                if match_index is None:
+                    if _is_full_cached_checklist(taxa, number_of_taxa):
+                        checklist = taxa
+                    else:
+                        checklist = read_parsed_checklist(cache_path)
+                        if checklist is None:
+                            return None
+                    print(f'Building name matching index for: {cache_path}')
+                    match_index = build_index(checklist)
+                    write_match_index(match_index, index_path)
+        checklist_registry.register_index(cache_path, index_path, match_index)
+    return match_index
+
+
+def _cached_match_index(taxa: pd.DataFrame) -> MatchIndex:
+    """
+    Returns the match index of the cached checklist that taxa was loaded from, building and caching it next to the
+    checklist if necessary. Returns None if taxa isn't from a cached checklist.
+    :param taxa:
+    :return:
+    """
+    return _cached_index(taxa, MatchIndex, match_index_cache_path,
+                         lambda checklist: MatchIndex(checklist, match_key_columns, resolve_best=True))
+
+
+def get_match_index(taxa: pd.DataFrame, key_columns: List[Tuple[str, ...]] = None) -> Tuple[MatchIndex, np.ndarray]:
+    """
+    Returns a match index for the given taxa, along with the position in taxa of each taxon in the index (-1 for taxa
+    in the index which aren't in taxa).
+
+    The index of the cached checklist taxa was loaded from by get_all_taxa is built once and stored with the
+    cache. Otherwise, e.g. for taxa which have been modified or made some other way, an index is built for just the
+    given taxa.
+    :param taxa:
+    :param key_columns: Column combinations the index must have keys for. Defaults to match_key_columns.
+    :return:
+    """
+    if key_columns is None:
+        key_columns = match_key_columns
+    match_index = _cached_match_index(taxa)
+    if match_index is not None and all(match_index.has_key_columns(c) for c in key_columns):
+        positions = match_index.positions_in(taxa)
+        if positions is not None:
+            return match_index, positions
+    return MatchIndex(taxa, key_columns), np.arange(len(taxa.index))
@@ -0,0 +1,179 @@
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from wcvpy.wcvp_download import get_all_taxa, wcvp_columns
+from wcvpy.wcvp_download.checklist_cache import phonetic_index_cache_path
+from wcvpy.wcvp_name_matching import output_record_col_names, resolve_matches_by_priorities
+from wcvpy.wcvp_name_matching.local_fuzzy_matching import _bit_parallel_distances
+from wcvpy.wcvp_name_matching.match_index import MatchIndex, _cached_index, hash_keys, \
+    tidy_values_for_matching_in_column
+from wcvpy.wcvp_name_matching.wcvp_matching import _family_filter
+
+# Replacements of letters at the start of each word, following the near-match rules of Taxamatch. Words are title
+# cased when the rules are applied, so only the first letter of each word is upper case.
+_initial_replacements = {'Ae': 'E', 'Cn': 'N', 'Ct': 'T', 'Cz': 'C', 'Dj': 'J', 'Ea': 'E', 'Eu': 'U', 'Gn': 'N',
+                         'Kn': 'N', 'Mc': 'Mac', 'Mn': 'N', 'Oe': 'E', 'Qu': 'Q', 'Ps': 'S', 'Pt': 'T', 'Ts': 'S',
+                         'Wr': 'R', 'X': 'Z'}
+_initial_pattern = '(' + '|'.join(sorted(_initial_replacements, key=len, reverse=True)) + ')'
+# Replacements of the rest of the letters of each word, in the order they're applied. Unlike Taxamatch, y is replaced
+# before the other rules and ia is replaced again after them, so that names differing by i/y and ae/e swaps within
+# words have the same key
+_other_replacements = [('y', 'i'), ('ae', 'i'), ('ia', 'a'), ('oe', 'i'), ('oi', 'a'), ('sc', 's'), ('h', '')]
+_other_translation = str.maketrans('eouykz', 'iaiics')
+
+
+def near_match_keys_in_column(column: pd.Series) -> pd.Series:
+    """
+    Phonetically normalised versions of the names in the column, so that names differing in ways common in
+    misspellings (e.g. i/y and ae/e swaps, doubled letters and the gender endings of epithets) have the same key.
+    Follows the near-match rules of Taxamatch, applied to each word of the tidied names: letter combinations at the
+    start of words are simplified, the remaining vowels and similar sounding letters are merged, repeated letters are
+    removed and the endings of epithets are normalised.
+    :param column:
+    :return:
+    """
+    names = tidy_values_for_matching_in_column(column)
+    # Remove accents
+    names = names.str.normalize('NFKD').str.replace('[\u0300-\u036f]', '', regex=True)
+    # Repeated letters are also removed before the other rules, so that doubled letters don't stop them applying
+    names = names.str.title().str.replace(r'(?i)(.)\1+', r'\1', regex=True)
+    names = names.str.replace(_initial_pattern, lambda m: _initial_replacements[m.group(0)], regex=True)
+    for old, new in _other_replacements:
+        names = names.str.replace(old, new, regex=False)
+    names = names.str.translate(_other_translation).str.replace('ia', 'a', regex=False)
+    names = names.str.replace(r'(?i)(.)\1+', r'\1', regex=True)
+    # Endings of epithets, e.g. -us, -um, -is and -os, are normalised to -a
+    names = names.str.replace(r'(?<= )(\S{3,})(?:is|im|as)(?![^ ])', r'\1a', regex=True)
+    return names.str.upper()
+
+
+class PhoneticIndex(MatchIndex):
+    """
+    Maps the hash of the near-match key (see near_match_keys_in_column) of each taxon name in the checklist to the
+    positions of the taxa with that key. Lookups use the key columns ().
+    """
+    # Increase when the contents change, so that indexes cached by older versions are rebuilt
+    format_version = 2
+
+    def __init__(self, taxa: pd.DataFrame):
+        super().__init__(taxa, [])
+        self.format_version = PhoneticIndex.format_version
+        keys = near_match_keys_in_column(taxa[wcvp_columns['name']])
+        positions = np.flatnonzero(keys.notna().to_numpy())
+        self._add_keys((), hash_keys(keys.iloc[positions]), positions)
+
+
+def get_phonetic_index(taxa: pd.DataFrame) -> Tuple[PhoneticIndex, np.ndarray]:
+    """
+    Returns a phonetic index for the given taxa, along with the position in taxa of each taxon in the index (-1 for
+    taxa in the index which aren't in taxa). As with get_match_index, the index of a cached checklist is built once
+    and stored with the cache.
+    :param taxa:
+    :return:
+    """
+    phonetic_index = _cached_index(taxa, PhoneticIndex, phonetic_index_cache_path, PhoneticIndex)
+    if phonetic_index is not None:
+        positions = phonetic_index.positions_in(taxa)
+        if positions is not None:
+            return phonetic_index, positions
+    return PhoneticIndex(taxa), np.arange(len(taxa.index))
+
+
+def _edit_distance(name: str, other_name: str) -> int:
+    # Levenshtein distance between two names of any length
+    previous_row = list(range(len(other_name) + 1))
+    for i, char in enumerate(name, start=1):
+        row = [i]
+        for j, other_char in enumerate(other_name, start=1):
+            row.append(min(previous_row[j] + 1, row[j - 1] + 1, previous_row[j - 1] + (char != other_char)))
+        previous_row = row
+    return previous_row[-1]
+
+
+def _pairwise_edit_distances(names: np.ndarray, other_names: np.ndarray) -> np.ndarray:
+    # Edit distance between each name and the corresponding other name. The bit-parallel routine only handles names
+    # shorter than 64 characters, so the distances of longer (and empty) names are found one at a time
+    lengths = np.array([len(n) for n in names], dtype=np.int64)
+    distances = np.array([_edit_distance(name, other_name) if not 0 < length < 64 else 0
+                          for name, other_name, length in zip(names, other_names, lengths)], dtype=np.int64)
+    pairs = np.flatnonzero((lengths > 0) & (lengths < 64))
+    if len(pairs) == 0:
+        return distances
+    name_chars = np.array(names[pairs], dtype=str).view(np.uint32).reshape(len(pairs), -1)
+    others = np.array(other_names[pairs], dtype=str)
+    other_chars = others.view(np.uint32).reshape(len(pairs), -1)
+    bits = np.uint64(1) << np.arange(name_chars.shape[1], dtype=np.uint64)
+
+    def column_matches(j):
+        return np.bitwise_or.reduce(np.where(name_chars == other_chars[:, j:j + 1], bits, np.uint64(0)), axis=1)
+
+    distances[pairs] = _bit_parallel_distances(column_matches, lengths[pairs],
+                                               np.char.str_len(others).astype(np.int64), other_chars.shape[1])
+    return distances
+
+
+def get_phonetic_matches(df: pd.DataFrame, matching_name_col: str, unique_submission_id_col: str,
+                         all_taxa: pd.DataFrame = None, family_column: str = None,
+                         wcvp_version: str = None) -> pd.DataFrame:
+    """
+    Finds the taxa whose names have the same near-match key as the names in matching_name_col, using the phonetic
+    index of the checklist, without using any online services.
+    :param df:
+    :param matching_name_col:
+    :param unique_submission_id_col:
+    :param all_taxa:
+    :param family_column: if given, only taxa in the family of each name (as their family or accepted family) are
+    matched
+    :param wcvp_version:
+    :return: All matches of each submission, with the edit distance between the tidied names
+    """
+    if all_taxa is None:
+        all_taxa = get_all_taxa(version=wcvp_version)
+    phonetic_index, taxa_positions = get_phonetic_index(all_taxa)
+
+    keys = near_match_keys_in_column(df[matching_name_col]).to_numpy(dtype=object)
+    has_key = np.flatnonzero(pd.notna(keys))
+    key_positions, index_rows = phonetic_index.candidates((), hash_keys(keys[has_key]))
+    name_positions = has_key[key_positions]
+    taxa_rows = taxa_positions[index_rows]
+    in_taxa = taxa_rows >= 0
+    name_positions, taxa_rows = name_positions[in_taxa], taxa_rows[in_taxa]
+    # The index is looked up by hash, so check the keys are the same
+    taxa_names = all_taxa[wcvp_columns['name']].iloc[taxa_rows]
+    same_key = near_match_keys_in_column(taxa_names).to_numpy(dtype=object) == keys[name_positions]
+    name_positions, taxa_rows = name_positions[same_key], taxa_rows[same_key]
+    if family_column is not None:
+        in_family = _family_filter(df, family_column, all_taxa, name_positions, taxa_rows)
+        name_positions, taxa_rows = name_positions[in_family], taxa_rows[in_family]
+
+    match_df = pd.concat([df[[unique_submission_id_col]].iloc[name_positions].reset_index(drop=True),
+                          all_taxa[output_record_col_names + [wcvp_columns['family'], wcvp_columns['rank']]].iloc[
+                              taxa_rows].reset_index(drop=True)], axis=1)
+    match_df['matched_name'] = all_taxa[wcvp_columns['name']].to_numpy(dtype=object)[taxa_rows]
+    match_df['edit_distance'] = _pairwise_edit_distances(
+        tidy_values_for_matching_in_column(df[matching_name_col]).to_numpy(dtype=object)[name_positions],
+        tidy_values_for_matching_in_column(match_df['matched_name']).to_numpy(dtype=object))
+    return match_df
+
+
+def resolve_phonetic_matches(match_df: pd.DataFrame, unique_submission_id_col: str) -> pd.DataFrame:
+    """
+    Resolves the matches from get_phonetic_matches to the closest spelt match of each submission, using status and
+    then rank priority where there are several.
+    :param match_df:
+    :param unique_submission_id_col:
+    :return:
+    """
+    closest = match_df[match_df['edit_distance'] == match_df.groupby(unique_submission_id_col)[
+        'edit_distance'].transform('min')]
+    # Appropriately label unique matches
+    matched_by = np.where(closest.duplicated(keep=False, subset=[unique_submission_id_col]), 'phonetic',
+                          'phonetic_unique')
+    closest = closest.assign(matched_by=matched_by)
+    resolved_df = resolve_matches_by_priorities(closest, unique_submission_id_col, ['status', 'rank'])
+    resolved_df = resolved_df.sort_index()
+    for c in [wcvp_columns['status'], wcvp_columns['rank']]:
+        resolved_df[c] = resolved_df[c].astype(object)
+    return resolved_df
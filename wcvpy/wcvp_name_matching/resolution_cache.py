@@ -0,0 +1,182 @@
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from wcvpy.wcvp_download.checklist_cache import checklist_cache_attr
+from wcvpy.wcvp_download.get_taxa_from_wcvp import _wcvp_downloads_path
+from wcvpy.wcvp_name_matching import output_record_col_names
+
+# Resolutions of submissions from previous runs of the name matching, kept across runs and datasets
+resolution_cache_path = os.path.join(_wcvp_downloads_path, 'name_resolutions.sqlite')
+# Least recently used resolutions are removed beyond this number
+max_cached_resolutions = 2000000
+
+cached_resolution_columns = output_record_col_names + ['matched_by', 'matched_name']
+
+
+@contextlib.contextmanager
+def _resolution_database():
+    os.makedirs(os.path.dirname(resolution_cache_path) or '.', exist_ok=True)
+    connection = sqlite3.connect(resolution_cache_path, timeout=60)
+    try:
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS resolutions (settings TEXT NOT NULL, '
+                               'family TEXT NOT NULL, name TEXT NOT NULL, checklist TEXT NOT NULL, '
+                               'record TEXT NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (settings, family, name))')
+            connection.execute('CREATE INDEX IF NOT EXISTS resolutions_last_used ON resolutions (last_used)')
+            # Types of the resolution columns when resolved with each settings, as records are stored as strings
+            connection.execute('CREATE TABLE IF NOT EXISTS resolution_types (settings TEXT PRIMARY KEY, '
+                               'types TEXT NOT NULL)')
+        yield connection
+    finally:
+        connection.close()
+
+
+def resolution_settings(all_taxa: pd.DataFrame, families_of_interest: List[str], match_level: str,
+                        use_open_refine: bool, manual_resolution_csv: str, use_local_fuzzy: bool = False,
+                        use_knms: bool = True, use_phonetic: bool = False) -> Tuple[str, str]:
+    """
+    Identifies the checklist and matching options resolutions are made with, which resolutions are cached under.
+    Returns None if the checklist isn't from the cached checklist, as resolutions made with it can't be identified.
+    :param all_taxa:
+    :param families_of_interest:
+    :param match_level:
+    :param use_open_refine:
+    :param manual_resolution_csv:
+    :param use_local_fuzzy:
+    :param use_knms:
+    :param use_phonetic:
+    :return: The checklist cache path and a hash of the settings
+    """
+    checklist_path, _ = all_taxa.attrs.get(checklist_cache_attr, (None, None))
+    if checklist_path is None:
+        return None
+    manual_hash = None
+    if manual_resolution_csv is not None:
+        with open(manual_resolution_csv, 'rb') as f:
+            manual_hash = hashlib.md5(f.read()).hexdigest()
+    # The taxa may be filtered from the cached checklist
+    taxa_hash = hashlib.md5(pd.util.hash_array(all_taxa.index.to_numpy()).tobytes()).hexdigest()
+    families = None if families_of_interest is None else sorted(str(f) for f in families_of_interest)
+    settings = json.dumps([os.path.basename(checklist_path), taxa_hash, families, match_level, bool(use_open_refine),
+                           manual_hash, bool(use_local_fuzzy), bool(use_knms), bool(use_phonetic)])
+    return checklist_path, hashlib.md5(settings.encode()).hexdigest()
+
+
+def _key_values(column: pd.Series) -> List[str]:
+    return ['' if pd.isna(v) else str(v) for v in column]
+
+
+def _stored_types(connection: sqlite3.Connection, settings_hash: str) -> dict:
+    found = connection.execute('SELECT types FROM resolution_types WHERE settings = ?', (settings_hash,)).fetchone()
+    return {} if found is None else json.loads(found[0])
+
+
+def _with_stored_types(records: pd.DataFrame, types: dict) -> pd.DataFrame:
+    for c, type_name in types.items():
+        try:
+            dtype = pd.api.types.pandas_dtype(type_name)
+        except TypeError:
+            continue
+        # Types are only restored by the versions of pandas they're named the same way in
+        if str(dtype) == type_name:
+            records[c] = records[c].astype(dtype)
+    return records
+
+
+def read_cached_resolutions(settings: Tuple[str, str], names: pd.Series,
+                            families: pd.Series = None) -> Tuple[np.ndarray, pd.DataFrame]:
+    """
+    Looks up cached resolutions of the given (tidied) names and families.
+    :param settings: From resolution_settings
+    :param names:
+    :param families:
+    :return: Positions in names of the submissions found, and their resolutions, with the types the resolutions
+    were made with
+    """
+    no_resolutions = np.array([], dtype=np.int64), pd.DataFrame(columns=cached_resolution_columns)
+    if not os.path.exists(resolution_cache_path) or len(names.index) == 0:
+        return no_resolutions
+    family_values = [''] * len(names.index) if families is None else _key_values(families)
+    try:
+        with _resolution_database() as connection:
+            connection.execute('CREATE TEMP TABLE lookup (position INTEGER, family TEXT, name TEXT)')
+            connection.executemany('INSERT INTO lookup VALUES (?, ?, ?)',
+                                   zip(range(len(names.index)), family_values, _key_values(names)))
+            found = connection.execute(
+                'SELECT lookup.position, resolutions.record FROM lookup JOIN resolutions ON '
+                'resolutions.settings = ? AND resolutions.family = lookup.family AND '
+                'resolutions.name = lookup.name ORDER BY lookup.position', (settings[1],)).fetchall()
+            types = _stored_types(connection, settings[1])
+            with connection:
+                connection.execute('UPDATE resolutions SET last_used = ? WHERE settings = ? AND '
+                                   '(family, name) IN (SELECT family, name FROM lookup)', (time.time(), settings[1]))
+    except sqlite3.Error as e:
+        print(f'WARNING: Could not read cached resolutions ({e}): {resolution_cache_path}')
+        return no_resolutions
+    positions = np.array([p for p, _ in found], dtype=np.int64)
+    records = pd.DataFrame([json.loads(r) for _, r in found], columns=cached_resolution_columns, dtype=object)
+    # Missing values are stored as null
+    records = records.where(records.notna(), np.nan)
+    return positions, _with_stored_types(records.infer_objects(), types)
+
+
+def _remove_stale_resolutions(connection: sqlite3.Connection):
+    # Resolutions made with checklists which have since been replaced or removed
+    for (checklist,) in connection.execute('SELECT DISTINCT checklist FROM resolutions').fetchall():
+        if not os.path.exists(checklist):
+            connection.execute('DELETE FROM resolutions WHERE checklist = ?', (checklist,))
+    number_cached = connection.execute('SELECT COUNT(*) FROM resolutions').fetchone()[0]
+    if number_cached > max_cached_resolutions:
+        connection.execute('DELETE FROM resolutions WHERE rowid IN (SELECT rowid FROM resolutions '
+                           'ORDER BY last_used LIMIT ?)', (number_cached - max_cached_resolutions,))
+    connection.execute('DELETE FROM resolution_types WHERE settings NOT IN (SELECT settings FROM resolutions)')
+
+
+def write_cached_resolutions(settings: Tuple[str, str], names: pd.Series, resolutions: pd.DataFrame,
+                             families: pd.Series = None):
+    """
+    Caches the resolutions of the given (tidied) names and families, including submissions which couldn't be
+    resolved, along with the types of the resolution columns.
+    :param settings: From resolution_settings
+    :param names:
+    :param resolutions: Resolution of each name, with columns cached_resolution_columns
+    :param families:
+    :return:
+    """
+    if len(names.index) == 0:
+        return
+    checklist_path, settings_hash = settings
+    family_values = [''] * len(names.index) if families is None else _key_values(families)
+    records = [json.dumps([None if pd.isna(v) else str(v) for v in row])
+               for row in resolutions[cached_resolution_columns].itertuples(index=False)]
+    types = {c: str(resolutions[c].dtype) for c in cached_resolution_columns if resolutions[c].notna().any()}
+    now = time.time()
+    try:
+        with _resolution_database() as connection:
+            with connection:
+                types = {**_stored_types(connection, settings_hash), **types}
+                connection.execute('INSERT OR REPLACE INTO resolution_types VALUES (?, ?)',
+                                   (settings_hash, json.dumps(types)))
+                connection.executemany('INSERT OR REPLACE INTO resolutions VALUES (?, ?, ?, ?, ?, ?)',
+                                       [(settings_hash, f, n, checklist_path, r, now) for f, n, r in
+                                        zip(family_values, _key_values(names), records)])
+                _remove_stale_resolutions(connection)
+    except sqlite3.Error as e:
+        print(f'WARNING: Could not cache resolutions ({e}): {resolution_cache_path}')
+
+
+def clear_resolution_cache():
+    """
+    Removes all cached resolutions.
+    :return:
+    """
+    if os.path.exists(resolution_cache_path):
+        os.remove(resolution_cache_path)
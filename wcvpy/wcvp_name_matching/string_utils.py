@@ -1,9 +1,13 @@
 import re
 import string
 
+import numpy as np
 import pandas as pd
 
-from wcvpy.wcvp_download import wcvp_accepted_columns, wcvp_columns, hybrid_characters, infraspecific_chars, clean_whitespaces_in_names
+from wcvpy.wcvp_download import wcvp_accepted_columns, wcvp_columns, hybrid_characters, infraspecific_chars, \
+    clean_whitespaces_in_column
+from wcvpy.wcvp_download.joined_strings import apply_to_unique_strings, join_words_in_joined_strings, \
+    joined_strings_separator, joined_strings_marker
 
 acc_info_col_names = [wcvp_accepted_columns['ipni_id'],
                       wcvp_accepted_columns['name'],
@@ -94,14 +98,31 @@ def remove_double_spaces(given_str: str) -> str:
         return " ".join(given_str.split())
 
 
+_chars_to_space_around = [c for c in infraspecific_chars if '.' in c and c != 'f.'] + hybrid_characters
+# Positions directly after and directly before each of the characters which aren't already spaced
+_space_after_char_patterns = [re.compile(r'(?<={})(?=[^\s])'.format(re.escape(h_char))) for h_char in
+                              _chars_to_space_around]
+_space_before_char_patterns = [re.compile(r'(?={})(?<=[^\s])'.format(re.escape(h_char))) for h_char in
+                               _chars_to_space_around]
+# As above, for values joined by joined_strings_separator. These match the characters themselves, which is much
+# faster to search for
+_chars_to_space_after_in_joined_patterns = [
+    re.compile(r'{0}(?=[^\s{1}])'.format(re.escape(h_char), joined_strings_separator)) for h_char in
+    _chars_to_space_around]
+_chars_to_space_before_in_joined_patterns = [
+    re.compile(r'{0}(?<=[^\s{1}]{0})'.format(re.escape(h_char), joined_strings_separator)) for h_char in
+    _chars_to_space_around]
+
+
 def add_space_around_hybrid_chars_and_infraspecific_epithets(value: str):
     try:
         out = value
-        for h_char in [c for c in infraspecific_chars if '.' in c and c != 'f.'] + hybrid_characters:
+        for h_char, after_pattern, before_pattern in zip(_chars_to_space_around, _space_after_char_patterns,
+                                                         _space_before_char_patterns):
             # These things should be preceded and followed by space
             if h_char in value:
-                out = re.sub(r'(?<={})(?=[^\s])'.format(re.escape(h_char)), r' ', out)
-                out = re.sub(r'(?={})(?<=[^\s])'.format(re.escape(h_char)), r' ', out)
+                out = after_pattern.sub(r' ', out)
+                out = before_pattern.sub(r' ', out)
 
         return out
     except AttributeError:
@@ -156,6 +177,84 @@ def remove_spacelike_chars(given_name: str) -> str:
         return given_name
 
 
+def _add_space_around_chars_in_joined_strings(joined: str) -> str:
+    # Adding spaces never creates or removes the characters which are checked later, so the substitutions can be made
+    # in all values rather than only those which originally contain each character
+    for h_char, after_pattern, before_pattern in zip(_chars_to_space_around, _chars_to_space_after_in_joined_patterns,
+                                                     _chars_to_space_before_in_joined_patterns):
+        if h_char in joined:
+            joined = after_pattern.sub(r'\g<0> ', joined)
+            joined = before_pattern.sub(r' \g<0>', joined)
+    return joined
+
+
+_value_start = '(?:^|(?<=' + joined_strings_separator + '))'
+_word_character = '[^ ' + joined_strings_separator + joined_strings_marker + ']'
+_word_start = '(?<!' + _word_character + ')'
+_starting_hybrid_chars = re.compile(_value_start + '(' + '|'.join(re.escape(x) for x in hybrid_characters) + ') ')
+_marked_hybrid_char_spaces = re.compile(joined_strings_marker + ' ')
+_abbreviated_words = re.compile(_word_start + _word_character + r'*\.(?![^ ' + joined_strings_separator + '])')
+_words_starting_with_punctuation = re.compile(
+    _word_start + '([' + re.escape(string.punctuation) + '])(' + _word_character + ')')
+_first_words = re.compile('(?:^|(?<=[' + joined_strings_separator + joined_strings_marker + ']))' +
+                          _word_character + '+')
+_infraspecific_chars_set = set(infraspecific_chars)
+
+
+def _capitalize_first_letter_of_taxon_in_joined_strings(joined: str) -> str:
+    # Mark the space after a leading hybrid character so that it's kept
+    capitalized = _starting_hybrid_chars.sub(r'\1' + joined_strings_marker, joined)
+    capitalized = join_words_in_joined_strings(capitalized.lower())
+    capitalized = _marked_hybrid_char_spaces.sub(joined_strings_marker, capitalized)
+
+    capitalized = _abbreviated_words.sub(
+        lambda m: m.group(0) if m.group(0) in _infraspecific_chars_set else m.group(0).capitalize(), capitalized)
+    capitalized = _words_starting_with_punctuation.sub(lambda m: m.group(1) + m.group(2).capitalize(), capitalized)
+    capitalized = _first_words.sub(lambda m: m.group(0).capitalize(), capitalized)
+    capitalized = capitalized.replace(joined_strings_marker, ' ').split(joined_strings_separator)
+
+    # Values without any words (e.g. only whitespace) are returned unchanged by the scalar version. These are the only
+    # values shortened to less than three characters, so redo any short values with the scalar version
+    lengths = np.fromiter(map(len, capitalized), dtype=int, count=len(capitalized))
+    short_values = np.flatnonzero(lengths < 3)
+    if len(short_values) > 0:
+        values = joined.split(joined_strings_separator)
+        for i in short_values:
+            capitalized[i] = _capitalize_first_letter_of_taxon(values[i])
+    return joined_strings_separator.join(capitalized)
+
+
+def remove_spacelike_chars_in_column(column: pd.Series) -> pd.Series:
+    """
+    Column version of remove_spacelike_chars, giving the same output as column.apply(remove_spacelike_chars).
+    :param column:
+    :return:
+    """
+    return apply_to_unique_strings(column, join_words_in_joined_strings, remove_spacelike_chars)
+
+
+def add_space_around_hybrid_chars_and_infraspecific_epithets_in_column(column: pd.Series) -> pd.Series:
+    """
+    Column version of add_space_around_hybrid_chars_and_infraspecific_epithets, giving the same output for string values.
+    Unlike the scalar version, missing values are left as they are.
+    :param column:
+    :return:
+    """
+    return apply_to_unique_strings(column, _add_space_around_chars_in_joined_strings,
+                                    add_space_around_hybrid_chars_and_infraspecific_epithets)
+
+
+def _capitalize_first_letter_of_taxon_in_column(column: pd.Series) -> pd.Series:
+    """
+    Column version of _capitalize_first_letter_of_taxon, giving the same output as
+    column.apply(_capitalize_first_letter_of_taxon).
+    :param column:
+    :return:
+    """
+    return apply_to_unique_strings(column, _capitalize_first_letter_of_taxon_in_joined_strings,
+                                    _capitalize_first_letter_of_taxon)
+
+
 def remove_fullstop(given_name: str) -> str:
     try:
         return given_name.replace('.', '')
@@ -165,17 +264,17 @@ def remove_fullstop(given_name: str) -> str:
 
 def tidy_families_in_column(df: pd.DataFrame, fam_column: str):
     df[submitted_family_name_col_id] = df[fam_column]
-    df[fam_column] = df[fam_column].apply(remove_spacelike_chars)
-    df[fam_column] = df[fam_column].apply(clean_whitespaces_in_names)
-    df[fam_column] = df[fam_column].apply(_capitalize_first_letter_of_taxon)
+    df[fam_column] = remove_spacelike_chars_in_column(df[fam_column])
+    df[fam_column] = clean_whitespaces_in_column(df[fam_column])
+    df[fam_column] = _capitalize_first_letter_of_taxon_in_column(df[fam_column])
 
 
 def tidy_names_in_column(df: pd.DataFrame, name_col: str):
     df[submitted_name_col_id] = df[name_col]
-    df[name_col] = df[name_col].apply(remove_spacelike_chars)
-    df[name_col] = df[name_col].apply(add_space_around_hybrid_chars_and_infraspecific_epithets)
-    df[name_col] = df[name_col].apply(clean_whitespaces_in_names)
-    df[recapitalised_name_col] = df[name_col].apply(_capitalize_first_letter_of_taxon)
+    df[name_col] = remove_spacelike_chars_in_column(df[name_col])
+    df[name_col] = add_space_around_hybrid_chars_and_infraspecific_epithets_in_column(df[name_col])
+    df[name_col] = clean_whitespaces_in_column(df[name_col])
+    df[recapitalised_name_col] = _capitalize_first_letter_of_taxon_in_column(df[name_col])
 
 
 def clean_urn_ids(given_value: str) -> str:
@@ -0,0 +1,40 @@
+import subprocess
+import sys
+import unittest
+
+_check_lazy_imports = """
+import sys
+import wcvpy.wcvp_name_matching
+import wcvpy.wcvp_download
+from wcvpy.wcvp_name_matching import *
+from wcvpy.wcvp_download import *
+print(','.join(m for m in ['requests', 'tqdm', 'wcvpy.OpenRefineMatching', 'wcvpy.wcvp_download.zip_download',
+                           'wcvpy.wcvp_download.get_distributions_from_wcvp',
+                           'wcvpy.wcvp_download.plot_distributions'] if m in sys.modules))
+"""
+
+
+class MyTestCase(unittest.TestCase):
+    def test_lazy_imports(self):
+        # Run in a fresh interpreter, as other tests will already have imported these
+        loaded = subprocess.run([sys.executable, '-c', _check_lazy_imports], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        self.assertEqual(loaded, '')
+
+    def test_lazy_names(self):
+        import wcvpy.wcvp_download
+        import wcvpy.wcvp_name_matching
+        from wcvpy.OpenRefineMatching import openrefine_match_full_names
+        from wcvpy.wcvp_download.plot_distributions import plot_number_accepted_taxa_in_regions
+
+        self.assertIs(wcvpy.wcvp_name_matching.openrefine_match_full_names, openrefine_match_full_names)
+        self.assertIs(wcvpy.wcvp_download.plot_number_accepted_taxa_in_regions, plot_number_accepted_taxa_in_regions)
+        for name in wcvpy.wcvp_download.__all__:
+            self.assertTrue(hasattr(wcvpy.wcvp_download, name), name)
+        for name in wcvpy.wcvp_name_matching.__all__:
+            self.assertTrue(hasattr(wcvpy.wcvp_name_matching, name), name)
+        self.assertRaises(AttributeError, getattr, wcvpy.wcvp_download, 'not_a_name')
+
+
+if __name__ == '__main__':
+    unittest.main()
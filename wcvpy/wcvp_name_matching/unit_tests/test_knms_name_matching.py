@@ -0,0 +1,165 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import pandas as pd
+
+from wcvpy.wcvp_name_matching import knms_name_matching, get_knms_name_matches, clear_stored_knms_matches, \
+    knms_failed_names_attr
+
+
+class _StandInKnms:
+    """
+    Answers KNMS match requests. Names starting with 'Match' get a single match, names starting with 'Multiple' get
+    two matches and other names none. Batches containing a name in `failing_names` get a 500 response, the first
+    `rate_limited` requests get a 429 response, and if `unavailable` every request gets a 503 response.
+    """
+
+    def __init__(self, failing_names=(), rate_limited: int = 0, unavailable: bool = False):
+        self.failing_names = set(failing_names)
+        self.rate_limited = rate_limited
+        self.unavailable = unavailable
+        self.batches = []
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _respond(self, status: int, body: bytes = b'', headers: dict = None):
+                self.send_response(status)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                names = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with server.lock:
+                    server.batches.append(names)
+                    rate_limited = server.rate_limited > 0
+                    server.rate_limited -= 1
+                if server.unavailable:
+                    return self._respond(503)
+                if rate_limited:
+                    return self._respond(429, headers={'Retry-After': '0'})
+                if server.failing_names.intersection(names):
+                    return self._respond(500)
+                records = []
+                for name in names:
+                    if name.startswith('Match'):
+                        records.append([name, 'true', 'urn:lsid:ipni.org:names:1-1', name])
+                    elif name.startswith('Multiple'):
+                        records.append([name, 'multiple (2)', 'urn:lsid:ipni.org:names:2-1', name + ' A'])
+                        records.append(['', '', 'urn:lsid:ipni.org:names:3-1', name + ' B'])
+                    else:
+                        records.append([name, 'false', '', ''])
+                self._respond(200, json.dumps({'records': records}).encode())
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/api/v2/powo/match'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Matches are stored in a temporary directory
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        patcher = mock.patch.multiple(knms_name_matching, knms_retry_wait=0, temp_outputs_dir=self.temp_dir.name,
+                                      knms_outputs_dir=os.path.join(self.temp_dir.name, 'knms matches'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get_matches(self, server: _StandInKnms, names, **kwargs):
+        with mock.patch.object(knms_name_matching, 'knms_url', server.url):
+            return get_knms_name_matches(names, **kwargs)
+
+    def test_batches_are_merged(self):
+        names = [f'Match {i}' for i in range(120)] + [f'Multiple {i}' for i in range(40)] + [f'None {i}' for i in
+                                                                                           range(90)]
+        with _StandInKnms() as server:
+            records = self._get_matches(server, names + names[:10], batch_size=20, max_workers=4)
+        self.assertEqual(len(server.batches), 13)
+        self.assertTrue(all(len(b) <= 20 for b in server.batches))
+        self.assertEqual(sorted(n for b in server.batches for n in b), sorted(names))
+        self.assertEqual(len(records.index), 120 + 2 * 40 + 90)
+        self.assertEqual(set(records['submitted']), set(names))
+        self.assertTrue((records[records['submitted'].str.startswith('Multiple')]['match_state'] ==
+                         'multiple (2)').all())
+        self.assertTrue(records[records['submitted'].str.startswith('None')]['ipni_id'].isna().all())
+
+    def test_rate_limiting(self):
+        names = [f'Match {i}' for i in range(30)]
+        with _StandInKnms(rate_limited=5) as server:
+            records = self._get_matches(server, names, batch_size=10, max_workers=2)
+        self.assertEqual(len(server.batches), 3 + 5)
+        self.assertEqual(set(records['submitted']), set(names))
+
+    def test_failing_names_are_isolated(self):
+        names = [f'Match {i}' for i in range(30)] + ['Match Ωμέγα']
+        with _StandInKnms(failing_names=['Match Ωμέγα']) as server:
+            records = self._get_matches(server, names, batch_size=16)
+        self.assertEqual(set(records['submitted']), set(names[:-1]))
+        self.assertEqual(records.attrs[knms_failed_names_attr], ['Match Ωμέγα'])
+
+    def test_unavailable(self):
+        with _StandInKnms(unavailable=True) as server:
+            with self.assertRaises(ConnectionError):
+                self._get_matches(server, ['Match 1', 'Match 2'])
+        self.assertEqual(len(server.batches), knms_name_matching.knms_retries + 1)
+
+    def test_stored_matches(self):
+        names = [f'Match {i}' for i in range(10)] + [f'Multiple {i}' for i in range(5)] + ['None 1']
+        with _StandInKnms() as server:
+            records = self._get_matches(server, names)
+            self.assertEqual(len(server.batches), 1)
+            # Stored names aren't sent again
+            stored_records = self._get_matches(server, names[::-1])
+            self.assertEqual(len(server.batches), 1)
+            pd.testing.assert_frame_equal(stored_records.sort_values(['submitted', 'ipni_id'], ignore_index=True),
+                                          records.sort_values(['submitted', 'ipni_id'], ignore_index=True))
+            self._get_matches(server, names[:3] + ['Match new'])
+            self.assertEqual(server.batches[-1], ['Match new'])
+            # Expired records are searched for again
+            with mock.patch.object(knms_name_matching, 'knms_cache_ttl', -1):
+                self._get_matches(server, names[:3])
+            self.assertEqual(server.batches[-1], names[:3])
+
+    def test_legacy_csvs_are_stored(self):
+        os.makedirs(knms_name_matching.knms_outputs_dir)
+        legacy_csv = os.path.join(knms_name_matching.knms_outputs_dir, 'knms_matches_cache_0123.csv')
+        pd.DataFrame([['Multiple 1', 'multiple (2)', 'urn:lsid:ipni.org:names:2-1', 'Multiple 1 A'],
+                      ['Multiple 1', 'multiple (2)', 'urn:lsid:ipni.org:names:3-1', 'Multiple 1 B'],
+                      ['None 1', 'false', None, None]],
+                     columns=knms_name_matching.knms_record_columns).to_csv(legacy_csv)
+        with _StandInKnms(unavailable=True) as server:
+            records = self._get_matches(server, ['Multiple 1', 'None 1'])
+        self.assertEqual(len(server.batches), 0)
+        self.assertFalse(os.path.exists(legacy_csv))
+        self.assertEqual(records['matched_name'].tolist()[:2], ['Multiple 1 A', 'Multiple 1 B'])
+        self.assertTrue(pd.isna(records['ipni_id'].iloc[2]))
+
+        clear_stored_knms_matches()
+        self.assertEqual(os.listdir(knms_name_matching.knms_outputs_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
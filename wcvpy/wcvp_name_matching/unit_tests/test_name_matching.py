@@ -1,19 +1,30 @@
+import multiprocessing
 import os
 import sys
+import tempfile
+import threading
 import unittest
 import time
 from typing import List
+from unittest import mock
 
 import numpy as np
 import pandas as pd
 import pandas.testing
 
 from wcvpy.wcvp_name_matching import lookup_ipni_id_in_wcvp, get_accepted_wcvp_info_from_ipni_ids_in_column, \
-    get_accepted_info_from_names_in_column, output_record_col_names, clean_urn_ids
+    get_accepted_info_from_names_in_column, output_record_col_names, clean_urn_ids, get_wcvp_info_for_names_in_column, \
+    get_accepted_info_from_names_in_chunks, recapitalised_name_col, get_word_combinations, get_local_fuzzy_matches, \
+    get_phonetic_matches, near_match_keys_in_column
+from wcvpy.wcvp_name_matching import chunked_matching, get_accepted_info, resolution_cache, local_fuzzy_matching, \
+    match_index
+from wcvpy.wcvp_name_matching.match_index import get_match_index
+from wcvpy.wcvp_name_matching.phonetic_matching import _pairwise_edit_distances
 from wcvpy.wcvp_name_matching.get_accepted_info import _get_knms_matches_and_accepted_info_from_names_in_column, \
-    _find_best_matches_from_multiple_knms_matches
+    _find_best_matches_from_multiple_knms_matches, _autoresolution_candidates
 
-from wcvpy.wcvp_download import get_all_taxa, wcvp_accepted_columns
+from wcvpy.wcvp_download import get_all_taxa, wcvp_accepted_columns, checklist_registry
+from wcvpy.wcvp_download.checklist_cache import checklist_cache_attr, match_index_cache_path
 
 wcvp_taxa = get_all_taxa()
 
@@ -419,6 +430,401 @@ class MyTestCase(unittest.TestCase):
         else:
             raise ValueError
 
+    def test_match_index(self):
+        # The index cached with the checklist gives the same matches as an index built for the given taxa, including
+        # the best matches it resolves in advance for names of more than one taxon (e.g. genera)
+        sample = wcvp_taxa.sample(500, random_state=1)
+        names = pd.DataFrame({'Name': pd.concat([sample['taxon_name'],
+                                                 sample['taxon_name'] + ' ' + sample['taxon_authors'].fillna(''),
+                                                 sample['taxon_name'].str.lower() + '  ' + sample['primary_author'],
+                                                 sample['genus']])})
+        names['Family'] = pd.concat([sample['family']] * 4).values
+        names = names.dropna().drop_duplicates(subset=['Name']).reset_index(drop=True)
+        families = wcvp_taxa[wcvp_taxa['family'].isin(sample['family'].unique()[:3])]
+        for taxa in [wcvp_taxa, families]:
+            untagged_taxa = taxa.copy()
+            untagged_taxa.attrs = {}
+            for family_column in [None, 'Family']:
+                result = get_wcvp_info_for_names_in_column(names.copy(), 'Name', 'Name', all_taxa=taxa,
+                                                           family_column=family_column)
+                expected = get_wcvp_info_for_names_in_column(names.copy(), 'Name', 'Name', all_taxa=untagged_taxa,
+                                                             family_column=family_column)
+                self.assertGreater(len(result.index), 0)
+                pandas.testing.assert_frame_equal(result.sort_values('Name').reset_index(drop=True),
+                                                  expected.sort_values('Name').reset_index(drop=True))
+
+    def test_match_index_of_edited_checklist(self):
+        # Best matches resolved in advance aren't used for copies of the checklist whose statuses have been changed
+        name_counts = wcvp_taxa['taxon_name'].value_counts()
+        shared_name = name_counts[name_counts > 1].index[0]
+        rows = wcvp_taxa[wcvp_taxa['taxon_name'] == shared_name]
+        statuses = rows['taxon_status']
+        best = get_wcvp_info_for_names_in_column(pd.DataFrame({'Name': [shared_name]}), 'Name', 'Name',
+                                                 all_taxa=wcvp_taxa)['plant_name_id'].iloc[0]
+        other = rows[statuses != statuses[rows['plant_name_id'] == best].iloc[0]].index[0]
+        edited_taxa = wcvp_taxa.copy()
+        edited_taxa.loc[rows[rows['plant_name_id'] == best].index, 'taxon_status'] = 'Unplaced'
+        edited_taxa.loc[other, 'taxon_status'] = 'Accepted'
+        for family_column in [None, 'Family']:
+            names = pd.DataFrame({'Name': [shared_name], 'Family': [rows['family'].iloc[0]]})
+            result = get_wcvp_info_for_names_in_column(names, 'Name', 'Name', all_taxa=edited_taxa,
+                                                       family_column=family_column)
+            self.assertEqual(result['plant_name_id'].tolist(), [edited_taxa.loc[other, 'plant_name_id']])
+
+        # The checklist is only checked against the index once, until its checked columns are replaced
+        checked_taxa = wcvp_taxa.copy()
+        with mock.patch.object(match_index, '_row_hashes', wraps=match_index._row_hashes) as row_hashes:
+            for _ in range(3):
+                self.assertIsNotNone(get_match_index(checked_taxa)[1])
+            self.assertEqual(row_hashes.call_count, 1)
+            checked_taxa['taxon_status'] = edited_taxa['taxon_status']
+            positions = get_match_index(checked_taxa)[1]
+            self.assertEqual(row_hashes.call_count, 3)
+        pandas.testing.assert_series_equal(
+            get_wcvp_info_for_names_in_column(pd.DataFrame({'Name': [shared_name]}), 'Name', 'Name',
+                                              all_taxa=checked_taxa)['plant_name_id'],
+            pd.Series([edited_taxa.loc[other, 'plant_name_id']], name='plant_name_id'), check_dtype=False)
+        self.assertTrue((positions == np.arange(len(checked_taxa.index))).all())
+
+    def test_resident_indexes_are_freed(self):
+        # Indexes built from the checklist are freed along with it
+        names = pd.DataFrame({'Name': ['Anthocleista grandiflorx'], 'id': [0]})
+        get_local_fuzzy_matches(names, 'Name', 'id', all_taxa=wcvp_taxa)
+        cache_path = wcvp_taxa.attrs[checklist_cache_attr][0]
+        self.assertIsNotNone(checklist_registry.lookup_index(cache_path, local_fuzzy_matching._word_index_key))
+        self.assertIsNotNone(checklist_registry.lookup_index(cache_path, match_index_cache_path(cache_path)))
+        checklist_registry.clear()
+        self.assertIsNone(checklist_registry.lookup_index(cache_path, local_fuzzy_matching._word_index_key))
+        self.assertIsNone(checklist_registry.lookup_index(cache_path, match_index_cache_path(cache_path)))
+
+    def test_autoresolution_candidates(self):
+        # Candidates are the taxa named by the first word(s) of each name, in the given family if there is one
+        sample = wcvp_taxa.dropna(subset=['taxon_name', 'family']).sample(50, random_state=1)
+        names = (sample['taxon_name'] + ' foo (bar.)').reset_index(drop=True)
+        families = sample['family'].reset_index(drop=True)
+        families.iloc[0] = np.nan
+        for given_families in [None, families]:
+            name_positions, taxa_rows = _autoresolution_candidates(names, wcvp_taxa, given_families)
+            expected_positions = []
+            expected_rows = []
+            for i, name in enumerate(names):
+                is_candidate = wcvp_taxa['taxon_name'].isin(get_word_combinations(name))
+                if given_families is not None:
+                    is_candidate &= (wcvp_taxa['family'] == families[i]) | (
+                            wcvp_taxa[wcvp_accepted_columns['family']] == families[i])
+                expected_rows += list(np.flatnonzero(is_candidate))
+                expected_positions += [i] * is_candidate.sum()
+            self.assertGreater(len(expected_rows), len(names.index))
+            self.assertEqual(list(name_positions), expected_positions)
+            self.assertEqual(list(taxa_rows), expected_rows)
+
+    def test_local_fuzzy_matching(self):
+        # Misspelt names are matched to the checklist without using knms or open refine
+        species = wcvp_taxa[(wcvp_taxa['taxon_rank'] == 'Species') & (wcvp_taxa['species'].str.len() >= 4)]
+        sample = species.drop_duplicates(subset=['taxon_name']).sample(100, random_state=1)
+        misspelt = pd.DataFrame({'Name': [n[:-2] + ('x' if n[-2] != 'x' else 'y') + n[-1] for n in
+                                          sample['taxon_name']],
+                                 'Family': sample['family'].values})
+        misspelt['id'] = range(len(misspelt.index))
+        matches = get_local_fuzzy_matches(misspelt, 'Name', 'id', all_taxa=wcvp_taxa, family_column='Family')
+        self.assertTrue((matches['edit_distance'] <= 2).all())
+        self.assertTrue(((matches['fuzzy_score'] > 0) & (matches['fuzzy_score'] < 1)).all())
+        self.assertTrue(((matches['family'] == misspelt['Family'].values[matches['id']]) | (
+                matches[wcvp_accepted_columns['family']] == misspelt['Family'].values[matches['id']])).all())
+        for i, name in enumerate(sample['taxon_name']):
+            self.assertIn(name, matches[matches['id'] == i]['matched_name'].values)
+
+        with mock.patch.object(get_accepted_info, 'get_knms_name_matches') as knms:
+            result = get_accepted_info_from_names_in_column(misspelt[['Name', 'Family']], 'Name',
+                                                            family_column='Family', match_level='fuzzy',
+                                                            use_open_refine=False, use_local_fuzzy=True,
+                                                            use_knms=False, all_taxa=wcvp_taxa)
+        knms.assert_not_called()
+        self.assertTrue(result['matched_by'].str.startswith('local_fuzzy').all())
+
+    def test_phonetic_matching(self):
+        keys = near_match_keys_in_column(pd.Series(['Quercus albus', 'Quercus albba', 'Pinus sylvestris',
+                                                    'Pinus silvestris', 'Aesculus hippocastanum',
+                                                    'Esculus hipocastanum', None]))
+        self.assertEqual(keys[0], keys[1])
+        self.assertEqual(keys[2], keys[3])
+        self.assertEqual(keys[4], keys[5])
+        self.assertTrue(pd.isna(keys[6]))
+
+        # Misspelt names are matched to the checklist without using knms or open refine
+        species = wcvp_taxa[(wcvp_taxa['taxon_rank'] == 'Species') & (wcvp_taxa['species'].str.contains('i'))]
+        sample = species.drop_duplicates(subset=['taxon_name']).sample(100, random_state=1)
+        misspelt = pd.DataFrame({'Name': [n[0] + n[1:].replace('i', 'y').replace('a', 'aa') for n in
+                                          sample['taxon_name']],
+                                 'Family': sample['family'].values})
+        misspelt['id'] = range(len(misspelt.index))
+        matches = get_phonetic_matches(misspelt, 'Name', 'id', all_taxa=wcvp_taxa, family_column='Family')
+        self.assertTrue(((matches['family'] == misspelt['Family'].values[matches['id']]) | (
+                matches[wcvp_accepted_columns['family']] == misspelt['Family'].values[matches['id']])).all())
+        for i, name in enumerate(sample['taxon_name']):
+            self.assertIn(name, matches[matches['id'] == i]['matched_name'].values)
+
+        with mock.patch.object(get_accepted_info, 'get_knms_name_matches') as knms:
+            result = get_accepted_info_from_names_in_column(misspelt[['Name', 'Family']], 'Name',
+                                                            family_column='Family', match_level='fuzzy',
+                                                            use_open_refine=False, use_phonetic=True,
+                                                            all_taxa=wcvp_taxa)
+        knms.assert_not_called()
+        self.assertTrue(result['matched_by'].str.startswith('phonetic').all())
+
+    def test_phonetic_edit_distances(self):
+        # Names of 64 or more characters are ranked by their edit distance like shorter names, rather than as the
+        # closest possible spelling
+        long_name = 'Quercus ' + 'a' * 60 + ' subsp. albus'
+        names = np.array(['Quercus albus', long_name, long_name, ''], dtype=object)
+        other_names = np.array(['Quercus albba', long_name, long_name.replace('albus', 'albba'), 'Quercus'],
+                               dtype=object)
+        np.testing.assert_array_equal(_pairwise_edit_distances(names, other_names), [2, 0, 2, 7])
+
+    def test_concurrent_network_stages(self):
+        # Querying knms and openrefine at the same time gives the same resolutions as querying them in turn
+        species = wcvp_taxa[(wcvp_taxa['taxon_rank'] == 'Species') & wcvp_taxa['ipni_id'].notna()]
+        sample = species.drop_duplicates(subset=['taxon_name']).sample(20, random_state=1)
+        ids = dict(zip(sample['taxon_name'] + 'x', sample['ipni_id']))
+        test_df = pd.DataFrame({'Name': list(ids)})
+        knms_names = list(ids)[:10]
+
+        def knms(names):
+            return pd.DataFrame([[n, 'true', ids[n], n[:-1]] if n in knms_names else [n, 'false', None, None]
+                                 for n in names], columns=['submitted', 'match_state', 'ipni_id', 'matched_name'])
+
+        openrefine_calls = []
+
+        def openrefine(df, full_name_col):
+            from wcvpy.OpenRefineMatching import reco_submitted_name_col_id
+            openrefine_calls.append((threading.current_thread(), df[full_name_col].tolist()))
+            out_df = df.copy()
+            out_df[reco_submitted_name_col_id] = df[full_name_col]
+            out_df['reco_id'] = [ids[n] for n in df[full_name_col]]
+            out_df['reco_name'] = df[full_name_col].str[:-1]
+            out_df['reco_score'] = 100.0
+            return out_df
+
+        results = []
+        for concurrent_network_stages in [False, True]:
+            with mock.patch.object(get_accepted_info, 'get_knms_name_matches', side_effect=knms), mock.patch(
+                    'wcvpy.OpenRefineMatching.openrefine_match_full_names', side_effect=openrefine):
+                results.append(get_accepted_info_from_names_in_column(
+                    test_df, 'Name', match_level='fuzzy', all_taxa=wcvp_taxa,
+                    concurrent_network_stages=concurrent_network_stages))
+        pandas.testing.assert_frame_equal(results[1], results[0])
+        self.assertEqual(results[0]['matched_by'].str.startswith('knms').sum(), 10)
+        self.assertEqual(results[0]['matched_by'].str.startswith('openrefine').sum(), 10)
+        self.assertEqual(sorted(openrefine_calls[0][1]), sorted(list(ids)[10:]))
+        self.assertEqual(sorted(openrefine_calls[1][1]), sorted(ids))
+        self.assertIs(openrefine_calls[0][0], threading.main_thread())
+        self.assertIsNot(openrefine_calls[1][0], threading.main_thread())
+
+    def test_repeated_submissions(self):
+        # Each submission is matched once and its resolution is given to all of its rows
+        test_df = pd.read_csv(os.path.join(unittest_inputs, 'family_test.csv'))[['Family', 'Name']]
+        repeated_df = pd.concat([test_df, test_df.iloc[::-1], test_df.iloc[[0]]])
+        repeated_df.iloc[-1, 1] = np.nan
+        repeated_df.index = range(100, 100 + len(repeated_df.index))
+        for family_column in [None, 'Family']:
+            result = get_accepted_info_from_names_in_column(test_df, 'Name', family_column=family_column,
+                                                            match_level='direct', all_taxa=wcvp_taxa)
+            repeated_result = get_accepted_info_from_names_in_column(repeated_df, 'Name', family_column=family_column,
+                                                                     match_level='direct', all_taxa=wcvp_taxa)
+            pandas.testing.assert_frame_equal(repeated_result.iloc[:-1],
+                                              pd.concat([result, result.iloc[::-1]], ignore_index=True))
+            self.assertTrue(repeated_result.iloc[-1][output_record_col_names + ['matched_by']].isna().all())
+
+    def test_parallel_matching(self):
+        test_df = pd.read_csv(os.path.join(unittest_inputs, 'family_test.csv'))[['Family', 'Name']]
+        for family_column in [None, 'Family']:
+            expected = get_accepted_info_from_names_in_column(test_df, 'Name', family_column=family_column,
+                                                              match_level='direct', all_taxa=wcvp_taxa)
+            result = get_accepted_info_from_names_in_column(test_df, 'Name', family_column=family_column,
+                                                            match_level='direct', all_taxa=wcvp_taxa, n_jobs=3)
+            pandas.testing.assert_frame_equal(result, expected)
+
+    def test_parallel_matching_without_fork(self):
+        # Where processes aren't forked by default (e.g. macOS), the checklist is sent to the workers
+        test_df = pd.read_csv(os.path.join(unittest_inputs, 'family_test.csv'))[['Family', 'Name']]
+        family_taxa = wcvp_taxa[wcvp_taxa['family'].isin(test_df['Family'])]
+        expected = get_accepted_info_from_names_in_column(test_df, 'Name', family_column='Family',
+                                                          match_level='direct', all_taxa=family_taxa)
+        with mock.patch.object(multiprocessing, 'get_context',
+                               return_value=multiprocessing.get_context('spawn')):
+            result = get_accepted_info_from_names_in_column(test_df, 'Name', family_column='Family',
+                                                            match_level='direct', all_taxa=family_taxa, n_jobs=2)
+        pandas.testing.assert_frame_equal(result, expected)
+
+    def test_compact_checklist_matching(self):
+        # Matching with a compact checklist gives the same output, including its types
+        test_df = pd.read_csv(os.path.join(unittest_inputs, 'family_test.csv'))[['Family', 'Name']]
+        compact_taxa = get_all_taxa(compact=True)
+        for family_column in [None, 'Family']:
+            expected = get_accepted_info_from_names_in_column(test_df, 'Name', family_column=family_column,
+                                                              match_level='direct', all_taxa=wcvp_taxa)
+            result = get_accepted_info_from_names_in_column(test_df, 'Name', family_column=family_column,
+                                                            match_level='direct', all_taxa=compact_taxa)
+            pandas.testing.assert_frame_equal(result, expected)
+
+    def test_chunked_matching(self):
+        # Matching in chunks gives the same as matching at once, and submissions seen in earlier chunks aren't matched
+        # again
+        test_df = pd.read_csv(os.path.join(unittest_inputs, 'family_test.csv'))[['Family', 'Name']]
+        repeated_df = pd.concat([test_df] * 3, ignore_index=True)
+        expected = get_accepted_info_from_names_in_column(repeated_df, 'Name', family_column='Family',
+                                                          match_level='direct', all_taxa=wcvp_taxa)
+        with mock.patch.object(chunked_matching, 'get_accepted_info_from_names_in_column',
+                               wraps=get_accepted_info_from_names_in_column) as match:
+            chunks = list(get_accepted_info_from_names_in_chunks(repeated_df, 'Name', chunksize=len(test_df.index),
+                                                                 family_column='Family', match_level='direct',
+                                                                 all_taxa=wcvp_taxa))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(match.call_count, 1)
+        pandas.testing.assert_frame_equal(pd.concat(chunks), expected)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file = os.path.join(tmp_dir, 'names.csv')
+            output_file = os.path.join(tmp_dir, 'matched.csv')
+            repeated_df.to_csv(input_file, index=False)
+            get_accepted_info_from_names_in_chunks(input_file, 'Name', output_file=output_file, chunksize=10,
+                                                   family_column='Family', match_level='direct', all_taxa=wcvp_taxa)
+            written = pd.read_csv(output_file)
+        self.assertEqual(list(written.columns), list(expected.columns))
+        pandas.testing.assert_series_equal(written['accepted_name'], expected['accepted_name'], check_dtype=False)
+
+    def test_resolution_cache(self):
+        # Resolutions are reused in later runs, and only new submissions are matched
+        test_df = pd.read_csv(os.path.join(unittest_inputs, 'family_test.csv'))[['Name']]
+        expected = get_accepted_info_from_names_in_column(test_df, 'Name', match_level='direct', all_taxa=wcvp_taxa)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with mock.patch.object(resolution_cache, 'resolution_cache_path', os.path.join(tmp_dir, 'cache.sqlite')):
+                with mock.patch.object(get_accepted_info, '_resolve_submissions',
+                                       wraps=get_accepted_info._resolve_submissions) as resolve:
+                    first = get_accepted_info_from_names_in_column(test_df.iloc[:10], 'Name', match_level='direct',
+                                                                   all_taxa=wcvp_taxa, use_resolution_cache=True)
+                    result = get_accepted_info_from_names_in_column(test_df, 'Name', match_level='direct',
+                                                                    all_taxa=wcvp_taxa, use_resolution_cache=True)
+                    first_submissions = resolve.call_args_list[0].args[0][recapitalised_name_col]
+                    new_submissions = resolve.call_args_list[1].args[0][recapitalised_name_col]
+                    self.assertGreater(len(new_submissions.index), 0)
+                    self.assertFalse(new_submissions.isin(first_submissions).any())
+                    cached = get_accepted_info_from_names_in_column(test_df, 'Name', match_level='direct',
+                                                                    all_taxa=wcvp_taxa, use_resolution_cache=True)
+                    self.assertEqual(resolve.call_count, 2)
+        pandas.testing.assert_frame_equal(first, expected.iloc[:10])
+        pandas.testing.assert_frame_equal(result, expected)
+        pandas.testing.assert_frame_equal(cached, expected)
+
+    def test_failed_lookups_are_not_cached(self):
+        # Submissions whose knms or openrefine requests fail are matched again in later runs
+        species = wcvp_taxa[(wcvp_taxa['taxon_rank'] == 'Species') & wcvp_taxa['ipni_id'].notna()]
+        sample = species.drop_duplicates(subset=['taxon_name']).sample(4, random_state=1)
+        ids = dict(zip(sample['taxon_name'] + 'x', sample['ipni_id']))
+        names = list(ids)
+        test_df = pd.DataFrame({'Name': names})
+
+        def knms(submitted):
+            from wcvpy.wcvp_name_matching import knms_failed_names_attr
+            records = pd.DataFrame([[n, 'true', ids[n], n[:-1]] if n == names[0] else [n, 'false', None, None]
+                                    for n in submitted if n != names[1]],
+                                   columns=['submitted', 'match_state', 'ipni_id', 'matched_name'])
+            records.attrs[knms_failed_names_attr] = [n for n in submitted if n == names[1]]
+            return records
+
+        def openrefine(df, full_name_col):
+            from wcvpy.OpenRefineMatching import reco_submitted_name_col_id, openrefine_failed_names_attr
+            out_df = df.copy()
+            out_df[reco_submitted_name_col_id] = df[full_name_col]
+            out_df['reco_id'] = [np.nan if n == names[3] else ids[n] for n in df[full_name_col]]
+            out_df['reco_name'] = df[full_name_col].str[:-1].where(df[full_name_col] != names[3])
+            out_df['reco_score'] = 100.0
+            out_df.attrs[openrefine_failed_names_attr] = [n for n in df[full_name_col] if n == names[3]]
+            return out_df
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with mock.patch.object(resolution_cache, 'resolution_cache_path', os.path.join(tmp_dir, 'cache.sqlite')):
+                with mock.patch.object(get_accepted_info, 'get_knms_name_matches', side_effect=knms), mock.patch(
+                        'wcvpy.OpenRefineMatching.openrefine_match_full_names', side_effect=openrefine), \
+                        mock.patch.object(get_accepted_info, '_resolve_submissions',
+                                          wraps=get_accepted_info._resolve_submissions) as resolve:
+                    for _ in range(2):
+                        result = get_accepted_info_from_names_in_column(test_df, 'Name', match_level='fuzzy',
+                                                                        all_taxa=wcvp_taxa,
+                                                                        use_resolution_cache=True)
+                        self.assertEqual(result['matched_by'].iloc[:3].str.split('_').str[0].tolist(),
+                                         ['knms', 'openrefine', 'openrefine'])
+                        self.assertTrue(pd.isna(result['matched_by'].iloc[3]))
+                    rematched = resolve.call_args_list[1].args[0][recapitalised_name_col]
+                    self.assertEqual(sorted(rematched), sorted([names[1], names[3]]))
+
+    def test_repeated_manual_resolutions(self):
+        # Submissions given more than one manual resolution get a row for each
+        ipni_ids = wcvp_taxa[wcvp_taxa['taxon_status'] == 'Accepted']['ipni_id'].dropna().iloc[[10, 20]].tolist()
+        test_df = pd.DataFrame({'Name': ['Foo bar', wcvp_taxa['taxon_name'].iloc[5], np.nan, 'Foo bar'],
+                                'Other': [1, 2, 3, 4]})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manual_csv = os.path.join(tmp_dir, 'manual.csv')
+            pd.DataFrame({'submitted': ['Foo bar', 'Foo bar'], 'resolution_id': ipni_ids}).to_csv(manual_csv)
+            with mock.patch.object(resolution_cache, 'resolution_cache_path', os.path.join(tmp_dir, 'cache.sqlite')):
+                for use_resolution_cache in [False, True]:
+                    result = get_accepted_info_from_names_in_column(test_df, 'Name', match_level='direct',
+                                                                    all_taxa=wcvp_taxa,
+                                                                    manual_resolution_csv=manual_csv,
+                                                                    use_resolution_cache=use_resolution_cache)
+                    self.assertEqual(result['Other'].tolist(), [1, 1, 2, 3, 4, 4])
+                    self.assertEqual(result[wcvp_accepted_columns['ipni_id']].iloc[[0, 1, 4, 5]].tolist(),
+                                     ipni_ids * 2)
+                    self.assertEqual(result['matched_by'].iloc[[0, 1, 4, 5]].tolist(), ['manual'] * 4)
+                    self.assertTrue(pd.isna(result['matched_by'].iloc[3]))
+
+    def test_cached_manual_resolutions(self):
+        # Manual resolutions are only reused for the submitted names they were given for, not others with the same
+        # tidied name
+        accepted = wcvp_taxa[(wcvp_taxa['taxon_status'] == 'Accepted') & (wcvp_taxa['taxon_rank'] == 'Species')]
+        name = accepted['taxon_name'].iloc[5]
+        manual_id = accepted['ipni_id'].dropna().iloc[10]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manual_csv = os.path.join(tmp_dir, 'manual.csv')
+            spaced_name = name.replace(' ', '  ', 1)
+            pd.DataFrame({'submitted': [spaced_name], 'resolution_id': [manual_id]}).to_csv(manual_csv)
+            expected = get_accepted_info_from_names_in_column(pd.DataFrame({'Name': [name]}), 'Name',
+                                                              match_level='direct', all_taxa=wcvp_taxa,
+                                                              manual_resolution_csv=manual_csv)
+            with mock.patch.object(resolution_cache, 'resolution_cache_path', os.path.join(tmp_dir, 'cache.sqlite')):
+                spaced = get_accepted_info_from_names_in_column(pd.DataFrame({'Name': [spaced_name]}), 'Name',
+                                                                match_level='direct', all_taxa=wcvp_taxa,
+                                                                manual_resolution_csv=manual_csv,
+                                                                use_resolution_cache=True)
+                result = get_accepted_info_from_names_in_column(pd.DataFrame({'Name': [name]}), 'Name',
+                                                                match_level='direct', all_taxa=wcvp_taxa,
+                                                                manual_resolution_csv=manual_csv,
+                                                                use_resolution_cache=True)
+        self.assertEqual(spaced['matched_by'].tolist(), ['manual'])
+        self.assertTrue(result['matched_by'].iloc[0].startswith('direct'))
+        pandas.testing.assert_frame_equal(result, expected)
+
+    def test_chunked_repeated_manual_resolutions(self):
+        # Submissions given more than one manual resolution get a row for each when matching in chunks, including in
+        # chunks after the one they were first matched in
+        ipni_ids = wcvp_taxa[wcvp_taxa['taxon_status'] == 'Accepted']['ipni_id'].dropna().iloc[[10, 20]].tolist()
+        test_df = pd.DataFrame({'Name': ['Foo bar', wcvp_taxa['taxon_name'].iloc[5], np.nan, 'Foo bar'] * 2,
+                                'Other': range(8)})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manual_csv = os.path.join(tmp_dir, 'manual.csv')
+            pd.DataFrame({'submitted': ['Foo bar', 'Foo bar'], 'resolution_id': ipni_ids}).to_csv(manual_csv)
+            expected = get_accepted_info_from_names_in_column(test_df, 'Name', match_level='direct',
+                                                              all_taxa=wcvp_taxa, manual_resolution_csv=manual_csv)
+            with mock.patch.object(chunked_matching, 'get_accepted_info_from_names_in_column',
+                                   wraps=get_accepted_info_from_names_in_column) as match:
+                chunks = list(get_accepted_info_from_names_in_chunks(test_df, 'Name', chunksize=3,
+                                                                     match_level='direct', all_taxa=wcvp_taxa,
+                                                                     manual_resolution_csv=manual_csv))
+        self.assertEqual(match.call_count, 1)
+        result = pd.concat(chunks)
+        self.assertEqual(result.index.tolist(), [0, 0, 1, 2, 3, 3, 4, 4, 5, 6, 7, 7])
+        pandas.testing.assert_frame_equal(result.reset_index(drop=True), expected)
+
     def test_fam_testing(self):
         self.all_info_test('family_test.csv', 'Name', family_column='Family')
 
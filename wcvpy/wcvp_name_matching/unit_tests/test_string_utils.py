@@ -5,11 +5,12 @@ import unittest
 import numpy as np
 import pandas as pd
 
-from wcvpy.wcvp_download import clean_whitespaces_in_names
+from wcvpy.wcvp_download import clean_whitespaces_in_names, clean_whitespaces_in_column
 from wcvpy.wcvp_name_matching import get_genus_from_full_name, clean_urn_ids, get_species_epithet_from_full_name
 from wcvpy.wcvp_name_matching.string_utils import _capitalize_first_letter_of_taxon, tidy_authors, \
     get_word_combinations, remove_spacelike_chars, add_space_around_hybrid_chars_and_infraspecific_epithets, \
-    get_species_binomial_from_full_name
+    get_species_binomial_from_full_name, remove_spacelike_chars_in_column, \
+    add_space_around_hybrid_chars_and_infraspecific_epithets_in_column, _capitalize_first_letter_of_taxon_in_column
 
 
 if sys.version_info >= (3, 9):
@@ -136,6 +137,28 @@ class MyTestCase(unittest.TestCase):
         for t in test_dict:
             self.assertEqual(clean_whitespaces_in_names(t), test_dict[t])
 
+    def test_column_versions_match_scalar_versions(self):
+        spacelike_names = pd.read_csv(os.path.join(unittest_inputs, 'spacelike_cases.csv'))['Name'].tolist()
+        names = spacelike_names + ['', ' ', '  ', '× ', '×   ', '× genus SPecies', '+ x', 'X genus', 'a',
+                                   'Abies .abies. (L. ) Druce', 'genus auth1. Genus auth2. Pub.',
+                                   'Pub. Genus auth1. var. Genus auth2. Pub.', 'Genus sp1 subs. sp2', '(a (b',
+                                   'Asubsp.B', 'A nothosubsp.B', 'A×B', 'A ×B', 'Avar.Bsubvar.C', 'ßtraße ǆ İ',
+                                   'Abies abies (L. ) druce', 'Abies\xa0abies \t(L.)  Druce ', 'Abies abies']
+        column = pd.Series(names * 2, index=range(len(names) * 2, 0, -1), name='names')
+        # Including a value with the separator used to join values in the column versions
+        column_with_missing_values = pd.Series(names + [np.nan, None, 2, 'Abies \x00 abies'], dtype=object)
+
+        for scalar_function, column_function in [(clean_whitespaces_in_names, clean_whitespaces_in_column),
+                                                 (remove_spacelike_chars, remove_spacelike_chars_in_column),
+                                                 (_capitalize_first_letter_of_taxon,
+                                                  _capitalize_first_letter_of_taxon_in_column)]:
+            pd.testing.assert_series_equal(column_function(column), column.apply(scalar_function))
+            pd.testing.assert_series_equal(column_function(column_with_missing_values),
+                                           column_with_missing_values.apply(scalar_function))
+
+        pd.testing.assert_series_equal(add_space_around_hybrid_chars_and_infraspecific_epithets_in_column(column),
+                                       column.apply(add_space_around_hybrid_chars_and_infraspecific_epithets))
+
 
 if __name__ == '__main__':
     unittest.main()
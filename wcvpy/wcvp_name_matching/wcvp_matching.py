@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Tuple
 
 import numpy as np
 import pandas as pd
@@ -7,6 +7,8 @@ from wcvpy.wcvp_download import get_all_taxa, wcvp_columns, wcvp_accepted_column
 from wcvpy.wcvp_name_matching import clean_urn_ids, output_record_col_names, lowercase_name_col, \
     remove_fullstop, tidied_taxon_authors_col, tidy_authors, \
     status_priority
+from wcvpy.wcvp_name_matching.match_index import MatchIndex, get_match_index, match_keys, hash_keys, match_key_columns, \
+    tidy_values_for_matching_in_column
 
 
 def lookup_ipni_id_in_wcvp(all_taxa: pd.DataFrame, given_id: str) -> pd.DataFrame:
@@ -50,34 +52,48 @@ def tidy_value_for_matching(given_value: str) -> str:
     return rmved_whitespace
 
 
-def match_name_to_concatenated_columns(df: pd.DataFrame, matching_name_col: str, all_taxa: pd.DataFrame,
-                                       columns: List[str]):
-    # Remove taxa without author information as these are matched later without authors
-    taxa_to_use = all_taxa.dropna(subset=columns).copy()
-    column_series = [all_taxa[c].fillna('') for c in columns]
-    taxa_to_use['taxon_name_with_extra_columns'] = taxa_to_use[wcvp_columns['name']].str.cat(column_series,
-                                                                                             sep=' ')
-    taxa_to_use['taxon_name_with_extra_columns'] = taxa_to_use['taxon_name_with_extra_columns'].apply(
-        tidy_value_for_matching)
-
-    df[lowercase_name_col] = df[matching_name_col].apply(tidy_value_for_matching)
+def _find_taxa_with_keys(keys: pd.Series, all_taxa: pd.DataFrame, match_index: MatchIndex,
+                         taxa_positions: np.ndarray, columns: Tuple[str, ...]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Looks up the given match keys in the match index.
+    :return: Positions in keys and the positions in all_taxa of the taxa with that key, ordered by position in keys
+    and then by position in all_taxa.
+    """
+    key_positions, index_rows = match_index.candidates(columns, hash_keys(keys))
+    taxa_rows = taxa_positions[index_rows]
+    in_taxa = taxa_rows >= 0
+    order = np.lexsort((taxa_rows[in_taxa], key_positions[in_taxa]))
+    key_positions = key_positions[in_taxa][order]
+    taxa_rows = taxa_rows[in_taxa][order]
+    # The index is looked up by hash, so check the keys are the same
+    same_key = match_keys(all_taxa.iloc[taxa_rows], columns).to_numpy() == keys.to_numpy()[key_positions]
+    return key_positions[same_key], taxa_rows[same_key]
+
+
+def _merge_with_taxa_with_keys(df: pd.DataFrame, key_col: str, all_taxa: pd.DataFrame, match_index: MatchIndex,
+                               taxa_positions: np.ndarray, columns: Tuple[str, ...]) -> pd.DataFrame:
+    # Same as merging df with the taxa on their match keys, keeping only rows of df which match
+    df_rows, taxa_rows = _find_taxa_with_keys(df[key_col], all_taxa, match_index, taxa_positions, columns)
+    return pd.concat([df.iloc[df_rows].reset_index(drop=True), all_taxa.iloc[taxa_rows].reset_index(drop=True)],
+                     axis=1)
+
+
+def _match_name_to_concatenated_columns(df: pd.DataFrame, matching_name_col: str, all_taxa: pd.DataFrame,
+                                        columns: List[str], match_index: MatchIndex, taxa_positions: np.ndarray):
+    columns = tuple(columns)
+    df[lowercase_name_col] = tidy_values_for_matching_in_column(df[matching_name_col])
     # Match with taxon authors
-    author_merged = pd.merge(df, taxa_to_use, how='left', left_on=lowercase_name_col,
-                             right_on='taxon_name_with_extra_columns')
-    author_merged = author_merged.dropna(subset=[wcvp_columns['wcvp_id']])
+    author_merged = _merge_with_taxa_with_keys(df, lowercase_name_col, all_taxa, match_index, taxa_positions,
+                                               columns)
 
     unmatched_with_authors_df = df[~df[lowercase_name_col].isin(author_merged[lowercase_name_col].values)].copy()
 
     # Repeat but with 'tidied' authors
-    unmatched_with_authors_df[tidied_taxon_authors_col] = unmatched_with_authors_df[matching_name_col].apply(
-        tidy_authors)
-    unmatched_with_authors_df[tidied_taxon_authors_col] = unmatched_with_authors_df[
-        tidied_taxon_authors_col].apply(tidy_value_for_matching)
+    unmatched_with_authors_df[tidied_taxon_authors_col] = tidy_values_for_matching_in_column(
+        unmatched_with_authors_df[matching_name_col].apply(tidy_authors))
 
-    tidy_author_merged = pd.merge(unmatched_with_authors_df, taxa_to_use, how='left',
-                                  left_on=tidied_taxon_authors_col,
-                                  right_on='taxon_name_with_extra_columns')
-    tidy_author_merged = tidy_author_merged.dropna(subset=[wcvp_columns['wcvp_id']])
+    tidy_author_merged = _merge_with_taxa_with_keys(unmatched_with_authors_df, tidied_taxon_authors_col, all_taxa,
+                                                    match_index, taxa_positions, columns)
 
     matched = pd.concat([author_merged, tidy_author_merged], ignore_index=True)
 
@@ -91,6 +107,173 @@ def match_name_to_concatenated_columns(df: pd.DataFrame, matching_name_col: str,
     return matched, unmatched
 
 
+def match_name_to_concatenated_columns(df: pd.DataFrame, matching_name_col: str, all_taxa: pd.DataFrame,
+                                       columns: List[str]):
+    match_index, taxa_positions = get_match_index(all_taxa, [tuple(columns)])
+    return _match_name_to_concatenated_columns(df, matching_name_col, all_taxa, columns, match_index,
+                                               taxa_positions)
+
+
+# Keys tried in turn by direct matching: the columns added to the name and whether authors in the name are tidied
+_direct_match_steps = [(columns, tidy_name_authors) for columns in match_key_columns[:-1] for tidy_name_authors in
+                       [False, True]] + [(match_key_columns[-1], False)]
+
+
+def _find_best_taxa_with_keys(keys: pd.Series, all_taxa: pd.DataFrame, match_index: MatchIndex,
+                              taxa_positions: np.ndarray, columns: Tuple[str, ...]):
+    """
+    Looks up the best taxon for each of the given match keys, as resolved in the match index.
+    :return: Positions in keys, positions in all_taxa of their best taxa, the number of taxa with each key and the
+    hashes of the keys. None if the index can't resolve the keys.
+    """
+    key_hashes = hash_keys(keys)
+    matches = match_index.best_matches(columns, key_hashes)
+    if matches is None:
+        return None
+    key_positions, index_rows, counts = matches
+    taxa_rows = taxa_positions[index_rows]
+    # The index is looked up by hash, so check the keys are the same
+    same_key = match_keys(all_taxa.iloc[taxa_rows], columns).to_numpy() == keys.to_numpy()[key_positions]
+    key_positions = key_positions[same_key]
+    return key_positions, taxa_rows[same_key], counts[same_key], key_hashes[key_positions]
+
+
+def _direct_match_names(names: pd.Series, find_taxa):
+    """
+    Finds the taxa matching each name, trying each of _direct_match_steps in turn for names that haven't matched yet.
+    Names are tidied once and each step is a lookup in the match index.
+    :param names:
+    :param find_taxa: Function taking a series of match keys and the columns the keys are made with, which returns the
+    positions in the keys which match followed by any arrays of what was found for them, or None if it can't find them.
+    :return: Positions in names and the step they matched at, followed by the arrays returned by find_taxa. Ordered
+    by step and then position in names. None if find_taxa returns None.
+    """
+    tidied_names = tidy_values_for_matching_in_column(names).to_numpy(dtype=object)
+    tidied_author_names = None
+    unmatched = np.arange(len(names.index))
+    name_positions, steps, found_arrays = [], [], []
+    for step, (columns, tidy_name_authors) in enumerate(_direct_match_steps):
+        if tidy_name_authors:
+            if tidied_author_names is None:
+                # Only needed for names not matched by the first step
+                tidied_author_names = np.full(len(names.index), None, dtype=object)
+                tidied_author_names[unmatched] = tidy_values_for_matching_in_column(
+                    names.iloc[unmatched].apply(tidy_authors)).to_numpy(dtype=object)
+            keys = tidied_author_names[unmatched]
+        else:
+            keys = tidied_names[unmatched]
+        found = find_taxa(pd.Series(keys, dtype=object), columns)
+        if found is None:
+            return None
+        key_positions = found[0]
+        name_positions.append(unmatched[key_positions])
+        steps.append(np.full(len(key_positions), step))
+        found_arrays.append(found[1:])
+        still_unmatched = np.full(len(unmatched), True)
+        still_unmatched[key_positions] = False
+        unmatched = unmatched[still_unmatched]
+    return (np.concatenate(name_positions), np.concatenate(steps)) + tuple(
+        np.concatenate(arrays) for arrays in zip(*found_arrays))
+
+
+def _status_priorities(statuses: np.ndarray) -> np.ndarray:
+    priorities = pd.Series(statuses, dtype=object).map({s: i for i, s in enumerate(status_priority)})
+    if priorities.isna().any():
+        r = statuses[priorities.isna().to_numpy()][0]
+        raise ValueError(f'Status priority list does not contain {r} and needs updating.')
+    return priorities.to_numpy(dtype=np.int64)
+
+
+def _matched_names(all_taxa: pd.DataFrame, taxa_rows: np.ndarray, steps: np.ndarray) -> np.ndarray:
+    # The taxon names followed by the columns used to match them
+    matched_names = all_taxa[wcvp_columns['name']].to_numpy(dtype=object)[taxa_rows]
+    for step, (columns, _) in enumerate(_direct_match_steps):
+        in_step = steps == step
+        for c in columns:
+            matched_names[in_step] = matched_names[in_step] + ' ' + all_taxa[c].to_numpy(dtype=object)[
+                taxa_rows[in_step]]
+    return matched_names
+
+
+def _family_filter(df: pd.DataFrame, family_column: str, all_taxa: pd.DataFrame, name_positions: np.ndarray,
+                   taxa_rows: np.ndarray) -> np.ndarray:
+    # Whether each matched taxon is in the family given for its name, if any
+    submitted_families = df[family_column].to_numpy(dtype=object)[name_positions]
+    return pd.isna(submitted_families) | (
+            all_taxa[wcvp_columns['family']].to_numpy(dtype=object)[taxa_rows] == submitted_families) | (
+                   all_taxa[wcvp_accepted_columns['family']].to_numpy(dtype=object)[taxa_rows] == submitted_families)
+
+
+def _best_direct_match_candidates(df: pd.DataFrame, matching_name_col: str, unique_submission_id_col: str,
+                                  all_taxa: pd.DataFrame, family_column: str, match_index: MatchIndex,
+                                  taxa_positions: np.ndarray):
+    """
+    Finds all the candidate taxa for each name and chooses the best for each submission.
+    :return: Positions in df, positions in all_taxa of the best matches, the step they matched at and the number of
+    matches for each submission. Ordered by status priority, then step and then position in df.
+    """
+    name_positions, steps, taxa_rows = _direct_match_names(
+        df[matching_name_col],
+        lambda keys, columns: _find_taxa_with_keys(keys, all_taxa, match_index, taxa_positions, columns))
+
+    if family_column is not None:
+        in_family = _family_filter(df, family_column, all_taxa, name_positions, taxa_rows)
+        name_positions, taxa_rows, steps = name_positions[in_family], taxa_rows[in_family], steps[in_family]
+
+    # Resolve multiple matches for a submission by status priority, and then by the order they were found
+    priorities = _status_priorities(all_taxa[wcvp_columns['status']].to_numpy(dtype=object)[taxa_rows])
+    submission_codes = pd.factorize(df[unique_submission_id_col], use_na_sentinel=False)[0][name_positions]
+    order = np.lexsort((np.arange(len(priorities)), priorities))
+    best = order[~pd.Series(submission_codes[order]).duplicated().to_numpy()]
+    number_of_matches = np.bincount(submission_codes)[submission_codes[best]] if len(best) > 0 else np.array([])
+    return name_positions[best], taxa_rows[best], steps[best], number_of_matches
+
+
+def _best_direct_matches(df: pd.DataFrame, matching_name_col: str, all_taxa: pd.DataFrame, family_column: str,
+                         match_index: MatchIndex, taxa_positions: np.ndarray):
+    """
+    As _best_direct_match_candidates, but using the best matches resolved in the match index rather than looking at
+    every candidate. Assumes each name is a separate submission.
+    :return: As _best_direct_match_candidates, or None if the index can't resolve the names.
+    """
+    found = _direct_match_names(
+        df[matching_name_col],
+        lambda keys, columns: _find_best_taxa_with_keys(keys, all_taxa, match_index, taxa_positions, columns))
+    if found is None:
+        return None
+    name_positions, steps, taxa_rows, number_of_matches, key_hashes = found
+
+    if family_column is not None:
+        # Names matching more than one taxon are resolved again within their given family
+        submitted_families = df[family_column].to_numpy(dtype=object)[name_positions]
+        shared_keys = (number_of_matches > 1) & pd.notna(submitted_families)
+        for step, (columns, _) in enumerate(_direct_match_steps):
+            in_step = np.flatnonzero(shared_keys & (steps == step))
+            matches = match_index.best_matches_in_families(columns, key_hashes[in_step],
+                                                           hash_keys(submitted_families[in_step]))
+            if matches is None:
+                return None
+            found_positions, index_rows, counts = matches
+            step_rows = np.full(len(in_step), -1)
+            step_rows[found_positions] = taxa_positions[index_rows]
+            step_counts = np.zeros(len(in_step), dtype=number_of_matches.dtype)
+            step_counts[found_positions] = counts
+            taxa_rows[in_step] = step_rows
+            number_of_matches[in_step] = step_counts
+        # Check the keys of the taxa found by family hash, then that they're in the given family
+        found = taxa_rows >= 0
+        for step, (columns, _) in enumerate(_direct_match_steps):
+            in_step = np.flatnonzero(found & shared_keys & (steps == step))
+            found[in_step] = hash_keys(match_keys(all_taxa.iloc[taxa_rows[in_step]], columns)) == key_hashes[in_step]
+        found[found] = _family_filter(df, family_column, all_taxa, name_positions[found], taxa_rows[found])
+        name_positions, taxa_rows, steps = name_positions[found], taxa_rows[found], steps[found]
+        number_of_matches = number_of_matches[found]
+
+    priorities = _status_priorities(all_taxa[wcvp_columns['status']].to_numpy(dtype=object)[taxa_rows])
+    order = np.argsort(priorities, kind='stable')
+    return name_positions[order], taxa_rows[order], steps[order], number_of_matches[order]
+
+
 def get_wcvp_info_for_names_in_column(df: pd.DataFrame, matching_name_col: str, unique_submission_id_col: str,
                                       all_taxa: pd.DataFrame = None, family_column: str = None, wcvp_version: str = None):
     """
@@ -105,58 +288,27 @@ def get_wcvp_info_for_names_in_column(df: pd.DataFrame, matching_name_col: str,
     """
     if all_taxa is None:
         all_taxa = get_all_taxa(version=wcvp_version)
+    match_index, taxa_positions = get_match_index(all_taxa)
 
     # First try with author info i.e. taxon name + taxon_authors and then
-    # taxon name + parenthetical_author + primary_author then taxon name + primary author
-    author_merged, unmatched_with_authors_df = match_name_to_concatenated_columns(df, matching_name_col,
-                                                                                  all_taxa,
-                                                                                  [wcvp_columns['authors']])
-
-    author_merged['matched_by'] = 'direct_wcvp_w_author'
-
-    # Try with paranthetical and primary author columns - slight difference with taxon authors as no parantheses around paranthet author
-    paranthet_author_merged, unmatched_with_paranthet_authors_df = match_name_to_concatenated_columns(
-        unmatched_with_authors_df, matching_name_col,
-        all_taxa,
-        [wcvp_columns['paranthet_author'], wcvp_columns['primary_author']])
-
-    paranthet_author_merged['matched_by'] = 'direct_wcvp_w_author'
-
-    # Try with primary author columns
-    primary_author_merged, unmatched_with_primary_author_df = match_name_to_concatenated_columns(
-        unmatched_with_paranthet_authors_df, matching_name_col,
-        all_taxa,
-        [wcvp_columns['primary_author']])
-
-    primary_author_merged['matched_by'] = 'direct_wcvp_w_author'
-
-    # Match with just name
-    all_taxa['tidied_taxon_name'] = all_taxa[wcvp_columns['name']].apply(tidy_value_for_matching)
-    unmatched_with_primary_author_df[lowercase_name_col] = unmatched_with_primary_author_df[
-        matching_name_col].apply(tidy_value_for_matching)
-    just_name_merged = pd.merge(unmatched_with_primary_author_df, all_taxa, how='left',
-                                left_on=lowercase_name_col,
-                                right_on='tidied_taxon_name')
-    just_name_merged = just_name_merged.dropna(subset=[wcvp_columns['wcvp_id']])
-    just_name_merged['matched_by'] = 'direct_wcvp'
-    just_name_merged['matched_name'] = just_name_merged[wcvp_columns['name']]
-
-    merged_with_wcvp = pd.concat([author_merged, paranthet_author_merged, primary_author_merged, just_name_merged])
-    match_df = get_family_specific_resolutions(merged_with_wcvp, family_column=family_column)
-    match_df = match_df[[unique_submission_id_col] + output_record_col_names + ['matched_by', 'matched_name']].copy()
-
-    # Remove duplicates in match_df based on priority
-
-    for r in match_df["taxon_status"].unique():
-        if r not in status_priority:
-            raise ValueError(f'Status priority list does not contain {r} and needs updating.')
-    match_df['taxon_status'] = pd.Categorical(match_df['taxon_status'],
-                                              status_priority)
-    match_df = match_df.sort_values('taxon_status')
+    # taxon name + parenthetical_author + primary_author then taxon name + primary author, and finally just the name.
+    # Each is tried with the given name and then with authors in the name tidied.
+    # Multiple matches for a submission are resolved by status priority, and then by the order they were found. This
+    # is done in advance by the index of the full checklist.
+    best_matches = None
+    if match_index.resolves_best(taxa_positions) and df[unique_submission_id_col].is_unique:
+        best_matches = _best_direct_matches(df, matching_name_col, all_taxa, family_column, match_index,
+                                            taxa_positions)
+    if best_matches is None:
+        best_matches = _best_direct_match_candidates(df, matching_name_col, unique_submission_id_col, all_taxa,
+                                                     family_column, match_index, taxa_positions)
+    name_positions, taxa_rows, steps, number_of_matches = best_matches
+
+    match_df = pd.concat([df[[unique_submission_id_col]].iloc[name_positions].reset_index(drop=True),
+                          all_taxa[output_record_col_names].iloc[taxa_rows].reset_index(drop=True)], axis=1)
     # Appropriately label unique matches
-    match_df['matched_by'] = np.where(match_df.duplicated(keep=False, subset=[unique_submission_id_col]),
-                                      match_df['matched_by'],
-                                      match_df['matched_by'] + '_unique')
-    match_df = match_df.drop_duplicates(subset=[unique_submission_id_col], keep='first')
+    matched_by = np.where(steps == len(_direct_match_steps) - 1, 'direct_wcvp', 'direct_wcvp_w_author')
+    match_df['matched_by'] = np.where(number_of_matches == 1, np.char.add(matched_by, '_unique'), matched_by)
+    match_df['matched_name'] = _matched_names(all_taxa, taxa_rows, steps)
     match_df['taxon_status'] = match_df['taxon_status'].astype(object)
     return match_df